@@ -21,8 +21,8 @@ from adora.tasks import (
     azkivam_reverse,
     azkivam_status,
     azkivam_verify,
+    dispatch_outbox,
     get_snap_pay_access_token,
-    send_order_status_message,
     snappay_cancel,
     snappay_settle,
     snappay_status,
@@ -33,10 +33,13 @@ from adora.tasks import (
     torobpay_status,
     torobpay_verify,
 )
+from core.utils.money import Rial, toman_to_rial, wallet_split
+from core.utils.normalize_text import normalize_text
 from core.utils.separate_and_convert_to_fa import separate_digits_and_convert_to_fa
 from core.utils.show_jalali_datetime import show_date_time
 from import_export.admin import ExportActionMixin
 from adora.resources import OrderResource
+from adora import outbox
 
 admin.site.site_header = "پنل ادمین آدورا یدک"
 admin.site.site_title = "پنل ادمین آدورا یدک"
@@ -62,6 +65,15 @@ def get_full_name_or_default_name(order: Order) -> str:
     return "کاربر آدورا یدک"
 
 
+class NormalizedSearchMixin:
+    """Normalizes the admin search term so it can be matched against the ``normalized_*`` columns."""
+
+    def get_search_results(self, request, queryset, search_term):
+        return super().get_search_results(
+            request, queryset, normalize_text(search_term)
+        )
+
+
 class UserFilter(AutocompleteFilter):
     title = _("شماره تلفن")
     field_name = "user"
@@ -1271,7 +1283,7 @@ async function submitSnapUpdate(orderId, items) {
             # ساخت لیست برای Payload
             cart_items_list = [{
                 "id": p.id,
-                "amount": int(pr * 10),
+                "amount": toman_to_rial(pr),
                 "category": "ابزار و یدک خودرو",
                 "count": c,
                 "name": p.fa_name,
@@ -1281,18 +1293,10 @@ async function submitSnapUpdate(orderId, items) {
             total_amount += order.delivery_cost
 
             # محاسبه کیف پول (دقیقاً طبق منطق شما)
-            wallet_discount = 0
-            if order.use_wallet_balance:
-                wallet_balance = order.amount_used_wallet_balance
-                if wallet_balance >= total_amount:
-                    amount_to_pay = 0
-                    wallet_discount = int(total_amount * 10)
-                else:
-                    amount_to_pay = int((total_amount - wallet_balance) * 10)
-                    wallet_discount = int(wallet_balance * 10)
-            else:
-                amount_to_pay = int(total_amount * 10)
-                wallet_discount = 0
+            amount_to_pay, wallet_discount = wallet_split(
+                total_amount,
+                order.amount_used_wallet_balance if order.use_wallet_balance else 0,
+            )
 
             # ارسال به اسنپ‌پی
             payload_data = {
@@ -1302,9 +1306,9 @@ async function submitSnapUpdate(orderId, items) {
                     "cartItems": cart_items_list,
                     "isShipmentIncluded": True if order.delivery_cost else False,
                     "isTaxIncluded": True,
-                    "shippingAmount": int(order.delivery_cost * 10) if order.delivery_cost else 0,
+                    "shippingAmount": Rial.from_toman(order.delivery_cost),
                     "taxAmount": 0,
-                    "totalAmount": int(total_amount * 10)
+                    "totalAmount": amount_to_pay + wallet_discount
                 }],
                 "discountAmount": 0,
                 "externalSourceAmount": wallet_discount,
@@ -1325,7 +1329,7 @@ async function submitSnapUpdate(orderId, items) {
                 for product, count, price in final_items:
                     OrderItem.objects.create(order=order, product=product, quantity=count, sold_price=price)
 
-                order.total_price = int(amount_to_pay / 10) if amount_to_pay > 0 else total_amount
+                order.total_price = amount_to_pay.to_toman() if amount_to_pay > 0 else total_amount
                 order.payment_status = "SU"
                 order.save()
 
@@ -1355,18 +1359,19 @@ async function submitSnapUpdate(orderId, items) {
                 # Call `send_message` if the new status is 'shipped' or 'pending'
                 if obj.delivery_status == "P":
                     text_code = os.environ.get("ORDER_PENDING", 0)
-                    send_order_status_message.delay(
+                    outbox.enqueue_order_status_sms(
                         phone_number,
                         [
                             full_name,
                             order_traking_number,
                         ],
                         int(text_code),
+                        order=obj,
                     )
                     # print(text_code)
                 if obj.delivery_status == "S":
                     text_code = os.environ.get("ORDER_SHIPPED", 0)
-                    send_order_status_message.delay(
+                    outbox.enqueue_order_status_sms(
                         phone_number,
                         [
                             full_name,
@@ -1375,17 +1380,19 @@ async function submitSnapUpdate(orderId, items) {
                             order_delivery_traking_num,
                         ],
                         int(text_code),
+                        order=obj,
                     )
 
                 if obj.delivery_status == "D":
                     text_code = os.environ.get("ORDER_DELIVERED", 0)
-                    send_order_status_message.delay(
+                    outbox.enqueue_order_status_sms(
                         phone_number,
                         [
                             full_name,
                             order_traking_number,
                         ],
                         int(text_code),
+                        order=obj,
                     )
 
             rejected_reason = obj.returned_rejected_reason
@@ -1393,18 +1400,19 @@ async function submitSnapUpdate(orderId, items) {
 
                 if obj.returned_status == "RC":
                     text_code = os.environ.get("ORDER_RETURNED_CONFIRM", 0)
-                    send_order_status_message.delay(
+                    outbox.enqueue_order_status_sms(
                         phone_number,
                         [
                             full_name,
                             order_traking_number,
                         ],
                         int(text_code),
+                        order=obj,
                     )
 
                 if obj.returned_status == "RR":
                     text_code = os.environ.get("ORDER_RETURNED_REJECT", 0)
-                    send_order_status_message.delay(
+                    outbox.enqueue_order_status_sms(
                         phone_number,
                         [
                             full_name,
@@ -1412,6 +1420,7 @@ async function submitSnapUpdate(orderId, items) {
                             rejected_reason,
                         ],
                         int(text_code),
+                        order=obj,
                     )
 
         # Proceed with the default save behavior
@@ -1423,10 +1432,10 @@ class OrderFilter(AutocompleteFilter):
     field_name = "order"
 
 
-class OrderItemAdmin(ModelAdminJalaliMixin, admin.ModelAdmin):
+class OrderItemAdmin(NormalizedSearchMixin, ModelAdminJalaliMixin, admin.ModelAdmin):
     list_display = ("id", "order_link", "get_product", "quantity", "get_sold_price")
     list_filter = (OrderFilter,)
-    search_fields = ("product__fa_name", "product__en_name")
+    search_fields = ("product__normalized_fa_name", "product__normalized_en_name")
     search_help_text = _("فقط میتوانید با نام فارسی و انگلیسی محصول سرچ کنید.")
 
     @admin.display(description="شماره پیگیری سفارش")
@@ -1489,7 +1498,7 @@ class ProductImageInline(admin.StackedInline):
     show_change_link = "__all__"
 
 
-class ProductAdmin(ModelAdminJalaliMixin, admin.ModelAdmin):
+class ProductAdmin(NormalizedSearchMixin, ModelAdminJalaliMixin, admin.ModelAdmin):
     list_display = (
         "id",
         "fa_name",
@@ -1502,7 +1511,7 @@ class ProductAdmin(ModelAdminJalaliMixin, admin.ModelAdmin):
         "get_similar_products",
         "get_price",
     )
-    search_fields = ("fa_name", "en_name")
+    search_fields = ("normalized_fa_name", "normalized_en_name")
     search_help_text = _("شما میتوانید با نام فارسی و انگلیسی سرچ کنید.")
     list_filter = (
         CategoryFilter,
@@ -1522,9 +1531,7 @@ class ProductAdmin(ModelAdminJalaliMixin, admin.ModelAdmin):
 
     @admin.display(description="قیمت (با تخفیف)")
     def get_price(self, obj):
-        return separate_digits_and_convert_to_fa(
-            obj.price - ((obj.price * obj.price_discount_percent) / 100)
-        )
+        return separate_digits_and_convert_to_fa(obj.discounted_price)
 
     @admin.display(description="دسته بندی")
     def get_category(self, obj):
@@ -1584,9 +1591,9 @@ class CategoryAdmin(ModelAdminJalaliMixin, admin.ModelAdmin):
         return format_html('<a target=_blank href="{}">{}</a>', obj.image, "عکس")
 
 
-class BrandAdmin(ModelAdminJalaliMixin, admin.ModelAdmin):
+class BrandAdmin(NormalizedSearchMixin, ModelAdminJalaliMixin, admin.ModelAdmin):
     list_display = ("id", "name", "abbreviation", "get_image", "get_products")
-    search_fields = ("name",)
+    search_fields = ("^normalized_name",)
     search_help_text = _("فقط میتوانید با نام برند سرچ کنید.")
 
     @admin.display(description=_("لیست محصولات"))
@@ -1602,9 +1609,9 @@ class BrandAdmin(ModelAdminJalaliMixin, admin.ModelAdmin):
         return format_html('<a target=_blank href="{}">{}</a>', obj.image, "عکس")
 
 
-class CarAdmin(ModelAdminJalaliMixin, admin.ModelAdmin):
+class CarAdmin(NormalizedSearchMixin, ModelAdminJalaliMixin, admin.ModelAdmin):
     list_display = ("id", "fa_name", "get_image", "get_products")
-    search_fields = ("fa_name",)
+    search_fields = ("^normalized_fa_name",)
     search_help_text = _("فقط میتوانید با نام برند سرچ کنید.")
 
     @admin.display(description=_("لیست محصولات"))
@@ -1916,6 +1923,35 @@ class SMSCampaignSendLogAdmin(ModelAdminJalaliMixin, admin.ModelAdmin):
         )
 
 
+class OutboxMessageAdmin(admin.ModelAdmin):
+    list_display = ("id", "topic", "status", "attempts", "order", "get_created_date")
+    list_filter = ("status", "topic")
+    search_fields = ("order__tracking_number",)
+    raw_id_fields = ("order",)
+    readonly_fields = (
+        "attempts",
+        "last_error",
+        "created_date",
+        "processed_date",
+        "claimed_until",
+    )
+    actions = ["retry_messages"]
+
+    @admin.display(description=_("تاریخ ایجاد"))
+    def get_created_date(self, obj: OutboxMessage):
+        return show_date_time(obj.created_date)
+
+    @admin.action(description=_("ارسال دوباره پیام های ناموفق"))
+    def retry_messages(self, request, queryset):
+        message_ids = list(
+            queryset.filter(status=OutboxMessage.STATUS_FAILED).values_list("id", flat=True)
+        )
+        OutboxMessage.objects.filter(id__in=message_ids).update(
+            status=OutboxMessage.STATUS_PENDING, attempts=0, claimed_until=None
+        )
+        dispatch_outbox.delay(message_ids)
+
+
 admin.site.register(SMSCampaign, SMSCampaignAdmin)
 admin.site.register(SMSCampaignParam, SMSCampaignParamAdmin)
 admin.site.register(SMSCampaignSendLog, SMSCampaignSendLogAdmin)
@@ -1933,3 +1969,4 @@ admin.site.register(Car, CarAdmin)
 admin.site.register(Collaborate_Contact, Collabrate_ContactAdmin)
 admin.site.register(TroboMerchantToken)
 admin.site.register(SnapPayAccessToken)
+admin.site.register(OutboxMessage, OutboxMessageAdmin)
@@ -5,3 +5,6 @@ class AdoraConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "adora"
     verbose_name = "آدورا"
+
+    def ready(self) -> None:
+        import adora.signals
@@ -0,0 +1,140 @@
+"""
+Version counters for cached API payloads.
+
+Cached payloads are stored under keys that embed a version number. Bumping the
+version (from model signals) makes every old key unreachable at once, so no
+key needs to be hunted down and deleted; stale entries simply expire.
+"""
+
+import hashlib
+import json
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import status
+from rest_framework.request import Request
+from rest_framework.response import Response
+
+CATEGORY_TREE = "category_tree"
+# Products, their cars, brands and categories: what the catalog snapshot and facets read.
+CATALOG = "catalog"
+# Everything rendered in product list/detail responses (CATALOG plus images, comments, FAQs).
+PRODUCT_PAGES = "product_pages"
+# What the Torob/Emalls feeds render (CATALOG plus images).
+PRICE_FEEDS = "price_feeds"
+
+
+def _version_key(name: str) -> str:
+    return f"adora:version:{name}"
+
+
+def _initial_version() -> int:
+    # Time based, so a counter lost with Redis never restarts at a version in use before.
+    return time.time_ns() // 1_000_000
+
+
+def get_version(name: str) -> int:
+    key = _version_key(name)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _initial_version(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(name: str) -> int:
+    key = _version_key(name)
+    cache.add(key, _initial_version(), timeout=None)
+    return cache.incr(key)
+
+
+def make_etag(*parts) -> str:
+    return quote_etag("-".join(str(part) for part in parts))
+
+
+def not_modified(request: Request, etag: str) -> bool:
+    etags = parse_etags(request.headers.get("If-None-Match", ""))
+    return etag in etags or "*" in etags
+
+
+def etag_response(request: Request, etag: str, get_data) -> Response:
+    """
+    Returns 304 when the client already has ``etag``; otherwise a 200 response
+    with ``get_data()`` as body. The ``ETag`` header is set on both.
+    """
+    if not_modified(request, etag):
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        response = Response(get_data(), status=status.HTTP_200_OK)
+    response["ETag"] = etag
+    return response
+
+
+def request_signature(request: Request, **extra) -> str:
+    """Digest of the host, sorted query parameters and ``extra``; parameter order does not matter."""
+    params = {name: sorted(request.query_params.getlist(name)) for name in request.query_params}
+    payload = json.dumps(
+        [request.get_host(), sorted(params.items()), sorted(extra.items())],
+        ensure_ascii=False,
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.md5(payload.encode()).hexdigest()
+
+
+def versioned_response_cache(prefix: str, version_name: str):
+    """
+    Caches the data of successful responses of a view method under
+    ``<prefix>:<version>:<request signature>``. Bumping ``version_name`` makes
+    every response cached before the change unreachable.
+    """
+
+    def decorator(view_method):
+        @wraps(view_method)
+        def wrapper(self, request, *args, **kwargs):
+            version = get_version(version_name)
+            cache_key = f"adora:{prefix}:{version}:{request_signature(request, **kwargs)}"
+            data = cache.get(cache_key)
+            if data is not None:
+                return Response(data, status=status.HTTP_200_OK)
+
+            response = view_method(self, request, *args, **kwargs)
+            if response.status_code == status.HTTP_200_OK:
+                cache.set(cache_key, response.data, timeout=settings.PRODUCT_RESPONSE_CACHE_TTL)
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+# Per-product serialized cards, one per serializer (see ProductFragmentMixin).
+# A card key embeds the product's card generation. Invalidating moves the
+# product to a new generation instead of deleting its cards: a reader that
+# read the generation before the change and the rows before the commit would
+# write its stale card back after a delete, but under a generation no longer read.
+
+
+def _card_generation_key(product_id: int) -> str:
+    return f"adora:product-card-generation:{product_id}"
+
+
+def product_fragment_keys(fragment: str, product_ids) -> dict:
+    """Card key of each product for its current generation, in one cache round trip."""
+    generation_keys = {product_id: _card_generation_key(product_id) for product_id in product_ids}
+    generations = cache.get_many(list(generation_keys.values()))
+    return {
+        product_id: f"adora:product-card:{fragment}:{product_id}:{generations.get(key, 0)}"
+        for product_id, key in generation_keys.items()
+    }
+
+
+def invalidate_product_fragments(product_ids) -> None:
+    generation = time.time_ns()
+    cache.set_many(
+        {_card_generation_key(product_id): generation for product_id in set(product_ids)},
+        timeout=None,
+    )
@@ -0,0 +1,382 @@
+"""
+Columnar, memory-mapped snapshot of the product catalog.
+
+The filterable and sortable columns of every product are written as ``.npy``
+arrays into a fresh directory, then a ``CURRENT`` pointer file is atomically
+replaced to publish it. Each gunicorn worker maps the arrays with
+``mmap_mode="r"``, so all workers share the same pages of the OS page cache.
+
+``ProductViewset.list`` filters, sorts and slices the arrays with NumPy and only
+goes to the database to load the products of the requested page. A snapshot
+is tagged with the catalog version (see adora.caching) it was built from; when
+the version moves on, the next request rebuilds it in a background thread,
+under a file lock so only one worker builds. The product list only uses a
+snapshot of the current version and goes to the database meanwhile.
+"""
+
+import fcntl
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from decimal import ROUND_CEILING, Decimal
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from django.conf import settings
+from django.db import connection
+
+from adora.caching import CATALOG, get_version
+from adora.filters import PRODUCT_ORDERINGS
+from adora.models import Brand, Car, Category, Product
+from core.utils.money import hundredths
+
+COLUMNS = (
+    "ids",
+    "price",
+    "discounted_price",
+    "discount_hundredths",
+    "count",
+    "buyer",
+    "created",
+    "rating_avg",
+    "review_count",
+    "brand",
+    "category",
+    "new",
+    "best_seller",
+    "cars",
+    "car_ids",
+    "known_car_ids",
+    "known_brand_ids",
+    "category_ids",
+    "category_parents",
+)
+# ProductFilter parameters the snapshot can answer; any other filter goes to the database.
+SUPPORTED_FILTERS = {
+    "min_price",
+    "max_price",
+    "count",
+    "discounter_products",
+    "category",
+    "compatible_cars",
+    "brand",
+    "new",
+    "best_seller",
+    "ordering",
+}
+SORT_COLUMNS = {
+    "id": "ids",
+    "count": "count",
+    "discounted_price": "discounted_price",
+    "created_date": "created",
+    "buyer": "buyer",
+    "price_discount_percent": "discount_hundredths",
+    "rating_avg": "rating_avg",
+    "review_count": "review_count",
+}
+UNSUPPORTED_FILTERS = {"name", "cursor"}
+BOOLEAN_VALUES = {"true": True, "1": True, "false": False, "0": False}
+NO_BRAND = -1
+
+
+def _root() -> Path:
+    return Path(settings.CATALOG_SNAPSHOT_DIR)
+
+
+class Snapshot:
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.meta = json.loads((directory / "meta.json").read_text())
+        for column in COLUMNS:
+            setattr(self, column, np.load(directory / f"{column}.npy", mmap_mode="r"))
+
+    @property
+    def version(self) -> int:
+        return self.meta["version"]
+
+    def category_subtree(self, category_id: int) -> np.ndarray:
+        subtree = np.array([category_id], dtype=np.int64)
+        frontier = subtree
+        while frontier.size:
+            frontier = self.category_ids[np.isin(self.category_parents, frontier)]
+            subtree = np.concatenate([subtree, frontier])
+        return subtree
+
+    def car_mask(self, car_ids) -> np.ndarray:
+        columns = np.flatnonzero(np.isin(self.car_ids, car_ids))
+        mask = np.zeros(self.ids.size, dtype=bool)
+        for column in columns:
+            byte, bit = divmod(int(column), 8)
+            mask |= (self.cars[:, byte] >> (7 - bit)) & 1 == 1
+        return mask
+
+    def sort_key(self, field: str) -> np.ndarray:
+        """Column of an ordering field, negated for a descending ``-field``."""
+        column = getattr(self, SORT_COLUMNS[field.lstrip("-")])
+        return -column if field.startswith("-") else column
+
+    def select(self, filters: dict) -> Optional[np.ndarray]:
+        """
+        Ids matching ``filters`` in their listing order (PRODUCT_ORDERINGS), or None
+        for an unknown brand or car, which the database path rejects with a 400.
+        """
+        if "brand" in filters and not np.isin(filters["brand"], self.known_brand_ids):
+            return None
+        if "compatible_cars" in filters and not np.isin(
+            filters["compatible_cars"], self.known_car_ids
+        ).all():
+            return None
+
+        mask = np.ones(self.ids.size, dtype=bool)
+        if "min_price" in filters:
+            mask &= self.discounted_price >= filters["min_price"]
+        if "max_price" in filters:
+            mask &= self.discounted_price <= filters["max_price"]
+        if "count" in filters:
+            mask &= self.count >= filters["count"]
+        if "discounter_products" in filters:
+            mask &= self.discount_hundredths >= filters["discounter_products"]
+        if "category" in filters:
+            mask &= np.isin(self.category, self.category_subtree(filters["category"]))
+        if "compatible_cars" in filters:
+            mask &= self.car_mask(filters["compatible_cars"])
+        if "brand" in filters:
+            mask &= self.brand == filters["brand"]
+        if "new" in filters:
+            mask &= self.new == filters["new"]
+        if "best_seller" in filters:
+            mask &= self.best_seller == filters["best_seller"]
+
+        rows = np.flatnonzero(mask)
+        ordering = PRODUCT_ORDERINGS[filters.get("ordering", "default")]
+        # lexsort takes the primary key last.
+        order = np.lexsort([self.sort_key(field)[rows] for field in reversed(ordering)])
+        return self.ids[rows][order]
+
+
+def parse_filters(query_params) -> Optional[dict]:
+    """
+    Typed ProductFilter values, or None when the request uses a filter or a value
+    the snapshot cannot answer exactly like the database would.
+    """
+    if UNSUPPORTED_FILTERS & set(query_params):
+        return None
+    filters = {}
+    try:
+        for name in SUPPORTED_FILTERS:
+            values = [value for value in query_params.getlist(name) if value != ""]
+            if not values:
+                continue
+            if name == "compatible_cars":
+                filters[name] = [int(value) for value in values]
+            elif name == "ordering":
+                if values[-1] not in PRODUCT_ORDERINGS:
+                    return None
+                filters[name] = values[-1]
+            elif name in ("new", "best_seller"):
+                filters[name] = BOOLEAN_VALUES[values[-1].lower()]
+            elif name == "discounter_products":
+                # Hundredths of a percent, rounded up: the same rows as ``>= value``.
+                filters[name] = int(
+                    (Decimal(values[-1]) * 100).to_integral_value(ROUND_CEILING)
+                )
+            else:
+                filters[name] = int(values[-1])
+    except (KeyError, ValueError, ArithmeticError):
+        return None
+    return filters
+
+
+def build(version: int) -> Path:
+    """Writes a snapshot of the current catalog and publishes it."""
+    root = _root()
+    directory = root / f"{version}-{uuid.uuid4().hex}"
+    directory.mkdir(parents=True)
+
+    rows = list(
+        Product.objects.order_by("id").values_list(
+            "id",
+            "price",
+            "price_discount_percent",
+            "discounted_price",
+            "count",
+            "buyer",
+            "created_date",
+            "brand_id",
+            "category_id",
+            "new",
+            "best_seller",
+            "rating_avg",
+            "review_count",
+        )
+    )
+    ids = np.array([row[0] for row in rows], dtype=np.int64)
+    price = np.array([row[1] for row in rows], dtype=np.int64)
+    discount = np.array([hundredths(row[2]) for row in rows], dtype=np.int64)
+
+    car_ids = np.array(
+        sorted(Product.compatible_cars.through.objects.values_list("car_id", flat=True).distinct()),
+        dtype=np.int64,
+    )
+    # Car membership is packed into bits as it is read (np.packbits order: the
+    # first car is the high bit of the first byte), never as one bool per cell.
+    cars = np.zeros((ids.size, (max(car_ids.size, 1) + 7) // 8), dtype=np.uint8)
+    product_rows = {product_id: row for row, product_id in enumerate(ids.tolist())}
+    car_columns = {car_id: column for column, car_id in enumerate(car_ids.tolist())}
+    for product_id, car_id in Product.compatible_cars.through.objects.values_list(
+        "product_id", "car_id"
+    ).iterator():
+        if product_id in product_rows and car_id in car_columns:
+            byte, bit = divmod(car_columns[car_id], 8)
+            cars[product_rows[product_id], byte] |= 0x80 >> bit
+
+    categories = list(Category.objects.values_list("id", "parent_id"))
+    columns = {
+        "ids": ids,
+        "price": price,
+        "discounted_price": np.array([row[3] for row in rows], dtype=np.int64),
+        "discount_hundredths": discount,
+        "count": np.array([row[4] for row in rows], dtype=np.int64),
+        "buyer": np.array([row[5] for row in rows], dtype=np.int64),
+        "created": np.array(
+            [int(row[6].timestamp()) * 1_000_000 + row[6].microsecond for row in rows],
+            dtype=np.int64,
+        ),
+        "rating_avg": np.array([row[11] for row in rows], dtype=np.float64),
+        "review_count": np.array([row[12] for row in rows], dtype=np.int64),
+        "brand": np.array(
+            [NO_BRAND if row[7] is None else row[7] for row in rows], dtype=np.int64
+        ),
+        "category": np.array([row[8] for row in rows], dtype=np.int64),
+        "new": np.array([row[9] for row in rows], dtype=bool),
+        "best_seller": np.array([row[10] for row in rows], dtype=bool),
+        "cars": cars,
+        "car_ids": car_ids,
+        "known_car_ids": np.array(
+            list(Car.objects.values_list("id", flat=True)), dtype=np.int64
+        ),
+        "known_brand_ids": np.array(
+            list(Brand.objects.values_list("id", flat=True)), dtype=np.int64
+        ),
+        "category_ids": np.array([row[0] for row in categories], dtype=np.int64),
+        "category_parents": np.array(
+            [0 if row[1] is None else row[1] for row in categories], dtype=np.int64
+        ),
+    }
+    for name, array in columns.items():
+        np.save(directory / f"{name}.npy", array)
+    (directory / "meta.json").write_text(
+        json.dumps({"version": version, "built_at": time.time(), "size": int(ids.size)})
+    )
+
+    pointer = root / "CURRENT"
+    temporary = root / f"CURRENT.{uuid.uuid4().hex}"
+    temporary.write_text(directory.name)
+    os.replace(temporary, pointer)
+    _remove_old(root, keep=directory.name)
+    return directory
+
+
+def _remove_old(root: Path, keep: str) -> None:
+    # Workers that still map an old snapshot keep their pages until they reload.
+    for entry in root.iterdir():
+        if entry.is_dir() and entry.name != keep:
+            shutil.rmtree(entry, ignore_errors=True)
+
+
+def _rebuild_in_background(version: int) -> None:
+    def run():
+        root = _root()
+        root.mkdir(parents=True, exist_ok=True)
+        with open(root / "build.lock", "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return  # Another worker is building.
+            try:
+                current = _read_pointer()
+                if (
+                    current is None
+                    or _snapshot_version(current) != version
+                    or not _is_complete(current)
+                ):
+                    build(version)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+                connection.close()
+
+    threading.Thread(target=run, name="catalog-snapshot", daemon=True).start()
+
+
+def _read_pointer() -> Optional[str]:
+    try:
+        return (_root() / "CURRENT").read_text().strip()
+    except FileNotFoundError:
+        return None
+
+
+def _snapshot_version(name: str) -> int:
+    return int(name.split("-", 1)[0])
+
+
+def _is_complete(name: str) -> bool:
+    # A snapshot written before a column was added is rebuilt.
+    directory = _root() / name
+    return all((directory / f"{column}.npy").exists() for column in COLUMNS)
+
+
+_loaded = {"name": None, "snapshot": None}
+_loaded_lock = threading.Lock()
+
+
+def current() -> Optional[Snapshot]:
+    """
+    The published snapshot, (re)mapped when the pointer moved, or None unless it
+    was built from the current catalog version: list responses are cached under
+    that version and must not show an older catalog. Starts a rebuild when the
+    catalog changed since it was built and it is older than
+    ``CATALOG_SNAPSHOT_MIN_AGE`` seconds, which debounces bursts of edits.
+    """
+    name = _read_pointer()
+    with _loaded_lock:
+        if name is not None and name != _loaded["name"]:
+            try:
+                _loaded["snapshot"], _loaded["name"] = Snapshot(_root() / name), name
+            except FileNotFoundError:
+                pass  # Replaced again while loading, use the previous one.
+        snapshot = _loaded["snapshot"]
+
+    version = get_version(CATALOG)
+    if snapshot is None:
+        _rebuild_in_background(version)
+        return None
+    if snapshot.version != version:
+        if time.time() - snapshot.meta["built_at"] >= settings.CATALOG_SNAPSHOT_MIN_AGE:
+            _rebuild_in_background(version)
+        return None
+    return snapshot
+
+
+class SnapshotResult:
+    """
+    Sequence of products for a list of ids, sliceable by Django's paginator.
+    Only the sliced ids are loaded from ``queryset``, in snapshot order.
+    """
+
+    def __init__(self, ids: np.ndarray, queryset):
+        self.ids = ids
+        self.queryset = queryset
+
+    def __len__(self):
+        return int(self.ids.size)
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index : index + 1][0]
+        ids = self.ids[index].tolist()
+        products = self.queryset.order_by().in_bulk(ids)
+        return [products[product_id] for product_id in ids if product_id in products]
@@ -0,0 +1,169 @@
+"""
+Catalog delta sync for products/changes.
+
+The storefront and partners keep a resume cursor instead of re-pulling the
+catalog. Changes come from two keyset-ordered sources: products by
+``(updated_date, id)`` (saves and the bulk updates in ``ProductQuerySet``) and
+``CatalogTombstone`` rows by ``(created_date, id)`` (deletes and relation
+changes, which leave ``updated_date`` alone). Each page reads at most
+``limit + 1`` keys of each source from its index, merges them by time and
+loads the products of the page in one query.
+
+Rows newer than ``CATALOG_CHANGES_LAG`` seconds are not served yet: a
+transaction may commit after a later one, and a cursor already past its
+timestamp would skip it. A cursor older than the tombstone retention can no
+longer see every delete and is rejected; the client has to resync. A caught-up
+page moves its cursor to the time it was served up to, so a client that syncs
+regularly keeps a fresh cursor even when nothing is deleted.
+"""
+
+import base64
+import json
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from adora.models import CatalogTombstone, Product
+
+OP_UPDATE = "update"
+OP_DELETE = "delete"
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class ExpiredCursor(Exception):
+    pass
+
+
+@dataclass
+class Change:
+    op: str
+    product_id: int
+    at: datetime
+    product: Optional[Product] = None
+
+
+@dataclass
+class ChangesPage:
+    changes: List[Change]
+    cursor: str
+    has_more: bool
+
+
+def encode_cursor(position: dict) -> str:
+    # Full microseconds, DjangoJSONEncoder would round them to milliseconds.
+    payload = json.dumps(
+        {
+            source: None if key is None else [key[0].isoformat(), key[1]]
+            for source, key in position.items()
+        },
+        separators=(",", ":"),
+    )
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def _key(value) -> Optional[tuple]:
+    if value is None:
+        return None
+    at, object_id = value
+    at = parse_datetime(at)
+    if at is None or not isinstance(object_id, int):
+        raise ValueError
+    return at, object_id
+
+
+def decode_since(since: Optional[str]) -> dict:
+    """
+    Position of ``since``: a cursor from a previous page, a datetime (ISO 8601)
+    to start from, or nothing for a full sync from the beginning.
+    """
+    if not since:
+        return {"products": None, "tombstones": None}
+    start = parse_datetime(since)
+    if start is not None:
+        if timezone.is_naive(start):
+            start = timezone.make_aware(start)
+        position = {"products": (start, 0), "tombstones": (start, 0)}
+    else:
+        try:
+            position = json.loads(base64.urlsafe_b64decode(since.encode()))
+            position = {
+                "products": _key(position["products"]),
+                "tombstones": _key(position["tombstones"]),
+            }
+        except Exception:
+            raise InvalidCursor(since)
+
+    retained_since = timezone.now() - timedelta(days=settings.CATALOG_TOMBSTONE_RETENTION_DAYS)
+    tombstones = position["tombstones"]
+    if tombstones is not None and tombstones[0] < retained_since:
+        raise ExpiredCursor(since)
+    return position
+
+
+def _after(position: Optional[tuple], time_field: str) -> Q:
+    if position is None:
+        return Q()
+    at, object_id = position
+    return Q(**{f"{time_field}__gt": at}) | Q(**{time_field: at, "id__gt": object_id})
+
+
+def catalog_changes(since: Optional[str], limit: int) -> ChangesPage:
+    position = decode_since(since)
+    served_until = timezone.now() - timedelta(seconds=settings.CATALOG_CHANGES_LAG)
+
+    updated = (
+        Product.objects.filter(_after(position["products"], "updated_date"))
+        .filter(updated_date__lt=served_until)
+        .order_by("updated_date", "id")
+        .values_list("updated_date", "id")[: limit + 1]
+    )
+    tombstones = (
+        CatalogTombstone.objects.filter(_after(position["tombstones"], "created_date"))
+        .filter(created_date__lt=served_until)
+        .order_by("created_date", "id")
+        .values_list("created_date", "id", "product_id", "reason")[: limit + 1]
+    )
+    keys = [(at, 0, product_id, product_id, None) for at, product_id in updated]
+    keys += [
+        (at, 1, tombstone_id, product_id, reason)
+        for at, tombstone_id, product_id, reason in tombstones
+    ]
+    keys.sort(key=lambda key: key[:3])
+    has_more = len(keys) > limit
+    keys = keys[:limit]
+
+    # A product changed several times in the page is reported once, at its last change.
+    latest = {}
+    for at, source, object_id, product_id, reason in keys:
+        position["products" if source == 0 else "tombstones"] = (at, object_id)
+        latest.pop(product_id, None)
+        latest[product_id] = (at, reason)
+
+    if not has_more:
+        # Caught up with both sources: move both to served_until, so a cursor
+        # expires by when it was issued, not by when the last tombstone was read.
+        position = {"products": (served_until, 0), "tombstones": (served_until, 0)}
+
+    products = Product.objects.prefetch_related("compatible_cars").in_bulk(
+        [
+            product_id
+            for product_id, (_, reason) in latest.items()
+            if reason != CatalogTombstone.REASON_DELETED
+        ]
+    )
+    changes = []
+    for product_id, (at, reason) in latest.items():
+        product = products.get(product_id)
+        if product is None:
+            changes.append(Change(OP_DELETE, product_id, at))
+        else:
+            changes.append(Change(OP_UPDATE, product_id, at, product))
+    return ChangesPage(changes, encode_cursor(position), has_more)
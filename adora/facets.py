@@ -0,0 +1,96 @@
+"""
+Filter sidebar counts for the product listing.
+
+Given the queryset produced by the current ``ProductFilter`` state, every facet
+is computed by a fixed number of grouped aggregates over the matching product
+ids (brand, category, car, and one pass for stock and price buckets), whatever
+the size of the catalog.
+"""
+
+import hashlib
+import json
+
+from django.conf import settings
+from django.db.models import Count, Max, Min, Q
+
+from adora.models import Product
+
+
+def facets_cache_key(version: int, filter_params: dict) -> str:
+    """Cache key of a filter state at a catalog version; parameter and value order does not matter."""
+    signature = json.dumps(
+        {name: sorted(values) for name, values in sorted(filter_params.items()) if values},
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return f"adora:products:facets:{version}:{hashlib.md5(signature.encode()).hexdigest()}"
+
+
+def _price_bucket_bounds():
+    bounds = list(settings.PRODUCT_FACET_PRICE_BUCKETS)
+    return list(zip(bounds, bounds[1:] + [None]))
+
+
+def compute_product_facets(queryset) -> dict:
+    product_ids = queryset.order_by().values("id")
+    products = Product.objects.filter(id__in=product_ids).order_by()
+
+    buckets = _price_bucket_bounds()
+    bucket_counts = {
+        f"bucket_{index}": Count(
+            "id",
+            filter=Q(discounted_price__gte=low)
+            & (Q(discounted_price__lt=high) if high is not None else Q()),
+        )
+        for index, (low, high) in enumerate(buckets)
+    }
+    summary = products.aggregate(
+        total=Count("id"),
+        in_stock=Count("id", filter=Q(count__gt=0)),
+        min_price=Min("discounted_price"),
+        max_price=Max("discounted_price"),
+        **bucket_counts,
+    )
+
+    brands = (
+        products.filter(brand__isnull=False)
+        .values("brand_id", "brand__name")
+        .annotate(count=Count("id"))
+        .order_by("-count", "brand__name")
+    )
+    categories = (
+        products.values("category_id", "category__name")
+        .annotate(count=Count("id"))
+        .order_by("-count", "category__name")
+    )
+    cars = (
+        Product.compatible_cars.through.objects.filter(product_id__in=product_ids)
+        .values("car_id", "car__fa_name")
+        .annotate(count=Count("product_id"))
+        .order_by("-count", "car__fa_name")
+    )
+
+    return {
+        "total": summary["total"],
+        "brands": [
+            {"id": row["brand_id"], "name": row["brand__name"], "count": row["count"]}
+            for row in brands
+        ],
+        "categories": [
+            {"id": row["category_id"], "name": row["category__name"], "count": row["count"]}
+            for row in categories
+        ],
+        "cars": [
+            {"id": row["car_id"], "name": row["car__fa_name"], "count": row["count"]}
+            for row in cars
+        ],
+        "stock": {
+            "in_stock": summary["in_stock"],
+            "out_of_stock": summary["total"] - summary["in_stock"],
+        },
+        "price": {"min": summary["min_price"], "max": summary["max_price"]},
+        "price_ranges": [
+            {"min": low, "max": high, "count": summary[f"bucket_{index}"]}
+            for index, (low, high) in enumerate(buckets)
+        ],
+    }
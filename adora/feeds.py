@@ -0,0 +1,348 @@
+"""
+Price-comparison feeds (Torob, Emalls...) generated from declarative specs.
+
+Each marketplace is a ``FeedSpec`` in ``FEEDS``: its output fields in order,
+the price rule, product page URL and output format. Products are streamed
+with ``QuerySet.iterator(chunk_size=...)`` into a JSON or XML writer, which
+writes to disk (plus a gzip copy) as it goes, so memory stays bounded at any
+catalog size. Adding a marketplace is adding a spec.
+
+Crawlers fetch the feeds often and in bursts, so they are not generated per
+request. A Celery task writes every feed (every page of a paged one as its own
+file) into a fresh directory under ``MEDIA_ROOT/feeds``, then atomically
+replaces the ``CURRENT.json`` manifest to publish it. The endpoints answer
+with the published file, through nginx ``X-Accel-Redirect`` when
+``PRICE_FEEDS_ACCEL_REDIRECT`` is set, with an ``ETag`` and ``Last-Modified``
+so unchanged feeds cost a 304.
+
+Feeds are tagged with the PRICE_FEEDS version (see adora.caching). Catalog
+changes schedule a rebuild ``PRICE_FEEDS_MIN_INTERVAL`` seconds later, so a
+burst of edits costs one rebuild.
+"""
+
+import gzip
+import json
+import os
+import shutil
+import time
+import uuid
+from dataclasses import dataclass
+from itertools import islice
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+from xml.sax.saxutils import escape
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import (
+    FileResponse,
+    HttpResponse,
+    HttpResponseNotModified,
+    StreamingHttpResponse,
+)
+from django.utils.http import http_date, parse_http_date_safe
+
+from adora.caching import PRICE_FEEDS, get_version, make_etag, not_modified
+from adora.models import Product
+from adora.tasks import regenerate_price_feeds
+
+SCHEDULED_KEY = "adora:feeds:scheduled"
+LOCK_KEY = "adora:feeds:lock"
+# Builds kept besides the published one, for crawlers still paging through it.
+KEEP_PREVIOUS = 1
+
+
+def _root() -> Path:
+    return Path(settings.MEDIA_ROOT) / "feeds"
+
+
+PRODUCT_PAGE_URL = "https://adorayadak.ir/product/adp-{id}/{slug}"
+
+
+def product_page_url(product: Product) -> str:
+    slug = product.fa_name.strip().replace(" ", "-")
+    return PRODUCT_PAGE_URL.format(id=product.id, slug=slug)
+
+
+def selling_price(product: Product) -> int:
+    return int(product.discounted_price)
+
+
+def list_price(product: Product) -> int:
+    return int(product.price)
+
+
+def first_image_url(product: Product) -> Optional[str]:
+    images = product.images.all()
+    return str(images[0].image_url) if images else None
+
+
+@dataclass(frozen=True)
+class FeedSpec:
+    """
+    One marketplace feed. ``fields`` are ``(output name, getter)`` pairs in
+    output order. A feed with ``page_size_setting`` is written as pages of that
+    many products, each wrapped as ``{"pages_count": n, "products": [...]}``
+    (or the XML equivalent); otherwise it is one bare list.
+    """
+
+    name: str
+    fields: Tuple[Tuple[str, Callable[[Product], object]], ...]
+    format: str = "json"
+    page_size_setting: Optional[str] = None
+    only: Tuple[str, ...] = ()
+    select_related: Tuple[str, ...] = ()
+    prefetch_related: Tuple[str, ...] = ()
+
+    @property
+    def extension(self) -> str:
+        return self.format
+
+    @property
+    def content_type(self) -> str:
+        return "application/json" if self.format == "json" else "application/xml"
+
+    def page_size(self) -> Optional[int]:
+        return getattr(settings, self.page_size_setting) if self.page_size_setting else None
+
+    def queryset(self):
+        queryset = Product.objects.order_by("id")
+        if self.only:
+            queryset = queryset.only(*self.only)
+        return queryset.select_related(*self.select_related).prefetch_related(
+            *self.prefetch_related
+        )
+
+    def pages_count(self) -> int:
+        page_size = self.page_size()
+        return max(1, -(-self.queryset().count() // page_size)) if page_size else 1
+
+    def file_name(self, page: int = 1) -> str:
+        if self.page_size_setting:
+            return f"{self.name}-{page}.{self.extension}"
+        return f"{self.name}.{self.extension}"
+
+    def rows(self, queryset) -> Iterator[dict]:
+        for product in queryset.iterator(chunk_size=settings.PRICE_FEEDS_CHUNK_SIZE):
+            yield {name: getter(product) for name, getter in self.fields}
+
+    def pages(self) -> Iterator[Tuple[int, Iterator[bytes]]]:
+        """``(page, chunks)`` for every page; each page must be consumed before the next."""
+        pages_count = self.pages_count()
+        rows = self.rows(self.queryset())
+        page_size = self.page_size()
+        for page in range(1, pages_count + 1):
+            page_rows = islice(rows, page_size) if page_size else rows
+            yield page, WRITERS[self.format](
+                page_rows, pages_count if self.page_size_setting else None
+            )
+
+    def page(self, page: int) -> Iterator[bytes]:
+        """Chunks of one page, generated from the database."""
+        page_size = self.page_size()
+        queryset = self.queryset()
+        if page_size:
+            queryset = queryset[(page - 1) * page_size : page * page_size]
+        pages_count = self.pages_count() if self.page_size_setting else None
+        return WRITERS[self.format](self.rows(queryset), pages_count)
+
+
+def _json_dumps(value) -> str:
+    # Same bytes as DRF's JSONRenderer.
+    text = json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+    return text.replace("\u2028", "\\u2028").replace("\u2029", "\\u2029")
+
+
+def write_json(rows: Iterable[dict], pages_count: Optional[int] = None) -> Iterator[bytes]:
+    if pages_count is not None:
+        yield f'{{"pages_count":{pages_count},"products":['.encode()
+    else:
+        yield b"["
+    for position, row in enumerate(rows):
+        yield (("," if position else "") + _json_dumps(row)).encode()
+    yield b"]}" if pages_count is not None else b"]"
+
+
+def _xml_value(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return escape(str(value))
+
+
+def write_xml(rows: Iterable[dict], pages_count: Optional[int] = None) -> Iterator[bytes]:
+    yield b'<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield (
+        f'<products pages_count="{pages_count}">' if pages_count is not None else "<products>"
+    ).encode()
+    for row in rows:
+        fields = "".join(f"<{name}>{_xml_value(value)}</{name}>" for name, value in row.items())
+        yield f"<product>{fields}</product>".encode()
+    yield b"</products>"
+
+
+WRITERS = {"json": write_json, "xml": write_xml}
+
+FEEDS = {
+    spec.name: spec
+    for spec in (
+        FeedSpec(
+            name="torob",
+            fields=(
+                ("product_id", lambda product: product.id),
+                ("page_url", product_page_url),
+                ("old_price", list_price),
+                ("availability", lambda product: "instock" if product.count > 0 else "outofstock"),
+                ("price", selling_price),
+            ),
+            only=("id", "fa_name", "price", "discounted_price", "count"),
+        ),
+        FeedSpec(
+            name="emalls",
+            fields=(
+                ("id", lambda product: product.id),
+                ("title", lambda product: product.fa_name),
+                ("url", product_page_url),
+                ("old_price", list_price),
+                ("is_available", lambda product: product.count > 0),
+                ("price", selling_price),
+                ("category", lambda product: product.category.name),
+                ("image", first_image_url),
+            ),
+            page_size_setting="EMALLS_FEED_PAGE_SIZE",
+            select_related=("category",),
+            prefetch_related=("images",),
+        ),
+    )
+}
+
+
+def _write(path: Path, chunks: Iterable[bytes]) -> None:
+    compressed_path = path.with_name(f"{path.name}.gz")
+    with open(path, "wb") as plain, gzip.open(compressed_path, "wb", compresslevel=9) as compressed:
+        for chunk in chunks:
+            plain.write(chunk)
+            compressed.write(chunk)
+
+
+def build(version: int) -> dict:
+    """Writes every feed and publishes them; returns the new manifest."""
+    root = _root()
+    name = f"{version}-{uuid.uuid4().hex}"
+    directory = root / name
+    directory.mkdir(parents=True)
+
+    pages = {}
+    for spec in FEEDS.values():
+        for page, chunks in spec.pages():
+            _write(directory / spec.file_name(page), chunks)
+            pages[spec.name] = page
+
+    manifest = {
+        "version": version,
+        "directory": name,
+        "built_at": int(time.time()),
+        "pages": pages,
+    }
+    temporary = root / f"CURRENT.{uuid.uuid4().hex}"
+    temporary.write_text(json.dumps(manifest))
+    os.replace(temporary, root / "CURRENT.json")
+    _remove_old(root, keep=name)
+    return manifest
+
+
+def _remove_old(root: Path, keep: str) -> None:
+    builds = sorted(
+        (entry for entry in root.iterdir() if entry.is_dir() and entry.name != keep),
+        key=lambda entry: entry.stat().st_mtime,
+    )
+    for entry in builds[: max(0, len(builds) - KEEP_PREVIOUS)]:
+        shutil.rmtree(entry, ignore_errors=True)
+
+
+def read_manifest() -> Optional[dict]:
+    try:
+        return json.loads((_root() / "CURRENT.json").read_text())
+    except FileNotFoundError:
+        return None
+
+
+def current_manifest() -> Optional[dict]:
+    """The published manifest, possibly stale; schedules a rebuild when it is."""
+    manifest = read_manifest()
+    if not _is_current(manifest, get_version(PRICE_FEEDS)):
+        schedule_build()
+    return manifest if manifest is not None and "pages" in manifest else None
+
+
+def _is_current(manifest: Optional[dict], version: int) -> bool:
+    # A build from before a feed was added to FEEDS is stale too.
+    return (
+        manifest is not None
+        and manifest["version"] == version
+        and set(manifest.get("pages", ())) == set(FEEDS)
+    )
+
+
+def build_if_stale() -> Optional[dict]:
+    version = get_version(PRICE_FEEDS)
+    manifest = read_manifest()
+    if _is_current(manifest, version):
+        return manifest
+    if not cache.add(LOCK_KEY, 1, timeout=10 * 60):
+        return manifest  # Another worker is building.
+    try:
+        return build(version)
+    finally:
+        cache.delete(LOCK_KEY)
+
+
+def schedule_build() -> None:
+    """Rebuilds ``PRICE_FEEDS_MIN_INTERVAL`` seconds after the first change, folding in later ones."""
+    if cache.add(SCHEDULED_KEY, 1, timeout=settings.PRICE_FEEDS_MIN_INTERVAL):
+        regenerate_price_feeds.apply_async(countdown=settings.PRICE_FEEDS_MIN_INTERVAL)
+
+
+def serve(request, name: str, page: int = 1):
+    """
+    Page ``page`` of feed ``name``: the published file, or generated from the
+    database while the first build is pending. ``None`` when there is no such page.
+    """
+    spec = FEEDS[name]
+    manifest = current_manifest()
+    if manifest is not None and name in manifest["pages"]:
+        if page > manifest["pages"][name]:
+            return None
+        return feed_response(request, spec, spec.file_name(page), manifest)
+
+    # Not built yet.
+    if page > spec.pages_count():
+        return None
+    return StreamingHttpResponse(spec.page(page), content_type=spec.content_type)
+
+
+def feed_response(request, spec: FeedSpec, file_name: str, manifest: dict):
+    """The published ``file_name`` with validators, or a 304 when the client has it."""
+    etag = make_etag("feed", manifest["directory"], file_name)
+    if_modified_since = parse_http_date_safe(request.headers.get("If-Modified-Since", ""))
+    if not_modified(request, etag) or (
+        "If-None-Match" not in request.headers
+        and if_modified_since is not None
+        and if_modified_since >= manifest["built_at"]
+    ):
+        response = HttpResponseNotModified()
+    elif settings.PRICE_FEEDS_ACCEL_REDIRECT:
+        # nginx serves the file (and its .gz copy) from the internal location.
+        response = HttpResponse(content_type=spec.content_type)
+        response["X-Accel-Redirect"] = (
+            f"{settings.PRICE_FEEDS_ACCEL_REDIRECT}{manifest['directory']}/{file_name}"
+        )
+    else:
+        response = FileResponse(
+            open(_root() / manifest["directory"] / file_name, "rb"),
+            content_type=spec.content_type,
+        )
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(manifest["built_at"])
+    return response
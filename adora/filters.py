@@ -1,15 +1,34 @@
 from django_filters import rest_framework as filters
+from django.db.models import Q
 from adora.models import Product, Category
+from core.utils.normalize_text import normalized_variants
 from decimal import Decimal
 from django.core.exceptions import ValidationError
 from django.http import JsonResponse, HttpResponseBadRequest
+# Whitelisted listing orders; each one ends with the id so pages are stable and
+# each one has a matching composite index on Product.
+PRODUCT_ORDERINGS = {
+    'default': ('-count', '-id'),
+    'cheapest': ('discounted_price', 'id'),
+    'most_expensive': ('-discounted_price', '-id'),
+    'newest': ('-created_date', '-id'),
+    'best_seller': ('-buyer', '-id'),
+    'most_discounted': ('-price_discount_percent', '-id'),
+    'best_rated': ('-rating_avg', '-review_count', '-id'),
+}
+
+
 class ProductFilter(filters.FilterSet):
     
-    min_price = filters.NumberFilter(field_name="price", lookup_expr='gte')
-    max_price = filters.NumberFilter(field_name="price", lookup_expr='lte')
+    min_price = filters.NumberFilter(field_name="discounted_price", lookup_expr='gte')
+    max_price = filters.NumberFilter(field_name="discounted_price", lookup_expr='lte')
     count = filters.NumberFilter(field_name="count", lookup_expr='gte')
     discounter_products = filters.NumberFilter(field_name='price_discount_percent', lookup_expr='gte')
     category = filters.NumberFilter(method='filter_by_category')
+    name = filters.CharFilter(method='filter_by_name')
+    ordering = filters.ChoiceFilter(
+        choices=[(key, key) for key in PRODUCT_ORDERINGS], method='filter_ordering'
+    )
 
     # min_price = filters.NumberFilter(field_name="price", lookup_expr='gte', method='filter_min_price')
     # max_price = filters.NumberFilter(field_name="price", lookup_expr='lte', method='filter_max_price')
@@ -17,14 +36,22 @@ class ProductFilter(filters.FilterSet):
 
     def filter_by_category(self, queryset, name, value):
         try:
-            # Fetch the category and its descendants
-            category = Category.objects.get(id=value)
-            categories = [category] + category.get_descendants()
-            category_ids = [cat.id for cat in categories]
-            return queryset.filter(category__id__in=category_ids)
+            # The category and its descendants, matched by materialized path prefix
+            category = Category.objects.only("path").get(id=value)
+            return queryset.filter(category__in=category.get_subtree_ids())
         except Category.DoesNotExist:
             return queryset.none()  # Return no results if category does not exist
-    
+
+    def filter_by_name(self, queryset, name, value):
+        # Prefix match on the stored normalized names, served by their indexes.
+        condition = Q()
+        for variant in normalized_variants(value):
+            condition |= Q(normalized_fa_name__startswith=variant)
+            condition |= Q(normalized_en_name__startswith=variant)
+        return queryset.filter(condition) if condition else queryset
+
+    def filter_ordering(self, queryset, name, value):
+        return queryset.order_by(*PRODUCT_ORDERINGS[value])
 
     class Meta:
         model = Product
@@ -0,0 +1,146 @@
+"""
+Request-scoped batch loaders for serializer method fields.
+
+A ``SerializerMethodField`` that follows a relation (``obj.user.profile``,
+``obj.replies.all()``...) costs one query per serialized object. Serializers
+using ``BatchLoadMixin`` instead declare the relations they read in
+``loaders``, a mapping of loader name to the instance attribute holding its
+key. When a ``many=True`` serializer starts, the keys of every instance are
+queued on the loaders, and the first ``load()`` resolves all of them with one
+query. Loaders live on the request (or on the serializer context without one),
+so nested serializers sharing the context share their results too.
+
+A batch function may queue keys on other loaders for the objects it fetched,
+which is how a page of products resolves the comments of all products, then
+the reply threads and users of all those comments, in one query each.
+"""
+
+from collections import defaultdict
+from typing import Callable, Dict, Iterable
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models import F, Q, Window
+from django.db.models.functions import RowNumber
+
+from adora import outbox
+from adora.models import Comment
+
+MISSING = object()
+
+
+class Loader:
+    def __init__(self, registry: "LoaderRegistry", batch: Callable, default=None):
+        self.registry = registry
+        self.batch = batch
+        self.default = default
+        self.results = {}
+        self.pending = set()
+
+    def prime(self, keys: Iterable) -> None:
+        """Queues keys for the next batch."""
+        self.pending.update(key for key in keys if key is not None and key not in self.results)
+
+    def load(self, key):
+        if key not in self.results:
+            self.pending.add(key)
+            self.dispatch()
+        return self.results[key]
+
+    def dispatch(self) -> None:
+        keys, self.pending = self.pending, set()
+        if not keys:
+            return
+        found = self.batch(self.registry, keys)
+        for key in keys:
+            value = found.get(key, MISSING)
+            self.results[key] = self.default() if value is MISSING else value
+
+
+def _users(registry, user_ids) -> dict:
+    return get_user_model().objects.select_related("profile").in_bulk(user_ids)
+
+
+def _product_comments(registry, product_ids) -> dict:
+    """
+    First page of top-level comments of each product, newest first, with one
+    extra comment telling whether there are more.
+    """
+    page_size = settings.PRODUCT_COMMENTS_PAGE_SIZE
+    comments = (
+        Comment.objects.filter(product_id__in=product_ids, parent__isnull=True)
+        .annotate(
+            position=Window(RowNumber(), partition_by=F("product_id"), order_by=F("id").desc())
+        )
+        .filter(position__lte=page_size + 1)
+        .order_by("product_id", "-id")
+    )
+    grouped = defaultdict(list)
+    for comment in comments:
+        grouped[comment.product_id].append(comment)
+        registry["users"].prime([comment.user_id])
+        if comment.position <= page_size:
+            registry["comment_threads"].prime([comment.thread_id])
+    return grouped
+
+
+def _comment_threads(registry, thread_ids) -> dict:
+    """
+    Replies of whole threads in one query, as ``{thread id: {parent id: replies}}``,
+    down to ``COMMENT_REPLY_MAX_DEPTH`` and at most ``COMMENT_REPLIES_LIMIT`` replies per comment.
+    """
+    in_threads = Q()
+    for thread_id in thread_ids:
+        in_threads |= Q(path__startswith=f"/{thread_id}/")
+    replies = Comment.objects.filter(
+        in_threads, depth__gte=1, depth__lte=settings.COMMENT_REPLY_MAX_DEPTH
+    ).order_by("id")
+
+    threads = defaultdict(lambda: defaultdict(list))
+    for reply in replies:
+        siblings = threads[reply.thread_id][reply.parent_id]
+        if len(siblings) < settings.COMMENT_REPLIES_LIMIT:
+            siblings.append(reply)
+            registry["users"].prime([reply.user_id])
+    return threads
+
+
+def _payment_requests(registry, order_ids) -> dict:
+    return outbox.payment_request_statuses(order_ids)
+
+
+def _order_item_cards(registry, product_ids) -> dict:
+    # Imported here: adora.serializers imports this module.
+    from adora.serializers import ProductOrderItemSerializer
+
+    return ProductOrderItemSerializer(context={"_adora_loaders": registry}).cards(product_ids)
+
+
+# name: (batch function, factory of the value of a key with no rows)
+LOADERS = {
+    "users": (_users, lambda: None),
+    "product_comments": (_product_comments, list),
+    "comment_threads": (_comment_threads, dict),
+    "payment_requests": (_payment_requests, lambda: None),
+    "order_item_cards": (_order_item_cards, lambda: None),
+}
+
+
+class LoaderRegistry:
+    def __init__(self):
+        self.loaders: Dict[str, Loader] = {}
+
+    def __getitem__(self, name: str) -> Loader:
+        if name not in self.loaders:
+            batch, default = LOADERS[name]
+            self.loaders[name] = Loader(self, batch, default)
+        return self.loaders[name]
+
+
+def get_loaders(context: dict) -> LoaderRegistry:
+    request = context.get("request")
+    if request is None:
+        return context.setdefault("_adora_loaders", LoaderRegistry())
+    if not hasattr(request, "_adora_loaders"):
+        request._adora_loaders = LoaderRegistry()
+    return request._adora_loaders
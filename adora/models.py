@@ -1,16 +1,61 @@
-from decimal import Decimal
 from functools import reduce
-import random
-import string
+import secrets
+import time
 from datetime import timedelta
+from typing import Tuple
 from django.utils import timezone
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, models, transaction
+from django.db.models import (
+    Case,
+    Count,
+    ExpressionWrapper,
+    F,
+    OuterRef,
+    Q,
+    Subquery,
+    Sum,
+    Value,
+    When,
+)
+from django.db.models.functions import (
+    Cast,
+    Coalesce,
+    Concat,
+    Floor,
+    Greatest,
+    Now,
+    Substr,
+)
+from django.db.models.lookups import GreaterThan
 from django.utils.translation import gettext as _
 from phonenumber_field.modelfields import PhoneNumberField
 import os
 
+from core.utils.money import (
+    Rial,
+    hundredths,
+    percent_of,
+    percent_off,
+    rounded_percent_off,
+    wallet_split,
+)
+from core.utils.normalize_text import normalize_text
+
+
+def _include_derived_fields(save_kwargs: dict, derived: dict) -> None:
+    """
+    Adds the derived columns to ``update_fields`` when one of their source fields
+    is saved. ``derived`` maps a derived field to its source fields.
+    """
+    update_fields = save_kwargs.get("update_fields")
+    if update_fields is not None:
+        save_kwargs["update_fields"] = set(update_fields) | {
+            field for field, sources in derived.items() if set(sources) & set(update_fields)
+        }
+
 
 # Create your models here.
 class Date(models.Model):
@@ -21,6 +66,22 @@ class Date(models.Model):
         abstract = True
 
 
+def _materialized_paths(parents: dict) -> dict:
+    """``{id: "/root id/.../id/"}`` from an ``{id: parent id}`` mapping."""
+    paths = {}
+
+    def path_of(node_id):
+        if node_id not in paths:
+            parent_id = parents.get(node_id)
+            prefix = "/" if parent_id is None else path_of(parent_id)
+            paths[node_id] = f"{prefix}{node_id}/"
+        return paths[node_id]
+
+    for node_id in parents:
+        path_of(node_id)
+    return paths
+
+
 class Category(Date):
     name = models.CharField(max_length=500, verbose_name="نام")
     image = models.URLField(max_length=500, verbose_name=_("لینک عکس دسته بندی"))
@@ -36,24 +97,11 @@ class Category(Date):
         verbose_name="دسته بندی مادر",
     )
 
-    def get_hierarchy(self) -> list:
-        """Returns the full category hierarchy from top-level to this category."""
-        hierarchy = []
-        category = self
-        while category:
-            hierarchy.insert(
-                0,
-                {
-                    "id": category.id,
-                    "name": category.name,
-                },
-            )
-            category = category.parent
-
-        for index, item in enumerate(hierarchy):
-            item["category_level"] = index + 1
-
-        return hierarchy
+    # Materialized path of ids from the root, e.g. "/1/5/12/" for a third level category.
+    path = models.CharField(
+        max_length=255, blank=True, editable=False, db_index=True
+    )
+    depth = models.PositiveSmallIntegerField(default=1, editable=False)
 
     class Meta:
         verbose_name = _("دسته بندی")
@@ -62,26 +110,90 @@ class Category(Date):
     def __str__(self) -> str:
         return self.name
 
+    def _parent_path(self) -> str:
+        if self.parent_id is None:
+            return "/"
+        return Category.objects.values_list("path", flat=True).get(pk=self.parent_id)
+
+    def _parent_is_descendant(self) -> bool:
+        if not (self.pk and self.parent_id):
+            return False
+        return self.parent_id == self.pk or f"/{self.pk}/" in self._parent_path()
+
+    def clean(self):
+        super().clean()
+        if self._parent_is_descendant():
+            raise ValidationError(
+                {"parent": _("دسته بندی نمی‌تواند زیرمجموعه خودش باشد.")}
+            )
+
+    def save(self, *args, **kwargs):
+        old_path = self.path
+        if old_path and self._parent_is_descendant():
+            raise ValidationError(_("دسته بندی نمی‌تواند زیرمجموعه خودش باشد."))
+        super().save(*args, **kwargs)
+
+        new_path = f"{self._parent_path()}{self.pk}/"
+        if new_path == old_path:
+            return
+        new_depth = new_path.count("/") - 1
+        Category.objects.filter(pk=self.pk).update(path=new_path, depth=new_depth)
+        if old_path:
+            # Moving a category moves its whole subtree.
+            Category.objects.filter(path__startswith=old_path).exclude(pk=self.pk).update(
+                path=Concat(Value(new_path), Substr("path", len(old_path) + 1)),
+                depth=F("depth") + (new_depth - self.depth),
+            )
+        self.path, self.depth = new_path, new_depth
+
+    @classmethod
+    def rebuild_tree(cls) -> None:
+        """Recomputes ``path`` and ``depth`` of every category from ``parent``."""
+        paths = _materialized_paths(dict(cls.objects.values_list("id", "parent_id")))
+        categories = list(cls.objects.only("id", "path", "depth"))
+        for category in categories:
+            category.path = paths[category.id]
+            category.depth = category.path.count("/") - 1
+        cls.objects.bulk_update(categories, ["path", "depth"], batch_size=500)
+
+    def get_ancestor_ids(self) -> list:
+        """Ids from the root down to (and including) this category, read from ``path``."""
+        return [int(category_id) for category_id in self.path.strip("/").split("/") if category_id]
+
+    def get_hierarchy(self) -> list:
+        """Returns the full category hierarchy from top-level to this category."""
+        names = dict(
+            Category.objects.filter(id__in=self.get_ancestor_ids()).values_list("id", "name")
+        )
+        return [
+            {"id": category_id, "name": names[category_id], "category_level": level}
+            for level, category_id in enumerate(self.get_ancestor_ids(), start=1)
+            if category_id in names
+        ]
+
     def get_level(self):
         """Returns the level of the category based on the parent hierarchy."""
-        if self.parent is None:
-            return 1
-        elif self.parent.parent is None:
-            return 2
-        else:
-            return 3
+        return min(self.depth, 3)
 
     def get_descendants(self):
-        descendants = []
-        children = self.children.all()
-        for child in children:
-            descendants.append(child)
-            descendants.extend(child.get_descendants())
-        return descendants
+        """All categories below this one, as a single indexed prefix query."""
+        if not self.path:
+            # Unsaved, or not backfilled yet: an empty prefix would match every category.
+            return Category.objects.none()
+        return Category.objects.filter(path__startswith=self.path).exclude(pk=self.pk)
+
+    def get_subtree_ids(self):
+        """Queryset of the ids of this category and all of its descendants."""
+        if not self.path:
+            return Category.objects.filter(pk=self.pk).values("id")
+        return Category.objects.filter(path__startswith=self.path).values("id")
 
 
 class Car(Date):
     fa_name = models.CharField(max_length=100, verbose_name=_("نام فارسی"))
+    normalized_fa_name = models.CharField(
+        max_length=100, blank=True, editable=False, db_index=True
+    )
     image = models.URLField(
         max_length=500, null=True, blank=True, verbose_name=_("عکس ماشین")
     )
@@ -96,9 +208,17 @@ class Car(Date):
     def __str__(self) -> str:
         return self.fa_name
 
+    def save(self, *args, **kwargs):
+        self.normalized_fa_name = normalize_text(self.fa_name)
+        _include_derived_fields(kwargs, {"normalized_fa_name": ["fa_name"]})
+        super().save(*args, **kwargs)
+
 
 class Brand(Date):
     name = models.CharField(max_length=100, verbose_name=_("نام"))
+    normalized_name = models.CharField(
+        max_length=100, blank=True, editable=False, db_index=True
+    )
     image = models.URLField(
         null=True, blank=True, max_length=500, verbose_name=_("لینک عکس برند")
     )
@@ -116,6 +236,11 @@ class Brand(Date):
     def __str__(self) -> str:
         return self.name
 
+    def save(self, *args, **kwargs):
+        self.normalized_name = normalize_text(self.name)
+        _include_derived_fields(kwargs, {"normalized_name": ["name"]})
+        super().save(*args, **kwargs)
+
 
 class Matrial(Date):
     material_name = models.CharField(max_length=500, verbose_name=_("دسته بندی جز"))
@@ -164,12 +289,158 @@ class FAQ(models.Model):
         verbose_name_plural = _("❓ پرسش‌های متداول")
 
 
+class ProductQuerySet(models.QuerySet):
+    # Bulk updates of fields published by products/changes set ``updated_date`` themselves,
+    # auto_now only applies to save().
+
+    def refresh_prices(self) -> int:
+        """Recomputes ``discounted_price`` and ``wallet_reward`` in a single UPDATE."""
+        amount = models.DecimalField(max_digits=30, decimal_places=4)
+        return self.update(
+            updated_date=Now(),
+            discounted_price=Floor(
+                ExpressionWrapper(
+                    F("price") * (100 - F("price_discount_percent")) / 100,
+                    output_field=amount,
+                )
+            ),
+            wallet_reward=Floor(
+                ExpressionWrapper(
+                    F("price") * F("wallet_discount") / 100, output_field=amount
+                )
+            ),
+        )
+
+    def apply_review_delta(self, reviews: int, ratings: int, buy_suggests: int) -> int:
+        """
+        Adds a change of reviews to the stored review aggregates in one atomic
+        UPDATE. A product whose aggregates would go negative had drifted (a
+        review it never counted was removed); it is floored at 0 and then
+        recomputed from its reviews.
+        """
+        deltas = {"review_count": reviews, "rating_sum": ratings, "buy_suggest_count": buy_suggests}
+        drifted = []
+        if min(deltas.values()) < 0:
+            out_of_range = Q()
+            for field, delta in deltas.items():
+                if delta < 0:
+                    out_of_range |= Q(**{f"{field}__lt": -delta})
+            drifted = list(self.filter(out_of_range).values_list("id", flat=True))
+
+        def add(field):
+            return Greatest(
+                F(field) + deltas[field], Value(0), output_field=models.PositiveIntegerField()
+            )
+
+        review_count, rating_sum = add("review_count"), add("rating_sum")
+        updated = self.update(
+            updated_date=Now(),
+            review_count=review_count,
+            rating_sum=rating_sum,
+            buy_suggest_count=add("buy_suggest_count"),
+            rating_avg=_rating_average(rating_sum, review_count),
+        )
+        if drifted:
+            Product.objects.filter(id__in=drifted).refresh_reviews()
+        return updated
+
+    def refresh_reviews(self) -> list:
+        """
+        Recomputes the review aggregates from ``Comment`` for the products whose
+        stored values drifted, in two queries. Returns the ids of those products.
+        """
+        reviews = (
+            Comment.objects.filter(Comment.REVIEWS, product=OuterRef("pk"))
+            .order_by()
+            .values("product")
+        )
+
+        def aggregate(expression):
+            return Coalesce(Subquery(reviews.annotate(value=expression).values("value")), 0)
+
+        review_count = aggregate(Count("id"))
+        rating_sum = aggregate(Sum("rating"))
+        buy_suggest_count = aggregate(Count("id", filter=Q(buy_suggest=True)))
+        drifted = list(
+            self.annotate(
+                actual_review_count=review_count,
+                actual_rating_sum=rating_sum,
+                actual_buy_suggest_count=buy_suggest_count,
+            )
+            .exclude(
+                review_count=F("actual_review_count"),
+                rating_sum=F("actual_rating_sum"),
+                buy_suggest_count=F("actual_buy_suggest_count"),
+            )
+            .values_list("id", flat=True)
+        )
+        if drifted:
+            Product.objects.filter(id__in=drifted).update(
+                updated_date=Now(),
+                review_count=review_count,
+                rating_sum=rating_sum,
+                buy_suggest_count=buy_suggest_count,
+                rating_avg=_rating_average(rating_sum, review_count),
+            )
+            Product.objects.filter(id__in=drifted).refresh_review_highlights()
+        return drifted
+
+    def refresh_review_highlights(self) -> None:
+        """
+        Stores the best review of each product, the one shown on its product
+        card: one query picks the reviews, one loads them, and the changed
+        highlights are written with ``bulk_update``.
+        """
+        best_review = (
+            Comment.objects.filter(Comment.REVIEWS, product=OuterRef("pk"))
+            .exclude(text="")
+            .order_by("-rating", "-buy_suggest", "-id")
+            .values("id")[:1]
+        )
+        products = list(
+            self.order_by()
+            .annotate(highlight_id=Subquery(best_review))
+            .only("id", "review_highlight")
+        )
+        reviews = Comment.objects.select_related("user__profile").in_bulk(
+            [product.highlight_id for product in products if product.highlight_id]
+        )
+        changed = []
+        for product in products:
+            review = reviews.get(product.highlight_id)
+            highlight = review.as_highlight() if review else None
+            if highlight != product.review_highlight:
+                product.review_highlight = highlight
+                changed.append(product)
+        Product.objects.bulk_update(changed, ["review_highlight"], batch_size=500)
+
+
+def _rating_average(rating_sum, review_count):
+    return Case(
+        When(
+            GreaterThan(review_count, 0),
+            then=ExpressionWrapper(
+                Cast(rating_sum, models.FloatField()) / review_count,
+                output_field=models.FloatField(),
+            ),
+        ),
+        default=Value(0.0),
+        output_field=models.FloatField(),
+    )
+
+
 class Product(Date):
     custom_id = models.PositiveBigIntegerField(
         default=0, unique=True, verbose_name=_("شناسه محصول")
     )
     fa_name = models.CharField(max_length=500, verbose_name="نام فارسی")
     en_name = models.CharField(max_length=500, verbose_name="نام انگلیسی")
+    normalized_fa_name = models.CharField(
+        max_length=500, blank=True, editable=False, db_index=True
+    )
+    normalized_en_name = models.CharField(
+        max_length=500, blank=True, editable=False, db_index=True
+    )
     price = models.PositiveBigIntegerField(verbose_name="قیمت محصول")
     price_discount_percent = models.DecimalField(
         max_digits=5, decimal_places=2, verbose_name=" درصد تخفیف قیمت"
@@ -177,6 +448,13 @@ class Product(Date):
     wallet_discount = models.DecimalField(
         max_digits=5, decimal_places=2, verbose_name="درصد تخفیف پاداش محصول"
     )
+    # Derived from price and the percents above on save / ProductQuerySet.refresh_prices().
+    discounted_price = models.PositiveBigIntegerField(
+        default=0, editable=False, verbose_name="قیمت با تخفیف"
+    )
+    wallet_reward = models.PositiveBigIntegerField(
+        default=0, editable=False, verbose_name="پاداش کیف پول"
+    )
     count = models.IntegerField(default=0, verbose_name="تعداد موجودی")
     install_location = models.CharField(
         max_length=500, null=True, blank=True, verbose_name="محل نصب"
@@ -212,6 +490,18 @@ class Product(Date):
     customer_point = models.PositiveIntegerField(
         default=0, verbose_name=_("درصد رضایت خریداران")
     )
+    # Aggregates of the reviews (top-level rated comments), kept up to date by adora.signals.
+    review_count = models.PositiveIntegerField(
+        default=0, editable=False, verbose_name=_("تعداد نظرات")
+    )
+    rating_sum = models.PositiveIntegerField(default=0, editable=False)
+    rating_avg = models.FloatField(
+        default=0, editable=False, verbose_name=_("میانگین امتیاز")
+    )
+    buy_suggest_count = models.PositiveIntegerField(
+        default=0, editable=False, verbose_name=_("تعداد پیشنهاد خرید")
+    )
+    review_highlight = models.JSONField(null=True, blank=True, editable=False)
     title_description = models.TextField(
         null=True, blank=True, verbose_name=_("توضیحات معرفی محصول")
     )
@@ -255,8 +545,10 @@ class Product(Date):
 
     faqs = models.ManyToManyField(FAQ, blank=True, verbose_name="سوالات متداول اختصاصی")
 
+    objects = ProductQuerySet.as_manager()
+
     def get_discounted_price(self)->int:
-        return int(self.price * (1 - (self.price_discount_percent / 100)))
+        return self.discounted_price
 
     def get_all_faqs(self):
         """
@@ -269,10 +561,123 @@ class Product(Date):
     class Meta:
         verbose_name = _("🛍️محصول")
         verbose_name_plural = _("📦️  محصولات")
+        # One index per listing order (adora.filters.PRODUCT_ORDERINGS), read forward or
+        # backward, plus the same order behind the category filter.
+        indexes = [
+            models.Index(fields=["-count", "-id"], name="product_count_id_idx"),
+            models.Index(fields=["discounted_price", "id"], name="product_price_id_idx"),
+            models.Index(fields=["-created_date", "-id"], name="product_newest_id_idx"),
+            models.Index(fields=["-buyer", "-id"], name="product_buyer_id_idx"),
+            models.Index(
+                fields=["-price_discount_percent", "-id"], name="product_discount_id_idx"
+            ),
+            models.Index(
+                fields=["category", "-count", "-id"], name="product_cat_count_id_idx"
+            ),
+            models.Index(
+                fields=["category", "discounted_price", "id"], name="product_cat_price_id_idx"
+            ),
+            models.Index(
+                fields=["category", "-created_date", "-id"], name="product_cat_newest_id_idx"
+            ),
+            models.Index(
+                fields=["category", "-buyer", "-id"], name="product_cat_buyer_id_idx"
+            ),
+            models.Index(
+                fields=["category", "-price_discount_percent", "-id"],
+                name="product_cat_discount_id_idx",
+            ),
+            models.Index(
+                fields=["-rating_avg", "-review_count", "-id"], name="product_rating_id_idx"
+            ),
+            models.Index(
+                fields=["category", "-rating_avg", "-review_count", "-id"],
+                name="product_cat_rating_id_idx",
+            ),
+            # Change feed (adora.changes).
+            models.Index(fields=["updated_date", "id"], name="product_updated_id_idx"),
+        ]
 
     def __str__(self):
         return self.fa_name
 
+    def save(self, *args, **kwargs):
+        self.normalized_fa_name = normalize_text(self.fa_name)
+        self.normalized_en_name = normalize_text(self.en_name)
+        self.discounted_price = percent_off(self.price, hundredths(self.price_discount_percent))
+        self.wallet_reward = percent_of(self.price, hundredths(self.wallet_discount))
+        _include_derived_fields(
+            kwargs,
+            {
+                "normalized_fa_name": ["fa_name"],
+                "normalized_en_name": ["en_name"],
+                "discounted_price": ["price", "price_discount_percent"],
+                "wallet_reward": ["price", "wallet_discount"],
+            },
+        )
+        super().save(*args, **kwargs)
+
+
+class CatalogTombstone(models.Model):
+    """
+    A product change that ``Product.updated_date`` does not show: the product
+    was deleted, or its relations (cars, similar products, FAQs, images, a
+    deleted brand) changed. Read by products/changes together with the
+    updated products, pruned after ``CATALOG_TOMBSTONE_RETENTION_DAYS``.
+    """
+
+    REASON_DELETED = "deleted"
+    REASON_RELATIONS = "relations"
+
+    REASON_CHOICES = [
+        (REASON_DELETED, _("حذف محصول")),
+        (REASON_RELATIONS, _("تغییر روابط محصول")),
+    ]
+
+    # Not a foreign key, the product may be gone.
+    product_id = models.BigIntegerField(verbose_name=_("شناسه محصول"))
+    reason = models.CharField(
+        max_length=10, choices=REASON_CHOICES, verbose_name=_("علت")
+    )
+    created_date = models.DateTimeField(auto_now_add=True, verbose_name="تاریخ ایجاد")
+
+    class Meta:
+        verbose_name = _("تغییر کاتالوگ")
+        verbose_name_plural = _("تغییرات کاتالوگ")
+        indexes = [
+            models.Index(fields=["created_date", "id"], name="tombstone_created_id_idx"),
+        ]
+
+    @classmethod
+    def record(cls, product_ids, reason: str) -> None:
+        cls.objects.bulk_create(
+            [cls(product_id=product_id, reason=reason) for product_id in set(product_ids)]
+        )
+
+
+class ProductSearchToken(models.Model):
+    """One posting of the product search inverted index (see adora.search)."""
+
+    token = models.CharField(max_length=64, verbose_name=_("توکن"))
+    product = models.ForeignKey(
+        Product,
+        on_delete=models.CASCADE,
+        related_name="search_tokens",
+        verbose_name=_("محصول"),
+    )
+
+    class Meta:
+        verbose_name = _("توکن جستجوی محصول")
+        verbose_name_plural = _("توکن‌های جستجوی محصول")
+        constraints = [
+            models.UniqueConstraint(
+                fields=["token", "product"], name="unique_product_search_token"
+            )
+        ]
+
+    def __str__(self):
+        return self.token
+
 
 class CashDiscountPercent(models.Model):
     zarinpal_discount_percent = models.PositiveIntegerField(
@@ -286,6 +691,44 @@ class CashDiscountPercent(models.Model):
     def __str__(self):
         return f"{self.zarinpal_discount_percent}%"
 
+    @classmethod
+    def current(cls) -> int:
+        """The cash discount percent in effect, 0 when none is set."""
+        cash_discount = cls.objects.last()
+        return cash_discount.zarinpal_discount_percent if cash_discount else 0
+
+
+CROCKFORD_BASE32 = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+TRACKING_NUMBER_PREFIX = "ADO"
+TRACKING_TIME_DIGITS = 10  # 50 bits of Unix time in milliseconds
+TRACKING_RANDOM_DIGITS = 14  # 70 bits
+TRACKING_NUMBER_ATTEMPTS = 3
+
+
+def _crockford(value: int, digits: int) -> str:
+    characters = []
+    for _ in range(digits):
+        value, digit = divmod(value, 32)
+        characters.append(CROCKFORD_BASE32[digit])
+    return "".join(reversed(characters))
+
+
+def new_tracking_number() -> str:
+    """
+    ``ADO_`` and 24 Crockford base32 characters: the creation time in
+    milliseconds, then 70 random bits from ``secrets``. Numbers sort by
+    creation time, as text too, so inserts into the unique index stay local.
+    Several endpoints find an order by its tracking number alone, so the
+    random part keeps it unguessable; two orders of the same millisecond
+    practically never draw the same bits, and ``Order.save`` draws again if
+    they do. No query is needed.
+    """
+    milliseconds = time.time_ns() // 1_000_000
+    return (
+        f"{TRACKING_NUMBER_PREFIX}_{_crockford(milliseconds, TRACKING_TIME_DIGITS)}"
+        f"{_crockford(secrets.randbits(5 * TRACKING_RANDOM_DIGITS), TRACKING_RANDOM_DIGITS)}"
+    )
+
 
 class Order(Date):
     NO_ANY_ACTION = "N"
@@ -348,7 +791,7 @@ class Order(Date):
     RECEIVER_CHOICES = [(RECEIVER_IS_MYSELF, "Myself"), (RECEIVER_IS_OTHER, "Other")]
 
     tracking_number = models.CharField(
-        max_length=20, unique=True, verbose_name=_("شماره پیگیری")
+        max_length=32, unique=True, verbose_name=_("شماره پیگیری")
     )
     payment_method = models.CharField(
         max_length=1,
@@ -507,20 +950,14 @@ class Order(Date):
         Product, through="OrderItem", related_name="orders", verbose_name=_("محصولات")
     )
 
-    def _generate_tracking_number(self):
-        prefix = "ADO"
-        suffix_len = 19 - len(prefix)
-        suffix = "".join(
-            random.choices(string.ascii_uppercase + string.digits, k=suffix_len)
-        )
-        return f"{prefix}_{suffix}"
-
-    def generate_unique_tracking_number(self):
-        """Generate a unique tracking number."""
-        while True:
-            tracking_number = self._generate_tracking_number()
-            if not Order.objects.filter(tracking_number=tracking_number).exists():
-                return tracking_number
+    def payment_amounts(self) -> Tuple[Rial, Rial, Rial]:
+        """
+        ``(to pay, paid from the wallet, total)`` in Rial, for the gateways.
+        ``total_price`` is stored with ``amount_used_wallet_balance`` taken off.
+        """
+        total = self.total_price + self.amount_used_wallet_balance
+        to_pay, from_wallet = wallet_split(total, self.amount_used_wallet_balance)
+        return to_pay, from_wallet, to_pay + from_wallet
 
     def get_order_discount(self) -> int:
         # return reduce(lambda total,item:  total + item.get_total_price_without_discount(),self.order_items.all(), 0 )
@@ -528,7 +965,7 @@ class Order(Date):
 
     def save(self, *args, **kwargs):
         if not self.tracking_number:
-            self.tracking_number = self.generate_unique_tracking_number()
+            return self._save_with_new_tracking_number(*args, **kwargs)
 
         # # super().save(*args, **kwargs)
         # self.calculate_total_price()
@@ -543,6 +980,18 @@ class Order(Date):
         # Call the original save method to actually save the data to the database
         super().save(*args, **kwargs)
 
+    def _save_with_new_tracking_number(self, *args, **kwargs):
+        """Inserts the order, drawing another tracking number if the new one is taken."""
+        for attempt in range(1, TRACKING_NUMBER_ATTEMPTS + 1):
+            self.tracking_number = new_tracking_number()
+            try:
+                with transaction.atomic():
+                    return super().save(*args, **kwargs)
+            except IntegrityError:
+                taken = Order.objects.filter(tracking_number=self.tracking_number).exists()
+                if not taken or attempt == TRACKING_NUMBER_ATTEMPTS:
+                    raise
+
     class Meta:
         verbose_name = _("سفارش")
         verbose_name_plural = _("🛒 سفارش‌ها")
@@ -568,7 +1017,7 @@ class OrderItem(models.Model):
     )
 
     def _get_discounted_price(self) -> int:
-        return int(self.product.price * (1 - (self.product.price_discount_percent / 100)))
+        return self.product.discounted_price
 
 
 
@@ -579,34 +1028,21 @@ class OrderItem(models.Model):
         return self.product.price * self.quantity - int(self.get_total())
 
     def get_wallet_reward(self):
-        return (
-            (self.product.price * self.product.wallet_discount) / 100
-        ) * self.quantity
+        return self.product.wallet_reward * self.quantity
 
     def save(self, *args, **kwargs):
 
         if not self.sold_price:
             # محاسبه قیمت اولیه با تخفیف محصول
-            price = self._get_discounted_price()
-
             # اگر سفارش با زرین‌پال پرداخت شده باشد، تخفیف نقدی اعمال کن
+            discount_percent = 0
             if self.order.payment_reference == os.getenv(
                 "ZARIN_MERCHANT_NAME", "zarinpal"
             ):
-                print(f"Come from model save {self.order.payment_reference}")
-                try:
-                    cash_discount = CashDiscountPercent.objects.last()
-                    if cash_discount:
-                        discount_percent = (
-                            Decimal(cash_discount.zarinpal_discount_percent) / 100
-                        )
-                        price = price * (1 - discount_percent)
-                except CashDiscountPercent.DoesNotExist:
-                    print("#" * 50)
-                    print("Some error occured in OrderItem save method")
-                    print("#" * 50)
-
-            self.sold_price = round(price)
+                discount_percent = CashDiscountPercent.current()
+            self.sold_price = rounded_percent_off(
+                self._get_discounted_price(), discount_percent
+            )
 
         super().save(
             *args, **kwargs
@@ -681,6 +1117,60 @@ class OrderReceipt(Date):
         return "-"
 
 
+class OutboxMessage(models.Model):
+    """
+    A side effect (payment gateway request, SMS) written in the transaction that
+    causes it and run after commit by ``adora.outbox``, outside the request.
+    """
+
+    STATUS_PENDING = "P"
+    STATUS_SENT = "S"
+    STATUS_FAILED = "F"
+    STATUS_CHOICES = [
+        (STATUS_PENDING, _("در انتظار")),
+        (STATUS_SENT, _("انجام شده")),
+        (STATUS_FAILED, _("ناموفق")),
+    ]
+
+    topic = models.CharField(max_length=100, verbose_name=_("نوع"))
+    payload = models.JSONField(default=dict, verbose_name=_("داده"))
+    order = models.ForeignKey(
+        Order,
+        null=True,
+        blank=True,
+        on_delete=models.CASCADE,
+        related_name="outbox_messages",
+        verbose_name=_("سفارش"),
+    )
+    status = models.CharField(
+        max_length=1,
+        choices=STATUS_CHOICES,
+        default=STATUS_PENDING,
+        verbose_name=_("وضعیت"),
+    )
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name=_("تعداد تلاش"))
+    last_error = models.TextField(blank=True, default="", verbose_name=_("آخرین خطا"))
+    created_date = models.DateTimeField(auto_now_add=True, verbose_name="تاریخ ایجاد")
+    processed_date = models.DateTimeField(null=True, blank=True, verbose_name=_("تاریخ اجرا"))
+    claimed_until = models.DateTimeField(
+        null=True, blank=True, verbose_name=_("در حال اجرا تا")
+    )
+
+    class Meta:
+        verbose_name = _("پیام صف خروجی")
+        verbose_name_plural = _("📤 صف خروجی")
+        indexes = [
+            models.Index(
+                fields=["id"],
+                condition=Q(status="P"),
+                name="outbox_pending_idx",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.topic} #{self.id}"
+
+
 class OrderProvider(models.Model):
     name = models.CharField(max_length=100)
 
@@ -730,13 +1220,88 @@ class Comment(Date):
     )
     buy_suggest = models.BooleanField(default=False, verbose_name=_("پیشنهاد خرید"))
 
+    # Reviews are the rated top-level comments; replies do not count.
+    REVIEWS = Q(parent__isnull=True, rating__gte=1, rating__lte=5)
+    HIGHLIGHT_LENGTH = 300
+
+    # Materialized path of ids from the top-level comment of the thread, e.g. "/4/9/" for a reply.
+    path = models.CharField(
+        max_length=500, blank=True, editable=False, db_index=True
+    )
+    depth = models.PositiveSmallIntegerField(default=0, editable=False)
+
     class Meta:
         verbose_name = _("کامنت")
         verbose_name_plural = _("💬 نظرات")
+        indexes = [
+            models.Index(
+                fields=["product", "-id"],
+                condition=models.Q(parent__isnull=True),
+                name="comment_product_thread_idx",
+            ),
+        ]
 
     def __str__(self):
         return self.text[:20]
 
+    @property
+    def thread_id(self) -> int:
+        """Id of the top-level comment of the thread."""
+        return int(self.path.split("/")[1]) if self.path else self.id
+
+    def review_values(self) -> tuple:
+        """What this comment adds to ``(review_count, rating_sum, buy_suggest_count)`` of its product."""
+        if self.parent_id is None and 1 <= self.rating <= 5:
+            return 1, self.rating, int(self.buy_suggest)
+        return 0, 0, 0
+
+    def as_highlight(self) -> dict:
+        """Compact copy of the review stored on its product for the product cards."""
+        profile = getattr(self.user, "profile", None)
+        full_name = f"{profile.first_name} {profile.last_name}" if profile else None
+        return {
+            "id": self.id,
+            "text": self.text[: self.HIGHLIGHT_LENGTH],
+            "rating": self.rating,
+            "buy_suggest": self.buy_suggest,
+            "user_full_name": full_name,
+            "created_date": self.created_date.isoformat(),
+        }
+
+    def _parent_path(self) -> str:
+        if self.parent_id is None:
+            return "/"
+        return Comment.objects.values_list("path", flat=True).get(pk=self.parent_id)
+
+    def save(self, *args, **kwargs):
+        old_path = self.path
+        if self.pk and self.parent_id and f"/{self.pk}/" in self._parent_path():
+            raise ValidationError(_("کامنت نمی‌تواند پاسخ خودش باشد."))
+        super().save(*args, **kwargs)
+
+        new_path = f"{self._parent_path()}{self.pk}/"
+        if new_path == old_path:
+            return
+        new_depth = new_path.count("/") - 2
+        Comment.objects.filter(pk=self.pk).update(path=new_path, depth=new_depth)
+        if old_path:
+            # Moving a comment moves its replies.
+            Comment.objects.filter(path__startswith=old_path).exclude(pk=self.pk).update(
+                path=Concat(Value(new_path), Substr("path", len(old_path) + 1)),
+                depth=F("depth") + (new_depth - self.depth),
+            )
+        self.path, self.depth = new_path, new_depth
+
+    @classmethod
+    def rebuild_threads(cls) -> None:
+        """Recomputes ``path`` and ``depth`` of every comment from ``parent``."""
+        paths = _materialized_paths(dict(cls.objects.values_list("id", "parent_id")))
+        comments = list(cls.objects.only("id", "path", "depth"))
+        for comment in comments:
+            comment.path = paths[comment.id]
+            comment.depth = comment.path.count("/") - 2
+        cls.objects.bulk_update(comments, ["path", "depth"], batch_size=500)
+
     def get_replies(self):
         return self.replies.all()
 
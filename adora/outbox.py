@@ -0,0 +1,198 @@
+"""
+Transactional outbox for side effects of order changes.
+
+Payment gateway requests and SMS used to run inside the request, the gateway
+ones inside the order's ``transaction.atomic()``, holding its row locks for
+the whole HTTP round trip and firing even when the transaction rolled back.
+Instead, ``enqueue`` writes an ``OutboxMessage`` in the caller's transaction
+and, once it commits, the ``dispatch_outbox`` Celery task runs the handler of
+its topic.
+
+A worker claims a message in a short transaction (``SELECT ... FOR UPDATE
+SKIP LOCKED``), stamping ``claimed_until`` so no other worker takes it for
+``OUTBOX_CLAIM_SECONDS``. The handler runs after that commits, outside any
+transaction, and its outcome is saved in a second short transaction, only if
+the claim still holds. A handler that raises is retried by the periodic sweep
+until ``OUTBOX_MAX_ATTEMPTS``, unless the error says trying again is useless
+(``GatewayError.retryable``). A worker that dies mid-call leaves the claim to
+expire, and the message is run again. The client sees the order's payment
+request as pending meanwhile.
+"""
+
+import os
+import traceback
+from datetime import timedelta
+from typing import Callable, Dict, Iterable, Optional
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from adora.models import Order, OutboxMessage
+from adora.tasks import (
+    azkivam_send_create_ticket_request,
+    deliver_order_status_message,
+    dispatch_outbox,
+    record_zarin_connection_error,
+    send_snap_payment_information,
+    send_torobpay_payment_information,
+    send_zarin_payment_information,
+)
+
+PAYMENT_TOPIC_PREFIX = "payment."
+
+
+def _order_handler(send: Callable[[Order], None]) -> Callable[[dict], None]:
+    def handle(payload: dict) -> None:
+        send(Order.objects.select_related("user__profile").get(pk=payload["order_id"]))
+
+    return handle
+
+
+def _send_sms(payload: dict) -> None:
+    deliver_order_status_message(payload["phone_number"], payload["args"], payload["text_code"])
+
+
+HANDLERS: Dict[str, Callable[[dict], None]] = {
+    "payment.zarinpal": _order_handler(send_zarin_payment_information),
+    "payment.torobpay": _order_handler(send_torobpay_payment_information),
+    "payment.azkivam": _order_handler(azkivam_send_create_ticket_request),
+    "payment.snappay": _order_handler(send_snap_payment_information),
+    "sms.order_status": _send_sms,
+}
+
+# Run once a message of the topic has failed for good.
+ON_FAILURE: Dict[str, Callable[[dict], None]] = {
+    # The Zarinpal long-poll waits for a receipt.
+    "payment.zarinpal": _order_handler(record_zarin_connection_error),
+}
+
+
+def payment_topic(payment_reference: Optional[str]) -> Optional[str]:
+    """The outbox topic of the gateway request for ``payment_reference``, if it has one."""
+    if not payment_reference:
+        return None
+    return {
+        os.getenv("ZARIN_MERCHANT_NAME"): "payment.zarinpal",
+        os.getenv("TOROBPAY_MERCHANT_NAME"): "payment.torobpay",
+        os.getenv("AZKIVAM_MERHCHANT_NAME"): "payment.azkivam",
+        os.getenv("SNAPPAY_MERHCHANT_NAME"): "payment.snappay",
+    }.get(payment_reference)
+
+
+def enqueue(topic: str, payload: dict, order: Optional[Order] = None) -> OutboxMessage:
+    """Records a side effect in the current transaction; it runs after commit."""
+    if topic not in HANDLERS:
+        raise ValueError(f"Unknown outbox topic: {topic}")
+    message = OutboxMessage.objects.create(topic=topic, payload=payload, order=order)
+    transaction.on_commit(lambda: dispatch_outbox.delay([message.id]))
+    return message
+
+
+def enqueue_order_status_sms(phone_number: str, args: list, text_code: int, order=None):
+    return enqueue(
+        "sms.order_status",
+        {"phone_number": phone_number, "args": args, "text_code": text_code},
+        order=order,
+    )
+
+
+def _unclaimed(now) -> Q:
+    return Q(status=OutboxMessage.STATUS_PENDING) & (
+        Q(claimed_until__isnull=True) | Q(claimed_until__lt=now)
+    )
+
+
+def _claim(message_id: int) -> Optional[OutboxMessage]:
+    now = timezone.now()
+    with transaction.atomic():
+        message = (
+            OutboxMessage.objects.select_for_update(skip_locked=True)
+            .filter(_unclaimed(now), pk=message_id)
+            .first()
+        )
+        if message is None:
+            return None  # Done already, or being run by another worker.
+        message.attempts += 1
+        message.claimed_until = now + timedelta(seconds=settings.OUTBOX_CLAIM_SECONDS)
+        message.save(update_fields=["attempts", "claimed_until"])
+    return message
+
+
+def _record(message: OutboxMessage, error: Optional[Exception]) -> bool:
+    """Saves the outcome of a claimed message, unless its claim ran out and another worker took it."""
+    with transaction.atomic():
+        current = (
+            OutboxMessage.objects.select_for_update()
+            .filter(pk=message.pk, claimed_until=message.claimed_until)
+            .exists()
+        )
+        if not current:
+            return False
+        if error is None:
+            message.status = OutboxMessage.STATUS_SENT
+        else:
+            message.last_error = "".join(traceback.format_exception(error))
+            if (
+                not getattr(error, "retryable", True)
+                or message.attempts >= settings.OUTBOX_MAX_ATTEMPTS
+            ):
+                message.status = OutboxMessage.STATUS_FAILED
+        message.claimed_until = None
+        message.processed_date = timezone.now()
+        message.save(update_fields=["last_error", "status", "claimed_until", "processed_date"])
+    return True
+
+
+def dispatch(message_ids: Optional[Iterable[int]] = None) -> int:
+    """
+    Runs pending messages, the given ones or (for the sweep) up to
+    ``OUTBOX_BATCH_SIZE`` of the oldest. Returns how many were handled.
+    """
+    if message_ids is None:
+        message_ids = list(
+            OutboxMessage.objects.filter(_unclaimed(timezone.now()))
+            .order_by("id")
+            .values_list("id", flat=True)[: settings.OUTBOX_BATCH_SIZE]
+        )
+    handled = 0
+    for message_id in message_ids:
+        message = _claim(message_id)
+        if message is None:
+            continue
+        error = None
+        try:
+            HANDLERS[message.topic](message.payload)
+        except Exception as e:
+            error = e
+        if not _record(message, error):
+            continue
+        if message.status == OutboxMessage.STATUS_FAILED and message.topic in ON_FAILURE:
+            ON_FAILURE[message.topic](message.payload)
+        handled += 1
+    return handled
+
+
+STATUS_NAMES = {
+    OutboxMessage.STATUS_PENDING: "pending",
+    OutboxMessage.STATUS_SENT: "sent",
+    OutboxMessage.STATUS_FAILED: "failed",
+}
+
+
+def payment_request_statuses(order_ids: Iterable[int]) -> Dict[int, str]:
+    """
+    ``"pending"``, ``"sent"`` or ``"failed"`` for the latest gateway request of
+    each order, in one query. Orders without one are left out.
+    """
+    messages = (
+        OutboxMessage.objects.filter(order_id__in=order_ids, topic__startswith=PAYMENT_TOPIC_PREFIX)
+        .order_by("order_id", "id")
+        .values_list("order_id", "status")
+    )
+    return {order_id: STATUS_NAMES[status] for order_id, status in messages}
+
+
+def payment_request_status(order: Order) -> Optional[str]:
+    return payment_request_statuses([order.id]).get(order.id)
@@ -1,9 +1,144 @@
-from rest_framework.pagination import PageNumberPagination
+import base64
+import datetime
+import json
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
 class ProductPagination(PageNumberPagination):
     page_size = 20
     page_query_param = 'page'
-    
+
     # def get_paginated_response(self, data):
-    #     return Response(data)
\ No newline at end of file
+    #     return Response(data)
+
+
+class CursorEncoder(DjangoJSONEncoder):
+    """
+    Keeps datetimes to the microsecond. DjangoJSONEncoder rounds them to
+    milliseconds, and a cursor rounded down would skip the rows created later
+    in the same millisecond as the last row of the page.
+    """
+
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination over a composite sort key.
+
+    The queryset's ``order_by`` (or ``ordering``) is extended with the primary key
+    so the key is unique, and the cursor carries the key values of the last row
+    of the page. The next page is a ``WHERE (key) after (cursor)`` query served
+    by the matching composite index, so every page costs the same and no
+    ``COUNT(*)`` is run.
+    """
+
+    page_size = 20
+    cursor_query_param = "cursor"
+    ordering = ("-id",)
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.ordering = self.get_ordering(queryset)
+        queryset = queryset.order_by(*self.ordering)
+
+        cursor = self.decode_cursor(queryset.model, request)
+        if cursor is not None:
+            queryset = queryset.filter(self.after(cursor))
+
+        page = list(queryset[: self.page_size + 1])
+        self.has_next = len(page) > self.page_size
+        page = page[: self.page_size]
+        self.next_cursor = (
+            [self.field_value(page[-1], field) for field in self.ordering]
+            if self.has_next
+            else None
+        )
+        return page
+
+    def get_ordering(self, queryset):
+        ordering = list(queryset.query.order_by) or list(self.ordering)
+        pk_name = queryset.model._meta.pk.name
+        if not {pk_name, f"-{pk_name}", "pk", "-pk"} & set(ordering):
+            descending = ordering[-1].startswith("-")
+            ordering.append(f"-{pk_name}" if descending else pk_name)
+        return ordering
+
+    @staticmethod
+    def field_value(instance, field):
+        return getattr(instance, field.lstrip("-"))
+
+    def after(self, cursor):
+        """``(f1, f2, ...) > (v1, v2, ...)`` in the sort direction of each field."""
+        condition = Q()
+        for position, field in enumerate(self.ordering):
+            name = field.lstrip("-")
+            lookup = "lt" if field.startswith("-") else "gt"
+            term = Q(**{f"{name}__{lookup}": cursor[position]})
+            for previous, value in zip(self.ordering[:position], cursor):
+                term &= Q(**{previous.lstrip("-"): value})
+            condition |= term
+        return condition
+
+    def encode_cursor(self, values):
+        payload = json.dumps(values, cls=CursorEncoder, separators=(",", ":"))
+        return base64.urlsafe_b64encode(payload.encode()).decode()
+
+    def decode_cursor(self, model, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            values = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            if len(values) != len(self.ordering):
+                raise ValueError
+            return [
+                model._meta.get_field(field.lstrip("-")).to_python(value)
+                for field, value in zip(self.ordering, values)
+            ]
+        except Exception:
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return replace_query_param(
+            self.request.build_absolute_uri(),
+            self.cursor_query_param,
+            self.encode_cursor(self.next_cursor),
+        )
+
+    def get_paginated_response(self, data):
+        return Response(
+            OrderedDict([("next", self.get_next_link()), ("results", data)])
+        )
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "properties": {
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+                "results": schema,
+            },
+        }
+
+
+class ProductKeysetPagination(KeysetPagination):
+    page_size = 20
+    ordering = ("-count", "-id")
+
+
+class CommentKeysetPagination(KeysetPagination):
+    page_size = settings.PRODUCT_COMMENTS_PAGE_SIZE
+    ordering = ("-id",)
@@ -0,0 +1,227 @@
+"""
+Payment request status, long-polled.
+
+After checkout the client asks for the payment URL of its order, which only
+exists once the outbox has sent the gateway request: in the order's
+``OrderReceipt`` for Zarinpal (``orders/zarinpal-payment-request-info``), on
+the order itself for Torob Pay, SnappPay and Azkivam
+(``orders/payment-request-info``). The Zarinpal endpoint used to sleep in a
+loop on a sync worker waiting for it, so a few concurrent checkouts could
+take every worker.
+
+Both are async views. Saving a receipt, or finishing a gateway request in the
+outbox, publishes the order id on a Redis channel once the transaction
+commits, and the view waits on that channel for up to
+``PAYMENT_STATUS_WAIT_TIMEOUT`` seconds. While waiting it holds no worker
+thread and no database connection. Each database read runs in a thread and
+closes its connection. The result is checked again after subscribing and
+after the wait, so a missed message only costs the timeout. A 202 means the
+request is still being sent, and the client asks again.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from typing import Optional
+
+import redis.asyncio as aioredis
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection
+from django.http import HttpResponseNotAllowed, JsonResponse
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from adora.models import Order, OrderReceipt, OutboxMessage
+from adora.tasks import consider_walet_balance
+
+logger = logging.getLogger(__name__)
+
+
+def channel(order_id: int) -> str:
+    return f"adora:payment:{order_id}"
+
+
+def publish(order_id: int) -> None:
+    """Wakes up the requests waiting for the order's payment URL."""
+    try:
+        get_redis_connection("default").publish(channel(order_id), "payment")
+    except RedisError as e:
+        # They still see the result when their wait times out.
+        logger.warning("Payment status publish for order %s failed: %s", order_id, e)
+
+
+def _json(data: dict, status: int) -> JsonResponse:
+    return JsonResponse(data, status=status, json_dumps_params={"ensure_ascii": False})
+
+
+def _closing_connection(function):
+    """Runs ``function`` in a thread that gives its database connection back afterwards."""
+
+    def run(*args):
+        try:
+            return function(*args)
+        finally:
+            connection.close()
+
+    return sync_to_async(run)
+
+
+def _authenticated_user(request):
+    """The user of the request's credentials, or None."""
+    authenticators = [auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES]
+    try:
+        user = Request(request, authenticators=authenticators).user
+    except APIException:
+        return None
+    return user if user.is_authenticated else None
+
+
+@_closing_connection
+def _find_order(request, tracking_number: str):
+    """``(response, order id)``: an error response, or the user's order to wait for."""
+    user = _authenticated_user(request)
+    if user is None:
+        return _json({"detail": "Authentication credentials were not provided."}, 401), None
+    # Another user's order is answered like a missing one.
+    order_id = (
+        Order.objects.filter(tracking_number=tracking_number, user=user)
+        .values_list("id", flat=True)
+        .first()
+    )
+    if order_id is None:
+        return (
+            _json(
+                {"message": f"There is no Order with this tracking number {tracking_number}."},
+                404,
+            ),
+            None,
+        )
+    return None, order_id
+
+
+@_closing_connection
+def _receipt_response(order_id: int) -> Optional[JsonResponse]:
+    """The payment URL, or the gateway's error, once the receipt exists."""
+    receipt = OrderReceipt.objects.select_related("order").filter(order_id=order_id).first()
+    if receipt is None:
+        return None
+    if receipt.request_code == 100:
+        return _json(
+            {
+                "payment_url": f"{os.environ.get('ZARIN_START_PAY_URL')}/{receipt.authority}",
+                "message": receipt.request_msg,
+                "fee": receipt.fee,
+                "amount": consider_walet_balance(receipt.order, "TOMAN"),
+            },
+            200,
+        )
+    return _json({"message": receipt.error_msg, "code": receipt.request_code}, 402)
+
+
+# Outbox topic: the order's payment page URL and token fields, and the receipt's error field.
+INSTALLMENT_PAGES = {
+    "payment.torobpay": ("torob_payment_page_url", "torob_payment_token", "torob_error_message"),
+    "payment.snappay": ("snap_payment_page_url", "snap_payment_token", "snap_error_message"),
+    "payment.azkivam": (
+        "azkivam_payment_page_url",
+        "azkivam_payment_token",
+        "azkivam_error_message",
+    ),
+}
+
+
+@_closing_connection
+def _installment_response(order_id: int) -> Optional[JsonResponse]:
+    """The payment page, or the gateway's error, once the outbox has sent the request."""
+    request = (
+        OutboxMessage.objects.filter(order_id=order_id, topic__in=INSTALLMENT_PAGES)
+        .order_by("-id")
+        .values_list("topic", "status")
+        .first()
+    )
+    if request is None:
+        return _json({"message": "This order has no installment payment request."}, 404)
+    topic, status = request
+    if status == OutboxMessage.STATUS_PENDING:
+        return None
+    url_field, token_field, error_field = INSTALLMENT_PAGES[topic]
+    if status == OutboxMessage.STATUS_SENT:
+        payment_url, payment_token = (
+            Order.objects.filter(pk=order_id).values_list(url_field, token_field).get()
+        )
+        return _json({"payment_url": payment_url, "payment_token": payment_token}, 200)
+    error = (
+        OrderReceipt.objects.filter(order_id=order_id).values_list(error_field, flat=True).first()
+    )
+    return _json({"message": error or "Payment request failed, please try again later!"}, 402)
+
+
+async def _wait(order_id: int, check, timeout: float) -> Optional[JsonResponse]:
+    client = aioredis.from_url(settings.PAYMENT_EVENTS_REDIS_URL)
+    pubsub = client.pubsub()
+    try:
+        await pubsub.subscribe(channel(order_id))
+        # Subscribed before looking, so a result saved meanwhile is not missed.
+        response = await check(order_id)
+        deadline = time.monotonic() + timeout
+        while response is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return await check(order_id)
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=remaining)
+            if message is not None:
+                response = await check(order_id)
+        return response
+    finally:
+        await pubsub.aclose()
+        await client.aclose()
+
+
+async def _long_poll(request, check, pending_message: str):
+    """Answers with ``check(order_id)``, waiting for it while it is ``None``."""
+    if request.method != "GET":
+        return HttpResponseNotAllowed(["GET"])
+    tracking_number = request.GET.get("tracking_number")
+    if not tracking_number:
+        return _json({"message": "Tracking number is missing."}, 400)
+
+    response, order_id = await _find_order(request, tracking_number)
+    if response is not None:
+        return response
+
+    response = await check(order_id)
+    if response is None:
+        try:
+            response = await _wait(order_id, check, settings.PAYMENT_STATUS_WAIT_TIMEOUT)
+        except (RedisError, OSError, asyncio.TimeoutError) as e:
+            logger.warning("Payment status wait for order %s failed: %s", order_id, e)
+            response = await check(order_id)
+    if response is None:
+        return _json({"message": pending_message}, 202)
+    return response
+
+
+async def zarinpal_payment_status(request):
+    return await _long_poll(
+        request,
+        _receipt_response,
+        "Order receipt not created after multiple attempts, please try again later!",
+    )
+
+
+async def installment_payment_status(request):
+    """
+    ``payment_url`` and ``payment_token`` of a Torob Pay, SnappPay or Azkivam
+    order (200), the gateway's error (402), or 202 while the request is still
+    being sent; ask again then.
+    """
+    return await _long_poll(
+        request,
+        _installment_response,
+        "Payment request is still being sent, please try again.",
+    )
@@ -0,0 +1,132 @@
+"""
+Prices a cart for checkout in one pass.
+
+All cart products are loaded with one ``in_bulk`` query and the cash discount
+row is read at most once. Sold prices, totals, delivery, reward and wallet
+use are then computed in memory with integer arithmetic (Toman, the total
+and the reward in fractions of a Toman where a percent leaves one), so
+``OrderSerializer.create`` writes the order once and its items with one
+``bulk_create``.
+"""
+
+import os
+from dataclasses import dataclass
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from adora.models import CashDiscountPercent, Order, OrderItem, Product
+from core.utils.money import hundredths, rounded_percent_off
+
+
+class UnknownProducts(ValueError):
+    def __init__(self, product_ids):
+        super().__init__(product_ids)
+        self.product_ids = sorted(product_ids)
+
+
+def is_cash_purchase(payment_reference: Optional[str]) -> bool:
+    """Zarinpal payments are cash purchases, which get ``CashDiscountPercent``."""
+    return payment_reference == os.getenv("ZARIN_MERCHANT_NAME", "zarinpal")
+
+
+@dataclass
+class CartLine:
+    product: Product
+    quantity: int
+    sold_price: int
+
+    @property
+    def total(self) -> int:
+        """Line total at the product's discounted price."""
+        return self.product.discounted_price * self.quantity
+
+    @property
+    def wallet_reward(self) -> int:
+        """Line reward in ten-thousandths of a Toman, exact: ``wallet_discount`` has two decimals."""
+        return self.product.price * hundredths(self.product.wallet_discount) * self.quantity
+
+
+@dataclass
+class CartPrice:
+    lines: List[CartLine]
+    total_price: Decimal
+    order_reward: Decimal
+    amount_used_wallet_balance: Decimal
+
+    def order_fields(self) -> dict:
+        return {
+            "total_price": self.total_price,
+            "order_reward": self.order_reward,
+            "amount_used_wallet_balance": self.amount_used_wallet_balance,
+        }
+
+    def order_items(self, order: Order) -> List[OrderItem]:
+        return [
+            OrderItem(
+                order=order,
+                product=line.product,
+                quantity=line.quantity,
+                sold_price=line.sold_price,
+            )
+            for line in self.lines
+        ]
+
+
+def load_products(product_ids: Iterable[int]) -> Dict[int, Product]:
+    """The cart's products by id, in one query. Raises ``UnknownProducts`` for ids with no product."""
+    product_ids = set(product_ids)
+    products = Product.objects.in_bulk(product_ids)
+    missing = product_ids - set(products)
+    if missing:
+        raise UnknownProducts(missing)
+    return products
+
+
+def price_cart(
+    items: Iterable[Tuple[Product, int]],
+    payment_reference: Optional[str],
+    delivery_cost,
+    wallet_balance: Optional[Decimal] = None,
+) -> CartPrice:
+    """
+    Prices ``items``, ``(product, quantity)`` pairs in cart order. Cash
+    purchases get the cash discount on every item and on the total, and earn
+    the products' wallet reward. ``wallet_balance``, when given, is all used
+    and taken off the total, as the order's ``use_wallet_balance`` promises.
+    """
+    cash_purchase = is_cash_purchase(payment_reference)
+    discount_percent = CashDiscountPercent.current() if cash_purchase else 0
+
+    lines = [
+        CartLine(
+            product=product,
+            quantity=quantity,
+            sold_price=rounded_percent_off(product.discounted_price, discount_percent),
+        )
+        for product, quantity in items
+    ]
+    subtotal = sum(line.total for line in lines)
+    # Hundredths of a Toman: the cash discount of the total is exact to two decimals.
+    total_hundredths = subtotal * (100 - discount_percent) + int(delivery_cost) * 100
+    total_price = Decimal(total_hundredths) / 100
+
+    # Credited to the wallet, which keeps two decimals: the exact reward rounded
+    # half to even, as the DecimalField rounded it when it was stored as is.
+    order_reward = Decimal(0)
+    if cash_purchase:
+        order_reward = (Decimal(sum(line.wallet_reward for line in lines)) / 10000).quantize(
+            Decimal("0.01")
+        )
+
+    amount_used_wallet_balance = Decimal(0)
+    if wallet_balance is not None:
+        amount_used_wallet_balance = wallet_balance
+        total_price -= wallet_balance
+
+    return CartPrice(
+        lines=lines,
+        total_price=total_price,
+        order_reward=order_reward,
+        amount_used_wallet_balance=amount_used_wallet_balance,
+    )
+
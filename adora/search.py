@@ -0,0 +1,178 @@
+"""
+Product search backed by an inverted n-gram index.
+
+Each product is turned into a set of normalized terms (whole words plus padded
+character trigrams) taken from its Persian and English names, its brand name and the
+names of its compatible cars. The terms are stored as postings in
+``ProductSearchToken`` so a query only reads the postings of its own terms,
+keeps a small shortlist of the best candidates and reranks that shortlist with
+``fuzz.WRatio``.
+"""
+
+import re
+from typing import Iterable, List, Set
+
+from django.db import transaction
+from django.db.models import Count, Q
+from fuzzywuzzy import fuzz
+
+from adora.models import Product, ProductSearchToken
+from core.utils.normalize_text import normalize_text, normalized_variants
+
+NGRAM_SIZE = 3
+MAX_TOKEN_LENGTH = 64
+SHORTLIST_SIZE = 100
+MIN_SCORE = 50
+INDEX_BATCH_SIZE = 500
+
+_NON_WORD = re.compile(r"[\W_]+", re.UNICODE)
+
+
+def normalize(text: str) -> str:
+    return " ".join(_NON_WORD.split(normalize_text(text))).strip()
+
+
+def extract_terms(text: str) -> Set[str]:
+    """Returns the words and padded character trigrams of ``text``."""
+    terms = set()
+    for word in normalize(text).split():
+        terms.add(word[:MAX_TOKEN_LENGTH])
+        padded = f" {word} "
+        for start in range(len(padded) - NGRAM_SIZE + 1):
+            terms.add(padded[start : start + NGRAM_SIZE])
+    return terms
+
+
+def product_document(product: Product) -> str:
+    """Text indexed for a product. Expects ``brand`` and ``compatible_cars`` to be loaded."""
+    parts = [product.fa_name, product.en_name]
+    if product.brand_id:
+        parts.append(product.brand.name)
+    parts.extend(car.fa_name for car in product.compatible_cars.all())
+    return " ".join(part for part in parts if part)
+
+
+def _indexable_products():
+    return Product.objects.select_related("brand").prefetch_related("compatible_cars")
+
+
+def index_products(product_ids: Iterable[int]) -> None:
+    """Brings the postings of the given products in line with their current data."""
+    product_ids = list(set(product_ids))
+    for offset in range(0, len(product_ids), INDEX_BATCH_SIZE):
+        batch = product_ids[offset : offset + INDEX_BATCH_SIZE]
+        products = _indexable_products().filter(id__in=batch)
+        wanted = {product.id: extract_terms(product_document(product)) for product in products}
+
+        existing = {}
+        for product_id, token in ProductSearchToken.objects.filter(
+            product_id__in=batch
+        ).values_list("product_id", "token"):
+            existing.setdefault(product_id, set()).add(token)
+
+        with transaction.atomic():
+            # Products that were deleted in the meantime lose all their postings.
+            ProductSearchToken.objects.filter(product_id__in=batch).exclude(
+                product_id__in=wanted.keys()
+            ).delete()
+
+            new_postings = []
+            for product_id, terms in wanted.items():
+                current = existing.get(product_id, set())
+                stale = current - terms
+                if stale:
+                    ProductSearchToken.objects.filter(
+                        product_id=product_id, token__in=stale
+                    ).delete()
+                new_postings.extend(
+                    ProductSearchToken(product_id=product_id, token=token)
+                    for token in terms - current
+                )
+            ProductSearchToken.objects.bulk_create(
+                new_postings, batch_size=INDEX_BATCH_SIZE, ignore_conflicts=True
+            )
+
+
+def rebuild_index() -> None:
+    """Drops every posting and indexes the whole catalog again."""
+    with transaction.atomic():
+        ProductSearchToken.objects.all().delete()
+        postings = []
+        for product in _indexable_products().iterator(chunk_size=INDEX_BATCH_SIZE):
+            postings.extend(
+                ProductSearchToken(product_id=product.id, token=token)
+                for token in extract_terms(product_document(product))
+            )
+            if len(postings) >= INDEX_BATCH_SIZE * 20:
+                ProductSearchToken.objects.bulk_create(postings, batch_size=INDEX_BATCH_SIZE)
+                postings = []
+        ProductSearchToken.objects.bulk_create(postings, batch_size=INDEX_BATCH_SIZE)
+
+
+def _prefix_matches(variants: List[str], limit: int) -> Set[int]:
+    condition = Q()
+    for variant in variants:
+        condition |= Q(normalized_fa_name__startswith=variant)
+        condition |= Q(normalized_en_name__startswith=variant)
+    return set(Product.objects.filter(condition).values_list("id", flat=True)[:limit])
+
+
+def _term_matches(variant: str, limit: int) -> dict:
+    """Maps product id -> percentage of the variant's terms found in its postings."""
+    terms = extract_terms(variant)
+    if not terms:
+        return {}
+    candidates = (
+        ProductSearchToken.objects.filter(token__in=terms)
+        .values("product_id")
+        .annotate(hits=Count("id"))
+        .order_by("-hits", "product_id")[:limit]
+    )
+    return {row["product_id"]: row["hits"] * 100 // len(terms) for row in candidates}
+
+
+def search_products(query: str, limit: int = SHORTLIST_SIZE) -> List[Product]:
+    """
+    Returns the products matching ``query`` best first.
+
+    The query is normalized (and also read as Persian typed on the Latin layout).
+    Names starting with it are exact hits; otherwise only the postings of the
+    query terms are read, and the ``limit`` products with the best term coverage
+    are reranked with ``fuzz.WRatio`` against their normalized names.
+    """
+    variants = normalized_variants(query)
+    if not variants:
+        return []
+
+    prefixed = _prefix_matches(variants, limit)
+    coverage = {}
+    for variant in variants:
+        for product_id, percent in _term_matches(variant, limit).items():
+            coverage[product_id] = max(coverage.get(product_id, 0), percent)
+    if not prefixed and not coverage:
+        return []
+
+    products = (
+        Product.objects.filter(id__in=prefixed | coverage.keys())
+        .only("id", "fa_name", "normalized_fa_name", "normalized_en_name")
+    )
+
+    scored = []
+    for product in products:
+        if product.id in prefixed:
+            score = 100
+        else:
+            score = max(
+                coverage.get(product.id, 0),
+                *(fuzz.WRatio(variant, product.normalized_fa_name) for variant in variants),
+                *(
+                    fuzz.WRatio(variant, product.normalized_en_name)
+                    for variant in variants
+                    if product.normalized_en_name
+                ),
+            )
+        if score >= MIN_SCORE:
+            scored.append((score, coverage.get(product.id, 0), product))
+
+    scored.sort(key=lambda item: (item[0], item[1]), reverse=True)
+    return [product for _, _, product in scored]
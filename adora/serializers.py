@@ -1,13 +1,21 @@
 import os
 from ast import Dict
-from decimal import Decimal
 from typing import Any, List, LiteralString
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist
 from django.db import IntegrityError, transaction
+from django.db.models import Manager, Prefetch, prefetch_related_objects
 from phonenumber_field.serializerfields import PhoneNumberField
 from rest_framework.exceptions import ValidationError
+from rest_framework.reverse import reverse
 
+from adora import outbox
+from adora.caching import product_fragment_keys
+from adora.loaders import get_loaders
+from adora.paginations import CommentKeysetPagination
 from adora.models import (
     FAQ,
     Brand,
@@ -24,23 +32,251 @@ from adora.models import (
     Product,
     ProductImage,
 )
-from adora.tasks import (
-    azkivam_send_create_ticket_request,
-    send_snap_payment_information,
-    send_torobpay_payment_information,
-    send_zarin_payment_information,
-)
+from adora.pricing import UnknownProducts, load_products, price_cart
 from rest_framework import serializers
 
 
-class CarSerializer(serializers.ModelSerializer):
+class BatchLoadListSerializer(serializers.ListSerializer):
+    """``many=True`` serializer that queues the loader keys of all items before serializing any."""
+
+    def to_representation(self, data):
+        items = list(data.all() if isinstance(data, Manager) else data)
+        self.child.prime_loaders(items)
+        return super().to_representation(items)
+
+
+class BatchLoadMixin:
+    """
+    Method fields read relations through the request's batch loaders (see
+    adora.loaders). ``loaders`` maps a loader name to the instance attribute
+    holding its key, or to ``relation__attribute`` for the keys of the items
+    of a prefetched to-many relation.
+    """
+
+    loaders = {}
+
+    def prime_loaders(self, instances) -> None:
+        registry = get_loaders(self.context)
+        for name, attribute in self.loaders.items():
+            relation, _, attribute = attribute.rpartition("__")
+            if relation:
+                # "relation__attribute": the keys of the items of a prefetched to-many relation.
+                keys = (
+                    getattr(item, attribute)
+                    for instance in instances
+                    if relation in getattr(instance, "_prefetched_objects_cache", {})
+                    for item in getattr(instance, relation).all()
+                )
+            else:
+                # A column left out by ?fields= is not read by any selected field.
+                keys = (
+                    getattr(instance, attribute)
+                    for instance in instances
+                    if attribute not in instance.get_deferred_fields()
+                )
+            registry[name].prime(keys)
+
+    def load(self, name: str, key):
+        return get_loaders(self.context)[name].load(key)
+
+
+class ProductFragmentListSerializer(serializers.ListSerializer):
+    """
+    ``many=True`` serializer for product cards: every card is read from Redis in
+    one ``get_many`` round trip and only the missing ones are prefetched and
+    serialized, then stored for the next request.
+    """
+
+    def to_representation(self, data):
+        products = list(data.all() if isinstance(data, Manager) else data)
+        return self.child.to_representations(products)
+
+
+def _field_tree(value: str) -> dict:
+    """``"id,images.image_url"`` -> ``{"id": {}, "images": {"image_url": {}}}``."""
+    tree = {}
+    for path in value.split(","):
+        node = tree
+        for name in path.strip().split("."):
+            if name:
+                node = node.setdefault(name, {})
+    return tree
+
+
+class DynamicFieldsMixin:
+    """
+    Sparse fieldsets. ``?fields=id,fa_name,images.image_url`` keeps only the
+    listed fields, dotted names selecting the fields of nested serializers. A
+    nested serializer listed without subfields is rendered as its primary
+    key(s) unless it is also named in ``?expand=``. Without ``fields`` the
+    output is unchanged.
+
+    ``sparse_queryset`` trims a queryset to the columns and relations of the
+    selected fields. ``Meta.field_sources`` names the model paths read by
+    method fields; by default a method field reads the model field of its name.
+    """
+
+    def sparse_selection(self):
+        """``(fields, expand)`` trees of this serializer, or None when every field is wanted."""
+        if not hasattr(self, "_sparse_selection"):
+            self._sparse_selection = self._resolve_sparse_selection()
+        return self._sparse_selection
+
+    def _resolve_sparse_selection(self):
+        node = self.parent if isinstance(self.parent, serializers.ListSerializer) else self
+        owner = node.parent
+        if owner is None:
+            request = self.context.get("request")
+            fields = request.query_params.get("fields") if request is not None else None
+            if not fields:
+                return None
+            return _field_tree(fields), _field_tree(request.query_params.get("expand", ""))
+        selection = owner.sparse_selection() if isinstance(owner, DynamicFieldsMixin) else None
+        if selection is None or not selection[0].get(node.field_name):
+            return None
+        fields, expand = selection
+        return fields[node.field_name], expand.get(node.field_name, {})
+
+    def get_fields(self):
+        fields = super().get_fields()
+        selection = self.sparse_selection()
+        if selection is None:
+            return fields
+        wanted, expand = selection
+        selected = {}
+        for name, field in fields.items():
+            if name not in wanted:
+                continue
+            many = isinstance(field, serializers.ListSerializer)
+            nested = field.child if many else field
+            if isinstance(nested, serializers.BaseSerializer) and not wanted[name] and name not in expand:
+                # Not expanded: only the related primary key(s).
+                field = serializers.PrimaryKeyRelatedField(read_only=True, many=many, source=field.source)
+            selected[name] = field
+        return selected
+
+    def sparse_lookups(self, model) -> tuple:
+        """``(columns, prefetch paths)`` read by the selected fields of ``model`` instances."""
+        field_sources = getattr(self.Meta, "field_sources", {})
+        columns, prefetch = {model._meta.pk.name}, []
+        for name, field in self.fields.items():
+            if field.source == "*":
+                paths = field_sources.get(name, (name,))
+            else:
+                paths = (field.source.replace(".", "__"),)
+            for path in paths:
+                head = path.split("__")[0]
+                try:
+                    model_field = model._meta.get_field(head)
+                except FieldDoesNotExist:
+                    continue
+                if model_field.concrete and not model_field.many_to_many:
+                    columns.add(head)
+                if (
+                    not model_field.is_relation
+                    or head != model_field.name  # the foreign key column itself
+                    or isinstance(field, serializers.PrimaryKeyRelatedField)
+                ):
+                    continue
+                nested = field.child if isinstance(field, serializers.ListSerializer) else field
+                if path == head and isinstance(nested, DynamicFieldsMixin):
+                    prefetch.append(Prefetch(path, queryset=nested.sparse_related(model_field)))
+                else:
+                    prefetch.append(path)
+        return columns, prefetch
+
+    def sparse_related(self, relation):
+        """Queryset prefetched through ``relation`` for the objects this serializer renders."""
+        model = relation.related_model
+        columns, prefetch = self.sparse_lookups(model)
+        queryset = model._default_manager.prefetch_related(*prefetch)
+        if self.sparse_selection() is None:
+            return queryset
+        if relation.one_to_many:
+            columns.add(relation.field.name)  # The prefetched rows are matched on it.
+        return queryset.only(*columns)
+
+    def sparse_queryset(self, queryset, columns=()):
+        """``queryset`` limited to what the selected fields read; unchanged when not sparse."""
+        if self.sparse_selection() is None:
+            return queryset
+        only, prefetch = self.sparse_lookups(queryset.model)
+        return (
+            queryset.select_related(None)
+            .prefetch_related(None)
+            .only(*only, *columns)
+            .prefetch_related(*prefetch)
+        )
+
+
+class ProductFragmentMixin(DynamicFieldsMixin, BatchLoadMixin):
+    """
+    Caches the representation of each product under ``fragment_name``. The
+    cards are invalidated per product by the signals in adora.signals.
+    ``fragment_prefetch`` lists the relations loaded for cache misses only.
+    Sparse (``?fields=``) cards are not cached. With ``card_loader``, a single
+    card is read through that batch loader, so nested cards of a whole
+    response are fetched together.
+    """
+
+    fragment_name = None
+    fragment_prefetch = ()
+    card_loader = None
+
+    def cards(self, product_ids) -> dict:
+        """Cards of ``product_ids`` by id: the cached ones, the others built and cached."""
+        keys = product_fragment_keys(self.fragment_name, product_ids)
+        cached = cache.get_many(list(keys.values()))
+        cards = {product_id: cached[key] for product_id, key in keys.items() if key in cached}
+        missing = [product_id for product_id in keys if product_id not in cards]
+        if missing:
+            # Rows read after the generations: a card built from rows changed
+            # meanwhile is stored under a generation that is already replaced.
+            products = list(
+                self.Meta.model.objects.filter(pk__in=missing).prefetch_related(
+                    *self.fragment_prefetch
+                )
+            )
+            self.prime_loaders(products)
+            fresh = {}
+            for product in products:
+                fresh[product.pk] = super().to_representation(product)
+            cache.set_many(
+                {keys[product_id]: card for product_id, card in fresh.items()},
+                timeout=settings.PRODUCT_FRAGMENT_CACHE_TTL,
+            )
+            cards.update(fresh)
+        return cards
+
+    def to_representations(self, products: list) -> list:
+        if self.sparse_selection() is not None:
+            self.prime_loaders(products)
+            cards = []
+            for product in products:
+                cards.append(super().to_representation(product))
+            return cards
+        cards = self.cards([product.pk for product in products])
+        return [
+            cards[product.pk] if product.pk in cards else super().to_representation(product)
+            for product in products
+        ]
+
+    def to_representation(self, instance):
+        if self.card_loader and self.sparse_selection() is None:
+            card = self.load(self.card_loader, instance.pk)
+            if card is not None:
+                return card
+        return self.to_representations([instance])[0]
+
+
+class CarSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Car
         exclude = ("created_date", "updated_date")
 
 
 # class CategorySeriali
-class ProductImageSerializer(serializers.ModelSerializer):
+class ProductImageSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = ProductImage
         # fields = ('id', 'alt', 'image_url', 'product')
@@ -67,7 +303,30 @@ class CategoryWhitChildrenSerializer(serializers.ModelSerializer):
         return CategoryWhitChildrenSerializer(children, many=True).data
 
 
-class CategorySerializer(serializers.ModelSerializer):
+def serialize_category_tree() -> list:
+    """
+    Whole category tree in the shape of ``CategoryWhitChildrenSerializer``,
+    built in memory from a single query.
+    """
+    categories = list(
+        Category.objects.order_by("id").values("id", "name", "image", "alt", "parent_id")
+    )
+    names = {category["id"]: category["name"] for category in categories}
+    nodes, roots = {}, []
+    for category in categories:
+        parent_id = category.pop("parent_id")
+        category["parent"] = names.get(parent_id)
+        category["children"] = []
+        nodes[category["id"]] = (category, parent_id)
+    for category, parent_id in nodes.values():
+        if parent_id is None:
+            roots.append(category)
+        elif parent_id in nodes:
+            nodes[parent_id][0]["children"].append(category)
+    return roots
+
+
+class CategorySerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     parent = serializers.SerializerMethodField()
 
     class Meta:
@@ -88,18 +347,22 @@ class CategorySerializer(serializers.ModelSerializer):
         return None
 
 
-class SimilarProductsSerializer(serializers.ModelSerializer):
+class SimilarProductsSerializer(ProductFragmentMixin, serializers.ModelSerializer):
+    fragment_name = "similar"
+    fragment_prefetch = ("brand", "compatible_cars", "images")
+
     # category = serializers.SerializerMethodField(read_only=True)
     # material = serializers.SerializerMethodField(read_only=True)
     compatible_cars = serializers.SerializerMethodField(read_only=True)
-    discounted_price = serializers.SerializerMethodField(read_only=True)
-    discounted_wallet = serializers.SerializerMethodField(read_only=True)
+    discounted_price = serializers.IntegerField(read_only=True)
+    discounted_wallet = serializers.IntegerField(source="wallet_reward", read_only=True)
     brand = serializers.SerializerMethodField(read_only=True)
     images = ProductImageSerializer(many=True, read_only=True)
     wallet_discount_percent = serializers.CharField(source="wallet_discount")
 
     class Meta:
         model = Product
+        list_serializer_class = ProductFragmentListSerializer
         fields = [
             "id",
             "fa_name",
@@ -151,11 +414,6 @@ class SimilarProductsSerializer(serializers.ModelSerializer):
             for car in obj.compatible_cars.all()
         ]
 
-    def get_discounted_price(self, obj):
-        return obj.price - ((obj.price * obj.price_discount_percent) / 100)
-
-    def get_discounted_wallet(self, obj):
-        return (obj.price * obj.wallet_discount) / 100
 
 
 class MaterialSerializer(serializers.ModelSerializer):
@@ -166,14 +424,15 @@ class MaterialSerializer(serializers.ModelSerializer):
         fields = ["id", "name"]
 
 
-class BrandSerializer(serializers.ModelSerializer):
+class BrandSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Brand
         # fields = '__all__'
         exclude = ["created_date", "updated_date", "alt"]
 
 
-class CommentSerializer(serializers.ModelSerializer):
+class CommentSerializer(BatchLoadMixin, serializers.ModelSerializer):
+    loaders = {"users": "user_id", "comment_threads": "thread_id"}
     replies = serializers.SerializerMethodField()
     user = serializers.SerializerMethodField(
         read_only=True
@@ -181,6 +440,7 @@ class CommentSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Comment
+        list_serializer_class = BatchLoadListSerializer
         fields = (
             "id",
             "user",
@@ -195,8 +455,10 @@ class CommentSerializer(serializers.ModelSerializer):
         )
 
     def get_replies(self, obj):
-        replies = obj.replies.all()  # Fetch all replies to the current comment
-        return CommentSerializer(replies, many=True).data  # Serialize each reply
+        if obj.depth >= settings.COMMENT_REPLY_MAX_DEPTH:
+            return []
+        thread = self.load("comment_threads", obj.thread_id)  # Replies of the whole thread, capped
+        return CommentSerializer(thread.get(obj.id, []), many=True, context=self.context).data
 
     def validate_rating(self, value):
         if value < 1 or value > 5:
@@ -206,10 +468,10 @@ class CommentSerializer(serializers.ModelSerializer):
     def get_user(self, obj):
         # profile = getattr(obj.user,'profile', None)
         # if profile and profile.first_name:
-
+        user = self.load("users", obj.user_id)
         return {
-            "full_name": f"{obj.user.profile.first_name} {obj.user.profile.last_name}",
-            "id": obj.user.id,
+            "full_name": f"{user.profile.first_name} {user.profile.last_name}",
+            "id": user.id,
         }
 
 
@@ -219,11 +481,14 @@ class FAQSerializer(serializers.ModelSerializer):
         fields = ["id", "question", "answer"]
 
 
-class ProductSearchSerializer(serializers.ModelSerializer):
+class ProductSearchSerializer(ProductFragmentMixin, serializers.ModelSerializer):
+    fragment_name = "search"
+    fragment_prefetch = ("images",)
     images = ProductImageSerializer(many=True, read_only=True)
 
     class Meta:
         model = Product
+        list_serializer_class = ProductFragmentListSerializer
         fields = (
             "id",
             "fa_name",
@@ -250,10 +515,13 @@ class SnapOrderUpdateSerilizer(serializers.Serializer):
         return value
 
 
-class ProductOrderItemSerializer(serializers.ModelSerializer):
+class ProductOrderItemSerializer(ProductFragmentMixin, serializers.ModelSerializer):
+    fragment_name = "order_item"
+    card_loader = "order_item_cards"
+    fragment_prefetch = ("compatible_cars", "images")
     images = ProductImageSerializer(many=True, read_only=True)
-    discounted_price = serializers.SerializerMethodField(read_only=True)
-    discounted_wallet = serializers.SerializerMethodField(read_only=True)
+    discounted_price = serializers.IntegerField(read_only=True)
+    discounted_wallet = serializers.IntegerField(source="wallet_reward", read_only=True)
     wallet_discount_percent = serializers.CharField(source="wallet_discount")
     # main_category = CategorySerializer(read_only=True, source='category')
     compatible_cars = serializers.SerializerMethodField(read_only=True)
@@ -261,6 +529,7 @@ class ProductOrderItemSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Product
+        list_serializer_class = ProductFragmentListSerializer
         fields = (
             "id",
             "custom_id",
@@ -280,11 +549,6 @@ class ProductOrderItemSerializer(serializers.ModelSerializer):
             "images",
         )
 
-    def get_discounted_price(self, obj):
-        return obj.price - ((obj.price * obj.price_discount_percent) / 100)
-
-    def get_discounted_wallet(self, obj):
-        return (obj.price * obj.wallet_discount) / 100
 
     def get_compatible_cars(self, obj):
         return [
@@ -298,17 +562,19 @@ class ProductOrderItemSerializer(serializers.ModelSerializer):
         ]
 
 
-class ProductRetrieveSerializer(serializers.ModelSerializer):
+class ProductRetrieveSerializer(DynamicFieldsMixin, BatchLoadMixin, serializers.ModelSerializer):
+    loaders = {"product_comments": "id"}
     faqs = serializers.SerializerMethodField()
 
     # main_category = serializers.CharField(source='category.fa_name', read_only=True)
     # comments = CommentSerializer(read_only=True, many=True)
     comments = serializers.SerializerMethodField()
+    comments_next = serializers.SerializerMethodField()
     main_category = CategorySerializer(read_only=True, source="category")
     compatible_cars = serializers.SerializerMethodField(read_only=True)
     # image = serializers.SerializerMethodField(read_only=True)
-    discounted_price = serializers.SerializerMethodField(read_only=True)
-    discounted_wallet = serializers.SerializerMethodField(read_only=True)
+    discounted_price = serializers.IntegerField(read_only=True)
+    discounted_wallet = serializers.IntegerField(source="wallet_reward", read_only=True)
     # brand= serializers.SerializerMethodField(read_only=True)
     brand = BrandSerializer(read_only=True)
     similar_products = SimilarProductsSerializer(many=True)
@@ -318,6 +584,7 @@ class ProductRetrieveSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Product
+        field_sources = {"comments": (), "comments_next": (), "category_hierarchy": ("category",)}
         fields = [
             "id",
             "custom_id",
@@ -346,15 +613,29 @@ class ProductRetrieveSerializer(serializers.ModelSerializer):
             "shopping_description",
             "buyer",
             "customer_point",
+            "review_count",
+            "rating_avg",
+            "buy_suggest_count",
             "comments",
+            "comments_next",
             "category",
             "faqs",
             "category_hierarchy",
         ]
 
     def get_comments(self, obj):
-        comments = obj.comments.filter(parent__isnull=True)
-        return CommentSerializer(comments, many=True).data
+        comments = self.load("product_comments", obj.id)[: settings.PRODUCT_COMMENTS_PAGE_SIZE]
+        return CommentSerializer(comments, many=True, context=self.context).data
+
+    def get_comments_next(self, obj):
+        """Link to the next page of comments on ``comments?product=<id>``, if any."""
+        comments = self.load("product_comments", obj.id)
+        if len(comments) <= settings.PRODUCT_COMMENTS_PAGE_SIZE:
+            return None
+        last = comments[settings.PRODUCT_COMMENTS_PAGE_SIZE - 1]
+        url = f"{reverse('comments-list')}?product={obj.id}&cursor={CommentKeysetPagination().encode_cursor([last.id])}"
+        request = self.context.get("request")
+        return request.build_absolute_uri(url) if request is not None else url
 
     def get_category(self, obj):
         return {
@@ -378,11 +659,6 @@ class ProductRetrieveSerializer(serializers.ModelSerializer):
             for car in obj.compatible_cars.all()
         ]
 
-    def get_discounted_price(self, obj):
-        return obj.price - ((obj.price * obj.price_discount_percent) / 100)
-
-    def get_discounted_wallet(self, obj):
-        return (obj.price * obj.wallet_discount) / 100
 
     # def get_similar_products(self, obj):
     #     return ProductSerializer(obj.similar_products.all(), many=True).data
@@ -405,13 +681,15 @@ class ProductRetrieveSerializer(serializers.ModelSerializer):
         return obj.category.get_hierarchy()
 
 
-class ProductListSerializer(serializers.ModelSerializer):
+class ProductListSerializer(ProductFragmentMixin, serializers.ModelSerializer):
+    fragment_name = "list"
+    fragment_prefetch = ("category__parent", "brand", "compatible_cars", "images")
     main_category = CategorySerializer(read_only=True, source="category")
     compatible_cars = serializers.SerializerMethodField(read_only=True)
     # image = serializers.SerializerMethodField(read_only=True)
-    discounted_price = serializers.SerializerMethodField(read_only=True)
-    discounted_wallet = serializers.SerializerMethodField(read_only=True)
-    comments = serializers.SerializerMethodField()
+    discounted_price = serializers.IntegerField(read_only=True)
+    discounted_wallet = serializers.IntegerField(source="wallet_reward", read_only=True)
+    review_summary = serializers.SerializerMethodField()
     # brand= serializers.SerializerMethodField(read_only=True)
     brand = BrandSerializer(read_only=True)
     images = ProductImageSerializer(many=True, read_only=True)
@@ -419,6 +697,10 @@ class ProductListSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Product
+        list_serializer_class = ProductFragmentListSerializer
+        field_sources = {
+            "review_summary": ("review_count", "rating_avg", "buy_suggest_count", "review_highlight")
+        }
         fields = [
             "id",
             "custom_id",
@@ -446,15 +728,20 @@ class ProductListSerializer(serializers.ModelSerializer):
             "shopping_description",
             "buyer",
             "customer_point",
-            "comments",
+            "review_summary",
         ]
 
     # def get_brand(self, obj):
     #     return {'id': obj.brand.id, 'name': obj.brand.name, 'image_url': obj.brand.image, 'alt': obj.brand.alt}
 
-    def get_comments(self, obj):
-        comments = obj.comments.filter(parent__isnull=True)
-        return CommentSerializer(comments, many=True).data
+    def get_review_summary(self, obj):
+        # Stored on the product; full comments are on the detail page and comments?product=<id>.
+        return {
+            "count": obj.review_count,
+            "rating_avg": round(obj.rating_avg, 1),
+            "buy_suggest_count": obj.buy_suggest_count,
+            "highlight": obj.review_highlight,
+        }
 
     def get_category(self, obj):
         return {
@@ -478,11 +765,6 @@ class ProductListSerializer(serializers.ModelSerializer):
             for car in obj.compatible_cars.all()
         ]
 
-    def get_discounted_price(self, obj):
-        return obj.price - ((obj.price * obj.price_discount_percent) / 100)
-
-    def get_discounted_wallet(self, obj):
-        return (obj.price * obj.wallet_discount) / 100
 
     # def validate(self, data):
     #     product = data.get('product')
@@ -491,7 +773,33 @@ class ProductListSerializer(serializers.ModelSerializer):
     #     return datam
 
 
+class ProductChangeSerializer(serializers.ModelSerializer):
+    """Compact product of products/changes; relations are ids."""
+
+    class Meta:
+        model = Product
+        fields = [
+            "id",
+            "custom_id",
+            "fa_name",
+            "en_name",
+            "price",
+            "price_discount_percent",
+            "discounted_price",
+            "count",
+            "category",
+            "brand",
+            "compatible_cars",
+            "review_count",
+            "rating_avg",
+            "updated_date",
+        ]
+
+
 class OrderItemSerializer(serializers.ModelSerializer):
+    # A plain id: the cart's products are loaded together by adora.pricing.
+    product = serializers.IntegerField(source="product_id")
+
     class Meta:
         model = OrderItem
         fields = ("id", "product", "quantity", "sold_price")
@@ -508,10 +816,11 @@ class OrderSerializer(serializers.ModelSerializer):
     order_reward = serializers.DecimalField(
         max_digits=10, decimal_places=2, default=0, read_only=True
     )
-    tracking_number = serializers.CharField(max_length=20, read_only=True)
+    tracking_number = serializers.CharField(max_length=32, read_only=True)
     payment_status = serializers.CharField(read_only=True)
     delivery_status = serializers.CharField(read_only=True)
     user = serializers.PrimaryKeyRelatedField(read_only=True)
+    payment_request_status = serializers.SerializerMethodField()
 
     class Meta:
         model = Order
@@ -519,6 +828,7 @@ class OrderSerializer(serializers.ModelSerializer):
             "id",
             "tracking_number",
             "payment_status",
+            "payment_request_status",
             "payment_method",
             "payment_reference",
             "delivery_status",
@@ -550,113 +860,40 @@ class OrderSerializer(serializers.ModelSerializer):
             "azkivam_payment_page_url",
         )
 
-    def calculate_total_price_for_cahs_purchase(self, order: Order):
-        """This method calculates the total price for cash purchase orders.
-        It applies the cash_discount_percent to the total price of the order items
-        and adds the delivery cost.
-
-
-        Args:
-            order (Order)
-        """
-        cash_discount_percent = CashDiscountPercent.objects.last()
-
-        total = sum([item.get_total() for item in order.order_items.all()])
-        if cash_discount_percent:
-            print(
-                "zarinpal_discount_percent",
-                cash_discount_percent.zarinpal_discount_percent,
-            )
-            total -= (total * cash_discount_percent.zarinpal_discount_percent) / 100
-        else:
-            print("Cash Discoutn Percent not found (message from order serizlier)")
-
-        order.total_price = total + int(order.delivery_cost)
-        order.save()
+    def validate_order_items(self, order_items):
+        try:
+            self.cart_products = load_products(item["product_id"] for item in order_items)
+        except UnknownProducts as e:
+            raise ValidationError(f"Invalid product ids: {e.product_ids}")
+        return order_items
 
-    def calculate_total_price_for_Installment_purchase(self, order: Order):
-        """This mehtod calculates the total price for installment purchase orders.
+    def create(self, validated_data):
+        order_items_data: List[dict[str, Any]] = validated_data.pop("order_items")
 
-        Args:
-            order (Order)
-        """
-        total = sum([item.get_total() for item in order.order_items.all()])
-        order.total_price = total + int(order.delivery_cost)
-        order.save()
-
-    def calculate_order_reward(self, order):
-        """_summary_
-        This reward calculated by each order item and saved in user
-        wallet
-        """
-        total_reward = sum(
-            [item.get_wallet_reward() for item in order.order_items.all()]
+        wallet_balance = None
+        if validated_data.get("use_wallet_balance"):
+            wallet_balance = validated_data["user"].profile.wallet_balance
+        cart = price_cart(
+            [
+                (self.cart_products[item["product_id"]], item["quantity"])
+                for item in order_items_data
+            ],
+            validated_data.get("payment_reference"),
+            validated_data.get("delivery_cost", 0),
+            wallet_balance,
         )
-        order.order_reward = total_reward
-        order.save()
-
-    def _get_wallet_balance(self, order) -> Decimal:
-        return order.user.profile.wallet_balance
 
-    def use_user_walet_balance_in_order(self, order):
-        """This method use mines wallet balance from total price"""
-        wallet_balance = self._get_wallet_balance(order)
-
-        order.amount_used_wallet_balance = wallet_balance
-        order.total_price -= wallet_balance
-        order.save()
-
-    def create(self, validated_data):
-        order_items_data: List[dict[str, Any]] = validated_data.pop("order_items")
-        # print("order_items_data", order_items_data)
-        # print('sold_pric', order_items_data[0]['sold_price'])
-        request = self.context.get("request")
-        # if not request:
-        #     torob_access_token = "There is no Torob Access Token"
-        # torob_access_token = request.query_params.get("torob_access_token")
+        payment_topic = outbox.payment_topic(validated_data.get("payment_reference"))
 
         try:
             # Wrap everything in a transaction to ensure atomicity
             with transaction.atomic():
-                # Create the order
-                order = Order.objects.create(**validated_data)
-                # Create the order items in bulk
-
-                for item_data in order_items_data:
-                    order_item = OrderItem(
-                        order=order,
-                        product=item_data["product"],
-                        quantity=item_data["quantity"],
-                    )
-                    order_item.save()  # ذخیره‌سازی به‌صورت معمولی، که متد save فراخوانی می‌شود
-
-                if order.payment_reference == os.getenv("ZARIN_MERCHANT_NAME"):
-                    # Calculate total price for cash purchase
-                    self.calculate_total_price_for_cahs_purchase(order)
-                    # Save order reward to user's wallet
-                    self.calculate_order_reward(order)
-                    send_zarin_payment_information(order)
-                    print("hello_zarin")
-
-                if order.payment_reference == os.getenv("TOROBPAY_MERCHANT_NAME"):
-                    self.calculate_total_price_for_Installment_purchase(order)
-                    print("helllo_torob")
-                    send_torobpay_payment_information(order)
-
-                if order.payment_reference == os.getenv("AZKIVAM_MERHCHANT_NAME"):
-                    self.calculate_total_price_for_Installment_purchase(order)
-                    print("hello_azkivam")
-                    azkivam_send_create_ticket_request(order)
-
-                if order.payment_reference == os.getenv("SNAPPAY_MERHCHANT_NAME"):
-                    self.calculate_total_price_for_Installment_purchase(order)
-                    print("hello_snappay")
-                    send_snap_payment_information(order)
-
-                # Use wallet_balance
-                if order.use_wallet_balance:
-                    print(" order.use_wallet_balance", order.use_wallet_balance)
-                    self.use_user_walet_balance_in_order(order)
+                order = Order.objects.create(**validated_data, **cart.order_fields())
+                OrderItem.objects.bulk_create(cart.order_items(order))
+
+                # The gateway is called by dispatch_outbox once this commits.
+                if payment_topic is not None:
+                    outbox.enqueue(payment_topic, {"order_id": order.id}, order=order)
 
             return order
 
@@ -668,6 +905,9 @@ class OrderSerializer(serializers.ModelSerializer):
             # Catch any other exceptions and return an appropriate error message
             raise ValidationError({"detail": f"An error occurred: {str(e)}"})
 
+    def get_payment_request_status(self, obj):
+        return outbox.payment_request_status(obj)
+
     def get_user(self, obj):
         return {
             "id": obj.user.id,
@@ -676,7 +916,7 @@ class OrderSerializer(serializers.ModelSerializer):
         }
 
 
-class OrderListItemSerializer(serializers.ModelSerializer):
+class OrderListItemSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     product = ProductOrderItemSerializer()
 
     class Meta:
@@ -684,16 +924,25 @@ class OrderListItemSerializer(serializers.ModelSerializer):
         fields = ("id", "product", "quantity")
 
 
-class OrderListSerializer(serializers.ModelSerializer):
+class OrderListSerializer(DynamicFieldsMixin, BatchLoadMixin, serializers.ModelSerializer):
+    loaders = {
+        "users": "user_id",
+        "payment_requests": "id",
+        "order_item_cards": "order_items__product_id",
+    }
     order_items = OrderListItemSerializer(many=True)
     user = serializers.SerializerMethodField()
+    payment_request_status = serializers.SerializerMethodField()
 
     class Meta:
         model = Order
+        list_serializer_class = BatchLoadListSerializer
+        field_sources = {"user": ("user_id",), "payment_request_status": ("id",)}
         fields = (
             "id",
             "tracking_number",
             "payment_status",
+            "payment_request_status",
             "payment_method",
             "payment_reference",
             "delivery_status",
@@ -719,12 +968,21 @@ class OrderListSerializer(serializers.ModelSerializer):
         )
 
     def get_user(self, obj):
+        user = self.load("users", obj.user_id)
         return {
-            "id": obj.user.id,
-            "phone_number": str(obj.user.phone_number),
-            "full_name": f"{obj.user.profile.first_name} {obj.user.profile.last_name}",
+            "id": user.id,
+            "phone_number": str(user.phone_number),
+            "full_name": f"{user.profile.first_name} {user.profile.last_name}",
         }
 
+    def to_representation(self, instance):
+        # A single order (retrieve) queues its own keys; in a list they are queued already.
+        self.prime_loaders([instance])
+        return super().to_representation(instance)
+
+    def get_payment_request_status(self, obj):
+        return self.load("payment_requests", obj.id)
+
 
 class AuthorSerilizer(serializers.ModelSerializer):
     full_name = serializers.SerializerMethodField(read_only=True)
@@ -739,10 +997,12 @@ class AuthorSerilizer(serializers.ModelSerializer):
         return f"{obj.profile.first_name} {obj.profile.last_name}"
 
 
-class ProductBlogSerializer(serializers.ModelSerializer):
+class ProductBlogSerializer(ProductFragmentMixin, serializers.ModelSerializer):
+    fragment_name = "blog"
+    fragment_prefetch = ("compatible_cars", "images")
     images = ProductImageSerializer(many=True, read_only=True)
-    discounted_price = serializers.SerializerMethodField(read_only=True)
-    discounted_wallet = serializers.SerializerMethodField(read_only=True)
+    discounted_price = serializers.IntegerField(read_only=True)
+    discounted_wallet = serializers.IntegerField(source="wallet_reward", read_only=True)
     wallet_discount_percent = serializers.CharField(source="wallet_discount")
     # main_category = CategorySerializer(read_only=True, source='category')
     compatible_cars = serializers.SerializerMethodField(read_only=True)
@@ -750,6 +1010,7 @@ class ProductBlogSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Product
+        list_serializer_class = ProductFragmentListSerializer
         fields = (
             "id",
             "fa_name",
@@ -764,11 +1025,6 @@ class ProductBlogSerializer(serializers.ModelSerializer):
             "images",
         )
 
-    def get_discounted_price(self, obj):
-        return obj.price - ((obj.price * obj.price_discount_percent) / 100)
-
-    def get_discounted_wallet(self, obj):
-        return (obj.price * obj.wallet_discount) / 100
 
     def get_compatible_cars(self, obj):
         return [
@@ -818,82 +1074,6 @@ class CollaborateAndContactUsSerializer(serializers.ModelSerializer):
         fields = "__all__"
 
 
-class ProductTorobSerilizers(serializers.ModelSerializer):
-    product_id = serializers.IntegerField(source="pk", read_only=True)
-    page_url = serializers.SerializerMethodField(read_only=True)
-    price = serializers.SerializerMethodField(read_only=True)
-    old_price = serializers.IntegerField(source="price", read_only=True)
-    availability = serializers.SerializerMethodField(read_only=True)
-
-    class Meta:
-        model = Product
-        fields = ["product_id", "page_url", "old_price", "availability", "price"]
-
-    def get_page_url(self, obj: Product) -> str:
-        product_title = obj.fa_name.strip().replace(" ", "-")
-        return f"https://adorayadak.ir/product/adp-{obj.id}/{product_title}"
-
-    def get_price(self, obj: Product) -> int:
-        discount_percent = int(obj.price_discount_percent)
-        price = obj.price
-
-        return int(price * (1 - discount_percent / 100))
-
-    def get_availability(self, obj: Product) -> str:
-        count = obj.count
-        if count > 0:
-            return "instock"
-        return "outofstock"
-
-
-class ProductEmallsSerilizers(serializers.ModelSerializer):
-    title = serializers.CharField(source="fa_name", read_only=True)
-    url = serializers.SerializerMethodField(read_only=True)
-    price = serializers.SerializerMethodField(read_only=True)
-    old_price = serializers.IntegerField(source="price", read_only=True)
-    is_available = serializers.SerializerMethodField(read_only=True)
-    category = serializers.SerializerMethodField(read_only=True)
-    image = serializers.SerializerMethodField(read_only=True)
-
-    class Meta:
-        model = Product
-        fields = [
-            "id",
-            "title",
-            "url",
-            "old_price",
-            "is_available",
-            "price",
-            "category",
-            "image",
-        ]
-
-    def get_url(self, obj: Product) -> str:
-        product_title = obj.fa_name.strip().replace(" ", "-")
-        return f"https://adorayadak.ir/product/adp-{obj.id}/{product_title}"
-
-    def get_price(self, obj: Product) -> int:
-        discount_percent = int(obj.price_discount_percent)
-        price = obj.price
-
-        return int(price * (1 - discount_percent / 100))
-
-    def get_is_available(self, obj: Product) -> bool:
-        count = obj.count
-        if count > 0:
-            return True
-        return False
-
-    def get_category(self, obj: Product) -> str:
-        return obj.category.name
-
-    def get_image(self, obj: Product) -> str | None:
-        all_images = obj.images.all()
-        if not all_images:
-            return None
-        return str(all_images[0].image_url)
-
-
 class OrderRejectedReasonSerializer(serializers.ModelSerializer):
 
     class Meta:
@@ -0,0 +1,354 @@
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import (
+    m2m_changed,
+    post_delete,
+    post_migrate,
+    post_save,
+    pre_delete,
+    pre_save,
+)
+from django.dispatch import receiver
+
+from adora import feeds, payment_status
+from adora.caching import (
+    CATALOG,
+    CATEGORY_TREE,
+    PRICE_FEEDS,
+    PRODUCT_PAGES,
+    bump_version,
+    invalidate_product_fragments,
+)
+from adora.models import (
+    FAQ,
+    Brand,
+    Car,
+    CatalogTombstone,
+    Category,
+    Comment,
+    OrderReceipt,
+    OutboxMessage,
+    Product,
+    ProductImage,
+    ProductSearchToken,
+)
+from adora.tasks import (
+    rebuild_product_search_index,
+    update_product_search_index,
+    update_suggestions,
+)
+from core.utils.normalize_text import normalize_text
+
+
+def _reindex_products(product_ids):
+    product_ids = list(product_ids)
+    if product_ids:
+        transaction.on_commit(lambda: update_product_search_index.delay(product_ids))
+
+
+@receiver(post_save, sender=Product)
+def reindex_saved_product(sender, instance, **kwargs):
+    _reindex_products([instance.id])
+
+
+@receiver(m2m_changed, sender=Product.compatible_cars.through)
+def reindex_product_cars(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if not reverse:
+        _reindex_products([instance.id])
+    elif action == "post_clear":
+        # pk_set is not provided on clear, the car's former products are unknown here.
+        transaction.on_commit(rebuild_product_search_index.delay)
+    else:
+        _reindex_products(pk_set)
+
+
+@receiver(post_save, sender=Brand)
+def reindex_brand_products(sender, instance, created, **kwargs):
+    if not created:
+        _reindex_products(instance.products.values_list("id", flat=True))
+
+
+@receiver(post_save, sender=Car)
+def reindex_car_products(sender, instance, created, **kwargs):
+    if not created:
+        _reindex_products(instance.products.values_list("id", flat=True))
+
+
+@receiver(pre_delete, sender=Brand)
+@receiver(pre_delete, sender=Car)
+def reindex_products_of_deleted(sender, instance, **kwargs):
+    # Evaluated now, the relation rows are gone once the delete has run.
+    _reindex_products(instance.products.values_list("id", flat=True))
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_category_tree(sender, **kwargs):
+    transaction.on_commit(lambda: bump_version(CATEGORY_TREE))
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(m2m_changed, sender=Product.compatible_cars.through)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Brand)
+@receiver(post_delete, sender=Brand)
+@receiver(post_save, sender=Car)
+@receiver(post_delete, sender=Car)
+def invalidate_catalog(sender, **kwargs):
+    transaction.on_commit(lambda: bump_version(CATALOG))
+    transaction.on_commit(lambda: bump_version(PRODUCT_PAGES))
+    _invalidate_price_feeds()
+
+
+@receiver(post_save, sender=OrderReceipt)
+def publish_order_receipt(sender, instance, **kwargs):
+    order_id = instance.order_id
+    transaction.on_commit(lambda: payment_status.publish(order_id))
+
+
+@receiver(post_save, sender=OutboxMessage)
+def publish_payment_request(sender, instance, **kwargs):
+    if (
+        instance.order_id is not None
+        and instance.topic in payment_status.INSTALLMENT_PAGES
+        and instance.status != OutboxMessage.STATUS_PENDING
+    ):
+        order_id = instance.order_id
+        transaction.on_commit(lambda: payment_status.publish(order_id))
+
+
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+def invalidate_price_feed_images(sender, **kwargs):
+    _invalidate_price_feeds()
+
+
+def _invalidate_price_feeds():
+    transaction.on_commit(lambda: bump_version(PRICE_FEEDS))
+    transaction.on_commit(feeds.schedule_build)
+
+
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+@receiver(post_save, sender=FAQ)
+@receiver(post_delete, sender=FAQ)
+@receiver(m2m_changed, sender=Product.similar_products.through)
+@receiver(m2m_changed, sender=Product.faqs.through)
+def invalidate_product_pages(sender, **kwargs):
+    transaction.on_commit(lambda: bump_version(PRODUCT_PAGES))
+
+
+def _drop_product_cards(product_ids):
+    product_ids = list(product_ids)
+    if product_ids:
+        transaction.on_commit(lambda: invalidate_product_fragments(product_ids))
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def drop_product_card(sender, instance, **kwargs):
+    _drop_product_cards([instance.id])
+
+
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def drop_cards_of_related_product(sender, instance, **kwargs):
+    _drop_product_cards([instance.product_id])
+
+
+@receiver(m2m_changed, sender=Product.compatible_cars.through)
+def drop_cards_of_car_products(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse and action.startswith("post_"):
+        _drop_product_cards([instance.id])
+    elif reverse and action in ("post_add", "post_remove"):
+        _drop_product_cards(pk_set)
+    elif reverse and action == "pre_clear":
+        _drop_product_cards(instance.products.values_list("id", flat=True))
+
+
+@receiver(post_save, sender=Brand)
+@receiver(pre_delete, sender=Brand)
+@receiver(post_save, sender=Car)
+@receiver(pre_delete, sender=Car)
+def drop_cards_of_products(sender, instance, **kwargs):
+    _drop_product_cards(instance.products.values_list("id", flat=True))
+
+
+@receiver(post_save, sender=Category)
+def drop_cards_of_category_products(sender, instance, created, **kwargs):
+    # Cards show the category and its parent's name.
+    if not created:
+        _drop_product_cards(
+            Product.objects.filter(
+                Q(category=instance) | Q(category__parent=instance)
+            ).values_list("id", flat=True)
+        )
+
+
+@receiver(post_delete, sender=Product)
+def record_deleted_product(sender, instance, **kwargs):
+    CatalogTombstone.record([instance.id], CatalogTombstone.REASON_DELETED)
+
+
+def _record_relations_changed(product_ids):
+    product_ids = list(product_ids)
+    if product_ids:
+        CatalogTombstone.record(product_ids, CatalogTombstone.REASON_RELATIONS)
+
+
+@receiver(m2m_changed, sender=Product.compatible_cars.through)
+@receiver(m2m_changed, sender=Product.similar_products.through)
+@receiver(m2m_changed, sender=Product.faqs.through)
+def record_product_relations(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse and action in ("post_add", "post_remove", "post_clear"):
+        _record_relations_changed([instance.id])
+    elif reverse and action in ("post_add", "post_remove"):
+        _record_relations_changed(pk_set)
+    elif reverse and action == "pre_clear":
+        field = next(
+            field for field in Product._meta.many_to_many if field.remote_field.through is sender
+        )
+        _record_relations_changed(
+            sender.objects.filter(**{field.m2m_reverse_field_name(): instance}).values_list(
+                f"{field.m2m_field_name()}_id", flat=True
+            )
+        )
+
+
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+def record_product_images(sender, instance, **kwargs):
+    _record_relations_changed([instance.product_id])
+
+
+@receiver(pre_delete, sender=Brand)
+@receiver(pre_delete, sender=Car)
+def record_products_of_deleted(sender, instance, **kwargs):
+    # Products lose the brand with a bulk UPDATE and the car with its relation rows,
+    # neither touches updated_date.
+    _record_relations_changed(instance.products.values_list("id", flat=True))
+
+
+def _count_reviews(product_id, values, sign=1):
+    if any(values):
+        Product.objects.filter(pk=product_id).apply_review_delta(
+            *(sign * value for value in values)
+        )
+        transaction.on_commit(lambda: bump_version(CATALOG))
+
+
+@receiver(pre_save, sender=Comment)
+def remember_review_values(sender, instance, raw=False, **kwargs):
+    instance._review_before = None
+    if instance.pk and not raw:
+        instance._review_before = (
+            Comment.objects.filter(pk=instance.pk)
+            .only("product", "parent", "rating", "buy_suggest")
+            .first()
+        )
+
+
+@receiver(post_save, sender=Comment)
+def update_review_aggregates(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    reviewed_products = set()
+    before = getattr(instance, "_review_before", None)
+    if before is not None:
+        _count_reviews(before.product_id, before.review_values(), sign=-1)
+        if any(before.review_values()):
+            reviewed_products.add(before.product_id)
+    _count_reviews(instance.product_id, instance.review_values())
+    if any(instance.review_values()):
+        reviewed_products.add(instance.product_id)
+    if reviewed_products:
+        Product.objects.filter(pk__in=reviewed_products).refresh_review_highlights()
+
+
+@receiver(post_delete, sender=Comment)
+def remove_review_from_aggregates(sender, instance, **kwargs):
+    _count_reviews(instance.product_id, instance.review_values(), sign=-1)
+    if any(instance.review_values()):
+        Product.objects.filter(pk=instance.product_id).refresh_review_highlights()
+
+
+SUGGESTION_KINDS = {Product: "products", Brand: "brands", Category: "categories", Car: "cars"}
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=Brand)
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=Car)
+@receiver(post_delete, sender=Product)
+@receiver(post_delete, sender=Brand)
+@receiver(post_delete, sender=Category)
+@receiver(post_delete, sender=Car)
+def refresh_suggestions(sender, instance, **kwargs):
+    kind, object_id = SUGGESTION_KINDS[sender], instance.id
+    transaction.on_commit(lambda: update_suggestions.delay(kind, [object_id]))
+
+
+@receiver(post_migrate)
+def backfill_category_paths(sender, **kwargs):
+    if sender.name != "adora":
+        return
+    if Category.objects.filter(path="").exists():
+        Category.rebuild_tree()
+
+
+@receiver(post_migrate)
+def backfill_comment_threads(sender, **kwargs):
+    if sender.name != "adora":
+        return
+    if Comment.objects.filter(path="").exists():
+        Comment.rebuild_threads()
+
+
+@receiver(post_migrate)
+def backfill_review_aggregates(sender, **kwargs):
+    if sender.name != "adora":
+        return
+    Product.objects.refresh_reviews()
+
+
+@receiver(post_migrate)
+def backfill_product_prices(sender, **kwargs):
+    if sender.name != "adora":
+        return
+    Product.objects.filter(discounted_price=0, price__gt=0).refresh_prices()
+
+
+@receiver(post_migrate)
+def backfill_normalized_names(sender, **kwargs):
+    if sender.name != "adora":
+        return
+    for model, fields in (
+        (Product, {"fa_name": "normalized_fa_name", "en_name": "normalized_en_name"}),
+        (Brand, {"name": "normalized_name"}),
+        (Car, {"fa_name": "normalized_fa_name"}),
+    ):
+        pending = []
+        missing = Q()
+        for source, normalized in fields.items():
+            missing |= Q(**{normalized: ""}) & ~Q(**{source: ""})
+        for instance in model.objects.filter(missing).only("id", *fields.keys()):
+            for source, normalized in fields.items():
+                setattr(instance, normalized, normalize_text(getattr(instance, source)))
+            pending.append(instance)
+        model.objects.bulk_update(pending, list(fields.values()), batch_size=500)
+
+
+@receiver(post_migrate)
+def build_product_search_index(sender, **kwargs):
+    if sender.name != "adora":
+        return
+    if Product.objects.exists() and not ProductSearchToken.objects.exists():
+        rebuild_product_search_index()
@@ -0,0 +1,155 @@
+"""
+Prefix index behind the ``products/suggest`` typeahead.
+
+Every product, brand, category and car name is stored in Redis as sorted set
+members of the form ``<normalized name from a word start>\\x00<id>`` (all with
+score 0), one sorted set per kind. ``ZRANGEBYLEX`` then returns the names
+starting with a prefix, or having a word starting with it, in O(log n + k).
+The display names live in a hash per kind, which is also what lets a save
+remove the members of the previous name. Being in Redis, the index is shared
+by all gunicorn workers.
+"""
+
+from typing import Dict, Iterable, List, Optional
+
+from django_redis import get_redis_connection
+
+from adora.models import Brand, Car, Category, Product
+from core.utils.normalize_text import normalize_text
+
+KEY_PREFIX = "adora:suggest"
+BUILT_KEY = f"{KEY_PREFIX}:built"
+LOCK_KEY = f"{KEY_PREFIX}:lock"
+SEPARATOR = "\x00"
+MAX_LIMIT = 20
+
+SOURCES = {
+    "products": (Product, "fa_name"),
+    "brands": (Brand, "name"),
+    "categories": (Category, "name"),
+    "cars": (Car, "fa_name"),
+}
+
+
+def _index_key(kind: str) -> str:
+    return f"{KEY_PREFIX}:{kind}:index"
+
+
+def _names_key(kind: str) -> str:
+    return f"{KEY_PREFIX}:{kind}:names"
+
+
+def _members(object_id: int, name: str) -> List[str]:
+    """One member per word start of the normalized name."""
+    words = normalize_text(name).split(" ")
+    return list(
+        {
+            f"{' '.join(words[position:])}{SEPARATOR}{object_id}"
+            for position in range(len(words))
+            if words[position]
+        }
+    )
+
+
+def _connection():
+    return get_redis_connection("default")
+
+
+def rebuild() -> None:
+    """Builds every index under temporary keys and swaps them in atomically."""
+    connection = _connection()
+    pipe = connection.pipeline(transaction=True)
+    for kind, (model, field) in SOURCES.items():
+        index_key, names_key = _index_key(kind), _names_key(kind)
+        pipe.delete(f"{index_key}:tmp", f"{names_key}:tmp")
+        names = dict(model.objects.values_list("id", field))
+        entries = {}
+        for object_id, name in names.items():
+            entries.update(dict.fromkeys(_members(object_id, name), 0))
+        if entries:
+            pipe.zadd(f"{index_key}:tmp", entries)
+            pipe.hset(f"{names_key}:tmp", mapping=names)
+            pipe.rename(f"{index_key}:tmp", index_key)
+            pipe.rename(f"{names_key}:tmp", names_key)
+        else:
+            pipe.delete(index_key, names_key)
+    pipe.set(BUILT_KEY, 1)
+    pipe.execute()
+
+
+def ensure_built() -> None:
+    connection = _connection()
+    if connection.exists(BUILT_KEY):
+        return
+    with connection.lock(LOCK_KEY, timeout=120, blocking_timeout=60):
+        if not connection.exists(BUILT_KEY):
+            rebuild()
+
+
+def update(kind: str, object_ids: Iterable[int]) -> None:
+    """Replaces the entries of the given objects with their current names (or drops them)."""
+    model, field = SOURCES[kind]
+    object_ids = [int(object_id) for object_id in object_ids]
+    if not object_ids:
+        return
+    connection = _connection()
+    index_key, names_key = _index_key(kind), _names_key(kind)
+
+    previous = connection.hmget(names_key, object_ids)
+    current = dict(model.objects.filter(id__in=object_ids).values_list("id", field))
+
+    pipe = connection.pipeline(transaction=True)
+    for object_id, old_name in zip(object_ids, previous):
+        new_name = current.get(object_id)
+        old_name = old_name.decode() if old_name is not None else None
+        if old_name == new_name:
+            continue
+        if old_name is not None:
+            pipe.zrem(index_key, *_members(object_id, old_name))
+        if new_name is None:
+            pipe.hdel(names_key, object_id)
+        else:
+            pipe.zadd(index_key, dict.fromkeys(_members(object_id, new_name), 0))
+            pipe.hset(names_key, object_id, new_name)
+    pipe.execute()
+
+
+def suggest(prefix: str, limit: int = 5) -> Optional[Dict[str, List[dict]]]:
+    """Returns up to ``limit`` ``{"id", "name"}`` entries per kind, or None for an empty prefix."""
+    prefix = normalize_text(prefix)
+    if not prefix:
+        return None
+    limit = max(1, min(limit, MAX_LIMIT))
+    ensure_built()
+
+    connection = _connection()
+    low = b"[" + prefix.encode()
+    high = low + b"\xff"
+    pipe = connection.pipeline(transaction=False)
+    for kind in SOURCES:
+        # A multi-word name can match at several word starts, fetch some spare members.
+        pipe.zrangebylex(_index_key(kind), low, high, start=0, num=limit * 3)
+    matches = pipe.execute()
+
+    ids_by_kind = {}
+    for kind, members in zip(SOURCES, matches):
+        ids = []
+        for member in members:
+            object_id = int(member.rsplit(SEPARATOR.encode(), 1)[1])
+            if object_id not in ids:
+                ids.append(object_id)
+        ids_by_kind[kind] = ids[:limit]
+
+    pipe = connection.pipeline(transaction=False)
+    for kind, ids in ids_by_kind.items():
+        pipe.hmget(_names_key(kind), ids or [0])
+    names = pipe.execute()
+
+    return {
+        kind: [
+            {"id": object_id, "name": name.decode()}
+            for object_id, name in zip(ids, kind_names)
+            if name is not None
+        ]
+        for (kind, ids), kind_names in zip(ids_by_kind.items(), names)
+    }
@@ -1,17 +1,31 @@
 import json
 import os
 import time
+from datetime import timedelta
 from typing import Callable, Dict, List, Literal, Optional
 
 import traceback
 import requests
 from celery import shared_task
+from django.conf import settings
+from django.utils import timezone
 from requests.exceptions import ConnectionError, RequestException, Timeout
 
 # from urllib3.exceptions import NameResolutionError
 
 # from account.models import User
-from adora.models import Order, OrderReceipt, TroboMerchantToken, SnapPayAccessToken
+from adora.caching import CATALOG, PRODUCT_PAGES, bump_version, invalidate_product_fragments
+from adora.models import (
+    CatalogTombstone,
+    Order,
+    OrderReceipt,
+    Product,
+    SnapPayAccessToken,
+    TroboMerchantToken,
+)
+from adora.search import index_products, rebuild_index
+from adora import suggest
+from core.utils.money import Rial, toman_to_rial
 
 # from adora.models import SMSCampaign, SMSCampaignSendLog
 # from account.models import User
@@ -20,79 +34,87 @@ from adora.models import Order, OrderReceipt, TroboMerchantToken, SnapPayAccessT
 HEADERS = {"accept": "application/json", "content-type": "application/json"}
 
 
-def consider_walet_balance(order: Order, currency: str = "IRT") -> int:
+class GatewayError(Exception):
+    """
+    A payment or SMS gateway request that failed. ``retryable`` when the
+    gateway could not be reached (or answered garbage), so trying again may work.
     """
-    This function checks if the user has a wallet balance and want to use it then returns the amount to be paid after deducting the wallet balance.
-    If the wallet balance is greater than or equal to the total price, it returns 0.
 
-    This function returnt Rial currency amount.
-    If the user does not want to use wallet balance, it returns the total price multiplied by 10 (to convert to Rial).
-    If the user has a wallet balance but it is less than the total price, it returns the total price minus the wallet balance.
+    def __init__(self, message: str, retryable: bool = False):
+        super().__init__(message)
+        self.retryable = retryable
 
-    args:
-        - currency [IRI, TOMAN]. default=IRI
+
+def consider_walet_balance(order: Order, currency: str = "IRT") -> int:
     """
-    currency_value = 10 if currency == "IRT" else 1
-    if not order.use_wallet_balance:
-        return int(order.total_price) * currency_value
+    The amount the user pays for ``order``, after the wallet balance it uses;
+    0 when the wallet covers the whole order.
 
-    if order.user.profile.wallet_balance >= order.total_price:
-        return 0
-    else:
-        return (
-            int(order.total_price - order.user.profile.wallet_balance) * currency_value
-        )
+    args:
+        - currency [IRT (Rial), TOMAN]. default=IRT
+    """
+    to_pay, _, _ = order.payment_amounts()
+    return to_pay if currency == "IRT" else to_pay.to_toman()
 
 
 @shared_task
 def send_zarin_payment_information(order: Order):
-    try:
-        # order = Order.objects.get(id=order_id)
-        merchant_id = os.environ.get("ZARIN_MERCHANT_ID")
-        zarin_request_url = os.environ.get("ZARIN_REQUEST_URL", b"")
-        zarin_callback_url = os.environ.get("ZARINT_CALLBACK_URL")
-        payment_data = {
-            "merchant_id": merchant_id,
-            "amount": consider_walet_balance(order, "TOMAN"),
-            "currency": "IRT",
-            "description": "خرید از آدورا یدک",
-            "callback_url": zarin_callback_url,
-            "metadata": {
-                "mobile": str(order.receiver_phone_number).replace("+98", "0"),
-            },
-        }
-        print("order", order)
+    """Requests a Zarinpal payment and stores the answer in the order's receipt. Raises ``GatewayError``."""
+    merchant_id = os.environ.get("ZARIN_MERCHANT_ID")
+    zarin_request_url = os.environ.get("ZARIN_REQUEST_URL", b"")
+    zarin_callback_url = os.environ.get("ZARINT_CALLBACK_URL")
+    payment_data = {
+        "merchant_id": merchant_id,
+        "amount": consider_walet_balance(order, "TOMAN"),
+        "currency": "IRT",
+        "description": "خرید از آدورا یدک",
+        "callback_url": zarin_callback_url,
+        "metadata": {
+            "mobile": str(order.receiver_phone_number).replace("+98", "0"),
+        },
+    }
+    print("order", order)
 
+    try:
         res = requests.post(
-            url=zarin_request_url, headers=HEADERS, data=json.dumps(payment_data)
+            url=zarin_request_url,
+            headers=HEADERS,
+            data=json.dumps(payment_data),
+            timeout=settings.PAYMENT_GATEWAY_TIMEOUT,
         )
-
         res_dict = res.json()
-        data = res_dict.get("data", {})
-        errors = res_dict.get("errors", {})
-
-        if data:
-            OrderReceipt.objects.create(
-                authority=data.get("authority", "Not Found"),
-                request_code=data.get("code", 0),
-                request_msg=data.get("message", "Not Found"),
-                fee=data.get("fee", 0),
-                order=order,
-            )
-        if errors:
-            OrderReceipt.objects.create(
-                request_code=errors.get("code", 0),
-                error_msg=errors.get("message", "Not Found"),
-                order=order,
-            )
-
-    except ConnectionError as e:
+    except RequestException as e:
         print(e)
-        OrderReceipt.objects.create(connection_error=True, order=order)
+        raise GatewayError(str(e), retryable=True) from e
+
+    data = res_dict.get("data", {})
+    errors = res_dict.get("errors", {})
+
+    if data:
+        OrderReceipt.objects.update_or_create(
+            order=order,
+            defaults={
+                "authority": data.get("authority", "Not Found"),
+                "request_code": data.get("code", 0),
+                "request_msg": data.get("message", "Not Found"),
+                "fee": data.get("fee", 0),
+            },
+        )
+    elif errors:
+        OrderReceipt.objects.update_or_create(
+            order=order,
+            defaults={
+                "request_code": errors.get("code", 0),
+                "error_msg": errors.get("message", "Not Found"),
+            },
+        )
+    if not data or data.get("code") != 100:
+        raise GatewayError(f"Zarinpal: {errors or res_dict}")
 
-    except Exception as e:
-        print(traceback.format_exc())
-        return None
+
+def record_zarin_connection_error(order: Order):
+    """The receipt of a Zarinpal request that never got through, so the client stops waiting."""
+    OrderReceipt.objects.get_or_create(order=order, defaults={"connection_error": True})
 
 
 def get_torobpay_access_token() -> Optional[str]:
@@ -153,111 +175,120 @@ def get_torobpay_access_token() -> Optional[str]:
 
 @shared_task
 def send_torobpay_payment_information(order: Order):
-    try:
-        order_receipt: OrderReceipt = OrderReceipt.objects.create(
-            order=order, torob_reciept=True
-        )
-        # print(Order)
-        TorobPay_BaseUrl = os.getenv("TOROBPAY_BASE_URL")
-        TorobPay_Payment_endpoint = os.getenv("TOROBPAY_PAYMENT_ENDPOINT")
-
-        access_token = get_torobpay_access_token()
-        # if type(access_token) != str:
-        #     order_receipt.torob_error_message = access_token
-        #     order_receipt.save()
-        #     return
-
-        print("access_token", access_token)
-        header = {
-            "content-type": "application/json",
-            "Authorization": f"Bearer {access_token}",
-        }
+    """Requests a Torob Pay payment token for ``order``. Raises ``GatewayError``."""
+    order_receipt, _ = OrderReceipt.objects.get_or_create(
+        order=order, defaults={"torob_reciept": True}
+    )
+    # print(Order)
+    TorobPay_BaseUrl = os.getenv("TOROBPAY_BASE_URL")
+    TorobPay_Payment_endpoint = os.getenv("TOROBPAY_PAYMENT_ENDPOINT")
 
-        payment_data = {
-            "mobile": str(order.user.phone_number).replace("+98", "0"),
-            "amount": consider_walet_balance(order),
-            "paymentMethodTypeDto": "CREDIT_ONLINE",
-            "returnURL": os.getenv("TOROBPAY_RETURN_TO_THIS_URL"),
-            "transactionId": order.tracking_number,
-            "cartList": [
-                {
-                    "cartId": order.tracking_number,
-                    "totalAmount": consider_walet_balance(order),
-                    # "tax_amount": order.receipt.fee if order.receipt else 0,
-                    "shippingAmount": int(order.delivery_cost) * 10,
-                    "isTaxIncluded": bool(os.getenv("TOROBPAY_IS_TAX_INCLUDE")),
-                    "isShipmentInclude": True if order.delivery_cost else False,
-                    "cartItems": list(
-                        map(
-                            lambda item: {
-                                "id": str(item.id),
-                                "name": item.product.fa_name,
-                                "count": item.quantity,
-                                "category": "قطعات خودرو",
-                                "amount": item.sold_price * 10,
-                                # "comission_type"
-                            },
-                            order.order_items.all(),
-                        )
-                    ),
-                }
-            ],
-        }
+    access_token = get_torobpay_access_token()
+    if access_token is None:
+        raise GatewayError("Torob Pay: no access token", retryable=True)
+
+    print("access_token", access_token)
+    header = {
+        "content-type": "application/json",
+        "Authorization": f"Bearer {access_token}",
+    }
+
+    payment_data = {
+        "mobile": str(order.user.phone_number).replace("+98", "0"),
+        "amount": consider_walet_balance(order),
+        "paymentMethodTypeDto": "CREDIT_ONLINE",
+        "returnURL": os.getenv("TOROBPAY_RETURN_TO_THIS_URL"),
+        "transactionId": order.tracking_number,
+        "cartList": [
+            {
+                "cartId": order.tracking_number,
+                "totalAmount": consider_walet_balance(order),
+                # "tax_amount": order.receipt.fee if order.receipt else 0,
+                "shippingAmount": Rial.from_toman(order.delivery_cost),
+                "isTaxIncluded": bool(os.getenv("TOROBPAY_IS_TAX_INCLUDE")),
+                "isShipmentInclude": True if order.delivery_cost else False,
+                "cartItems": list(
+                    map(
+                        lambda item: {
+                            "id": str(item.id),
+                            "name": item.product.fa_name,
+                            "count": item.quantity,
+                            "category": "قطعات خودرو",
+                            "amount": toman_to_rial(item.sold_price),
+                            # "comission_type"
+                        },
+                        order.order_items.all(),
+                    )
+                ),
+            }
+        ],
+    }
 
-        print(payment_data)
+    print(payment_data)
 
+    try:
         res = requests.post(
             url=f"{TorobPay_BaseUrl}/{TorobPay_Payment_endpoint}",
             headers=header,
             data=json.dumps(payment_data),
+            timeout=settings.PAYMENT_GATEWAY_TIMEOUT,
         )
         res_dict = res.json()
-
-        if res_dict.get("successful", False):
-            print(f"Payment Token successfully is taked")
-            response = res_dict.get("response", {})
-            print("respone : ", response)
-            order.torob_payment_token = response.get("paymentToken")
-            order.torob_payment_page_url = response.get("paymentPageUrl")
-            order.save()
-
-        else:
-            error_data = res_dict.get("errorData", {})
-            error_message = (
-                f"{error_data.get('errorCode', '')}\n {error_data.get('message', '')}"
-            )
-            print(error_message)
-            order_receipt.torob_error_message = error_message
-            order_receipt.save()
-
-        print(res_dict)
-    except ConnectionError as e:
+    except RequestException as e:
         print(f"There is a problem to connecct to Torob Pay to get payment token ")
         print(e)
         order_receipt.torob_error_message = str(e)
         order_receipt.save()
+        raise GatewayError(str(e), retryable=True) from e
 
-    except Exception as e:
-        print(f"There is some error on get access token function from Torob Pay")
-        print(traceback.format_exc())
+    print(res_dict)
+    if not res_dict.get("successful", False):
+        error_data = res_dict.get("errorData", {})
+        error_message = (
+            f"{error_data.get('errorCode', '')}\n {error_data.get('message', '')}"
+        )
+        print(error_message)
+        order_receipt.torob_error_message = error_message
+        order_receipt.save()
+        raise GatewayError(f"Torob Pay: {error_message}")
+
+    print(f"Payment Token successfully is taked")
+    response = res_dict.get("response", {})
+    print("respone : ", response)
+    order.torob_payment_token = response.get("paymentToken")
+    order.torob_payment_page_url = response.get("paymentPageUrl")
+    order.save()
 
 
 MELLIPAYAMK_PATTER_URL = os.environ.get("MELLIPAYAMK_PATTER_URL", b"")
 
 
-@shared_task
-def send_order_status_message(phone_number, msg_args: List, text_code: int):
+def deliver_order_status_message(phone_number, msg_args: List, text_code: int):
+    """Sends an order status SMS. Raises ``GatewayError`` when it was not accepted."""
+    data = {"bodyId": int(text_code), "to": phone_number, "args": msg_args}
     try:
-        data = {"bodyId": int(text_code), "to": phone_number, "args": msg_args}
         res = requests.post(
-            MELLIPAYAMK_PATTER_URL, data=json.dumps(data), headers=HEADERS
+            MELLIPAYAMK_PATTER_URL,
+            data=json.dumps(data),
+            headers=HEADERS,
+            timeout=settings.SMS_GATEWAY_TIMEOUT,
         )
+    except RequestException as e:
+        raise GatewayError(str(e), retryable=True) from e
 
-        print(res.json())
-    except ConnectionError:
-        print("Connectino error")
-    except Exception:
-        print("Exception error")
+    print(res.text)
+    if not res.ok:
+        raise GatewayError(
+            f"SMS {res.status_code}: {res.text}", retryable=res.status_code >= 500
+        )
+
+
+@shared_task
+def send_order_status_message(phone_number, msg_args: List, text_code: int):
+    try:
+        deliver_order_status_message(phone_number, msg_args, text_code)
+    except GatewayError as e:
+        print("SMS error:", e)
 
 
 def _choose_getaway_header(
@@ -480,86 +511,86 @@ AZKIVAM_BASE_URL = os.getenv("AZKIVAM_BASE_URL", "")
 
 
 def azkivam_send_create_ticket_request(order: Order):
-    try:
-        order_receipt = OrderReceipt.objects.create(order=order, azkivam_reciept=True)
-
-        suburl = os.getenv("AZKIVAM_CREATE_TICKET", "")
-
-        body_data = {
-            "amount": consider_walet_balance(order),
-            "redirect_uri": "https://adorayadak.ir/a_redirect_uri",
-            "fallback_uri": "https://adorayadak.ir/a_fallback_uri",
-            "provider_id": AZKIVAM_PROVIDED_ID,
-            "mobile_number": str(order.user.phone_number).replace("+98", "0"),
-            "merchant_id": AZKIVAM_MERCHANT_ID,
-            "items": [
-                {
-                    "name": item.product.fa_name,
-                    "count": item.quantity,
-                    "amount": item.sold_price * 10,
-                    "url": f"https://adorayadak.ir/adp-{item.id}/{item.product.fa_name.strip().replace(' ', '-')}",
-                }
-                for item in order.order_items.all()
-            ],
-        }
+    """Creates an Azkivam ticket for ``order``. Raises ``GatewayError``."""
+    order_receipt, _ = OrderReceipt.objects.get_or_create(
+        order=order, defaults={"azkivam_reciept": True}
+    )
 
-        # افزودن هزینه ارسال (در صورت وجود)
-        delivery_cost = getattr(order, "delivery_cost", None)
-        if delivery_cost:
-            body_data["items"].append(
-                {
-                    "name": "هزینه ارسال و بسته بندی",
-                    "count": 1,
-                    "amount": int(delivery_cost) * 10,
-                    "url": "https://adorayadak.ir/checkout",
-                }
-            )
+    suburl = os.getenv("AZKIVAM_CREATE_TICKET", "")
+
+    body_data = {
+        "amount": consider_walet_balance(order),
+        "redirect_uri": "https://adorayadak.ir/a_redirect_uri",
+        "fallback_uri": "https://adorayadak.ir/a_fallback_uri",
+        "provider_id": AZKIVAM_PROVIDED_ID,
+        "mobile_number": str(order.user.phone_number).replace("+98", "0"),
+        "merchant_id": AZKIVAM_MERCHANT_ID,
+        "items": [
+            {
+                "name": item.product.fa_name,
+                "count": item.quantity,
+                "amount": toman_to_rial(item.sold_price),
+                "url": f"https://adorayadak.ir/adp-{item.id}/{item.product.fa_name.strip().replace(' ', '-')}",
+            }
+            for item in order.order_items.all()
+        ],
+    }
+
+    # افزودن هزینه ارسال (در صورت وجود)
+    delivery_cost = getattr(order, "delivery_cost", None)
+    if delivery_cost:
+        body_data["items"].append(
+            {
+                "name": "هزینه ارسال و بسته بندی",
+                "count": 1,
+                "amount": Rial.from_toman(delivery_cost),
+                "url": "https://adorayadak.ir/checkout",
+            }
+        )
 
-        # ارسال درخواست به آذکی‌وام
+    # ارسال درخواست به آذکی‌وام
+    try:
         res = requests.post(
             url=f"{AZKIVAM_BASE_URL}/{suburl}",
             headers=azkivam_header(suburl, "POST", AZKIVAM_MERCHANT_ID),
             data=json.dumps(body_data),
-            timeout=30,  # ✅ اضافه‌شده برای جلوگیری از هنگ در صورت قطع اتصال
+            timeout=settings.PAYMENT_GATEWAY_TIMEOUT,
         )
+    except RequestException as e:
+        print("ConnectionError:", e)
+        order_receipt.azkivam_error_message = str(e)
+        order_receipt.save()
+        raise GatewayError(str(e), retryable=True) from e
 
-        print(f"Azkivam response status: {res.status_code}")
+    print(f"Azkivam response status: {res.status_code}")
 
-        # پردازش پاسخ
-        if res.status_code == 200:
+    # پردازش پاسخ
+    if res.status_code != 200:
+        # در صورت خطا از سمت آذکی‌وام
+        try:
             res_dict = res.json()
-            print("Azkivam Ticket created successfully")
-
-            response = res_dict.get("result", {})
-            print("Response:", response)
-
-            order.azkivam_payment_token = response.get("ticket_id")
-            order.azkivam_payment_page_url = response.get("payment_uri")
-            order.save()
+        except ValueError:
+            res_dict = {"error": res.text}
 
-        else:
-            # در صورت خطا از سمت آذکی‌وام
-            try:
-                res_dict = res.json()
-            except Exception:
-                res_dict = {"error": res.text}
+        error_message = str(res_dict)
+        print("Azkivam error:", error_message)
 
-            error_message = str(res_dict)
-            print("Azkivam error:", error_message)
+        order_receipt.azkivam_error_message = error_message
+        order_receipt.save()
+        raise GatewayError(f"Azkivam: {error_message}", retryable=res.status_code >= 500)
 
-            order_receipt.azkivam_error_message = error_message
-            order_receipt.save()
+    try:
+        res_dict = res.json()
+    except ValueError as e:
+        raise GatewayError(f"Azkivam: invalid response {res.text!r}", retryable=True) from e
+    print("Azkivam Ticket created successfully")
 
-    except ConnectionError as e:
-        print("ConnectionError:", e)
-        order_receipt.azkivam_error_message = str(e)
-        order_receipt.save()
+    response = res_dict.get("result", {})
+    print("Response:", response)
 
-    except Exception as e:
-        tb = traceback.format_exc()
-        print(tb)
-        order_receipt.azkivam_error_message = tb
-        order_receipt.save()
+    order.azkivam_payment_token = response.get("ticket_id")
+    order.azkivam_payment_page_url = response.get("payment_uri")
+    order.save()
 
 
 AZKI_CODES = {
@@ -753,97 +784,94 @@ def get_snap_pay_access_token() -> Optional[str]:
 
 @shared_task
 def send_snap_payment_information(order: Order):
-    try:
-        order_receipt: OrderReceipt = OrderReceipt.objects.create(
-            order=order, snap_reciept=True
-        )
-        # print(Order)
-        snap_base_url = os.getenv("SNAP_PAY_BASE_URL")
-        snap_payment_endpoint = os.getenv("SNAP_PAY_PAYMENT_ENDPOINT")
-
-        access_token = get_snap_pay_access_token()
-        # if type(access_token) != str:
-        #     order_receipt.torob_error_message = access_token
-        #     order_receipt.save()
-        #     return
-
-        print("access_token", access_token)
-        header = {
-            "content-type": "application/json",
-            "Authorization": f"Bearer {access_token}",
-        }
+    """Requests a SnappPay payment token for ``order``. Raises ``GatewayError``."""
+    order_receipt, _ = OrderReceipt.objects.get_or_create(
+        order=order, defaults={"snap_reciept": True}
+    )
+    # print(Order)
+    snap_base_url = os.getenv("SNAP_PAY_BASE_URL")
+    snap_payment_endpoint = os.getenv("SNAP_PAY_PAYMENT_ENDPOINT")
 
-        payment_data = {
-            "amount": consider_walet_balance(order),
-           "discountAmount": 0,
-            "externalSourceAmount": int(order.user.profile.wallet_balance * 10) if order.use_wallet_balance else 0,
-            "mobile": str(order.user.phone_number),
-            "paymentMethodTypeDto": "INSTALLMENT",
-            "returnURL": "https://api.adorayadak.ir/snappay-callback/",
-            "transactionId": order.tracking_number,
-            "cartList": [
-                {
-                    "cartId": order.id,
-                    "totalAmount": int(order.total_price) * 10,
-                    "isShipmentIncluded": True if order.delivery_cost else False,
-                    "shippingAmount": int(order.delivery_cost) * 10,
-                    "isTaxIncluded": True,
-                    "taxAmount": 0,
-                    "cartItems": list(
-                        map(
-                            lambda item: {
-                                "id": item.id,
-                                "amount": item.sold_price * 10,
-                                "category": "ابزار و یدک خودرو",
-                                "count": item.quantity,
-                                "name": item.product.fa_name,
-                                "commissionType": 100,
-                            },
-                            order.order_items.all(),
-                        )
-                    ),
-                }
-            ],
-        }
+    access_token = get_snap_pay_access_token()
+    if access_token is None:
+        raise GatewayError("SnappPay: no access token", retryable=True)
 
-        print(payment_data)
+    print("access_token", access_token)
+    header = {
+        "content-type": "application/json",
+        "Authorization": f"Bearer {access_token}",
+    }
+
+    to_pay, from_wallet, total = order.payment_amounts()
+    payment_data = {
+        "amount": to_pay,
+        "discountAmount": 0,
+        "externalSourceAmount": from_wallet,
+        "mobile": str(order.user.phone_number),
+        "paymentMethodTypeDto": "INSTALLMENT",
+        "returnURL": "https://api.adorayadak.ir/snappay-callback/",
+        "transactionId": order.tracking_number,
+        "cartList": [
+            {
+                "cartId": order.id,
+                "totalAmount": total,
+                "isShipmentIncluded": True if order.delivery_cost else False,
+                "shippingAmount": Rial.from_toman(order.delivery_cost),
+                "isTaxIncluded": True,
+                "taxAmount": 0,
+                "cartItems": list(
+                    map(
+                        lambda item: {
+                            "id": item.id,
+                            "amount": toman_to_rial(item.sold_price),
+                            "category": "ابزار و یدک خودرو",
+                            "count": item.quantity,
+                            "name": item.product.fa_name,
+                            "commissionType": 100,
+                        },
+                        order.order_items.all(),
+                    )
+                ),
+            }
+        ],
+    }
 
-        url = f"{snap_base_url}{snap_payment_endpoint}"
-        print("urllllllllllllllllllL", url)
+    print(payment_data)
+
+    url = f"{snap_base_url}{snap_payment_endpoint}"
+    try:
         res = requests.post(
             url=url,
             headers=header,
             data=json.dumps(payment_data),
+            timeout=settings.PAYMENT_GATEWAY_TIMEOUT,
         )
         res_dict = res.json()
-
-        if res_dict.get("successful", False):
-            print(f"Payment Token successfully is taked")
-            response = res_dict.get("response", {})
-            print("respone : ", response)
-            order.snap_payment_token = response.get("paymentToken")
-            order.snap_payment_page_url = response.get("paymentPageUrl")
-            order.save()
-
-        else:
-            error_data = res_dict.get("errorData", {})
-            error_message = (
-                f"{error_data.get('errorCode', '')}\n {error_data.get('message', '')}"
-            )
-            print(error_message)
-            order_receipt.snap_error_message = error_message
-            order_receipt.save()
-
-        print(res_dict)
-    except ConnectionError as e:
-        print(f"There is a problem to connecct to Torob Pay to get payment token ")
+    except RequestException as e:
+        print(f"There is a problem to connecct to SnappPay to get payment token ")
         print(e)
         order_receipt.snap_error_message = str(e)
         order_receipt.save()
+        raise GatewayError(str(e), retryable=True) from e
+
+    print(res_dict)
+    if not res_dict.get("successful", False):
+        error_data = res_dict.get("errorData", {})
+        error_message = (
+            f"{error_data.get('errorCode', '')}\n {error_data.get('message', '')}"
+        )
+        print(error_message)
+        order_receipt.snap_error_message = error_message
+        order_receipt.save()
+        raise GatewayError(f"SnappPay: {error_message}")
+
+    print(f"Payment Token successfully is taked")
+    response = res_dict.get("response", {})
+    print("respone : ", response)
+    order.snap_payment_token = response.get("paymentToken")
+    order.snap_payment_page_url = response.get("paymentPageUrl")
+    order.save()
 
-    except Exception as e:
-        print(f"There is some error on get access token function from Torob Pay")
-        print(traceback.format_exc())
 
 def _handle_snap_action(order: Order, endpoint_env: str, success_status: str):
     url = f"{os.getenv('SNAP_PAY_BASE_URL')}{os.getenv(endpoint_env)}"
@@ -899,3 +927,56 @@ def snappay_revert(order: Order):
 def snappay_cancel(order: Order):
     return _handle_snap_action(order, "SNAP_PAY_CANCEL_ENDPOINT", "SC")  # Snap Canceled
 
+
+
+@shared_task
+def update_product_search_index(product_ids: List[int]):
+    index_products(product_ids)
+
+
+@shared_task
+def rebuild_product_search_index():
+    rebuild_index()
+
+
+@shared_task
+def update_suggestions(kind: str, object_ids: List[int]):
+    suggest.update(kind, object_ids)
+
+
+@shared_task
+def rebuild_suggestions():
+    suggest.rebuild()
+
+
+@shared_task
+def reconcile_product_reviews():
+    product_ids = Product.objects.refresh_reviews()
+    if product_ids:
+        invalidate_product_fragments(product_ids)
+        bump_version(CATALOG)
+        bump_version(PRODUCT_PAGES)
+    return len(product_ids)
+
+
+@shared_task
+def regenerate_price_feeds():
+    # Imported here: adora.feeds imports this module.
+    from adora import feeds
+
+    feeds.build_if_stale()
+
+
+@shared_task
+def prune_catalog_tombstones():
+    retained_since = timezone.now() - timedelta(days=settings.CATALOG_TOMBSTONE_RETENTION_DAYS)
+    deleted, _ = CatalogTombstone.objects.filter(created_date__lt=retained_since).delete()
+    return deleted
+
+
+@shared_task
+def dispatch_outbox(message_ids: Optional[List[int]] = None):
+    # Imported here: adora.outbox imports this module.
+    from adora import outbox
+
+    return outbox.dispatch(message_ids)
@@ -1,3 +1,1308 @@
-from django.test import TestCase
+import gzip
+import json
+import tempfile
+from decimal import ROUND_FLOOR, Decimal
+import time
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from account.models import User
+from adora import catalog_snapshot, changes, feeds, outbox, search, suggest
+from adora import models as adora_models
+from adora.caching import (
+    CATALOG,
+    CATEGORY_TREE,
+    PRICE_FEEDS,
+    PRODUCT_PAGES,
+    bump_version,
+    get_version,
+    invalidate_product_fragments,
+    product_fragment_keys,
+)
+from adora.filters import PRODUCT_ORDERINGS
+from adora.pricing import price_cart
+from adora.models import (
+    Brand,
+    Car,
+    CashDiscountPercent,
+    Category,
+    Comment,
+    Order,
+    OrderItem,
+    OutboxMessage,
+    Product,
+    ProductImage,
+    new_tracking_number,
+)
+from adora.serializers import CategoryWhitChildrenSerializer, ProductOrderItemSerializer
+from adora.tasks import consider_walet_balance
+from core.utils.money import (
+    Rial,
+    hundredths,
+    percent_of,
+    percent_off,
+    rounded_percent_off,
+    wallet_split,
+)
+from core.utils.normalize_text import normalize_text, normalized_variants
+
+
+def forget_cached_responses():
+    """Moves every cache version on, so responses cached by other tests are not read."""
+    for name in (CATEGORY_TREE, CATALOG, PRODUCT_PAGES, PRICE_FEEDS):
+        bump_version(name)
+
+
+def make_product(category, **fields):
+    values = {
+        "custom_id": Product.objects.count() + 1,
+        "fa_name": "قطعه",
+        "en_name": "part",
+        "price": 1000,
+        "price_discount_percent": 0,
+        "wallet_discount": 0,
+        "count": 1,
+    }
+    values.update(fields)
+    return Product.objects.create(category=category, **values)
+
+
+class CategoryTreeTests(TestCase):
+    def test_moving_a_category_rewrites_its_subtree(self):
+        root = Category.objects.create(name="root")
+        other = Category.objects.create(name="other")
+        child = Category.objects.create(name="child", parent=root)
+        grandchild = Category.objects.create(name="grandchild", parent=child)
+
+        child.parent = other
+        child.save()
+
+        grandchild.refresh_from_db()
+        self.assertEqual(grandchild.path, f"/{other.id}/{child.id}/{grandchild.id}/")
+        self.assertEqual(grandchild.depth, 3)
+        self.assertEqual(set(root.get_descendants()), set())
+        self.assertEqual(set(other.get_descendants()), {child, grandchild})
+        self.assertEqual(
+            {row["id"] for row in other.get_subtree_ids()}, {other.id, child.id, grandchild.id}
+        )
+
+    def test_empty_path_does_not_match_every_category(self):
+        Category.objects.create(name="root")
+        category = Category.objects.create(name="not backfilled")
+        Category.objects.filter(pk=category.pk).update(path="")
+        category.refresh_from_db()
+
+        self.assertEqual(list(category.get_descendants()), [])
+        self.assertEqual([row["id"] for row in category.get_subtree_ids()], [category.id])
+        self.assertEqual(list(Category(name="unsaved").get_descendants()), [])
+
+
+class CatalogSnapshotTests(TestCase):
+    def test_car_bitsets_match_packbits_and_the_database(self):
+        category = Category.objects.create(name="c")
+        cars = [Car.objects.create(fa_name=f"car {i}") for i in range(11)]
+        products = [make_product(category, count=i) for i in range(5)]
+        for i, product in enumerate(products):
+            product.compatible_cars.set(cars[i::2])
+
+        with tempfile.TemporaryDirectory() as root, override_settings(
+            CATALOG_SNAPSHOT_DIR=root
+        ):
+            snapshot = catalog_snapshot.Snapshot(catalog_snapshot.build(1))
+
+            membership = np.array(
+                [[car in product.compatible_cars.all() for car in cars] for product in products]
+            )
+            np.testing.assert_array_equal(snapshot.cars, np.packbits(membership, axis=1))
+            for car in cars:
+                self.assertEqual(
+                    snapshot.select({"compatible_cars": [car.id]}).tolist(),
+                    list(
+                        Product.objects.filter(compatible_cars=car)
+                        .order_by("-count", "-id")
+                        .values_list("id", flat=True)
+                    ),
+                )
+
+
+class ProductListCacheTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(
+            CATALOG_SNAPSHOT_DIR=directory.name, CATALOG_SNAPSHOT_MIN_AGE=3600
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        # Snapshots are built by the test, not by a thread outside its transaction.
+        patcher = mock.patch.object(catalog_snapshot, "_rebuild_in_background")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.category = Category.objects.create(name="c")
+        forget_cached_responses()
+
+    def list_ids(self):
+        response = APIClient().get("/products/")
+        self.assertEqual(response.status_code, 200)
+        return [product["id"] for product in response.data["results"]["results"]]
+
+    def test_list_is_fresh_after_a_write(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = make_product(self.category, count=1)
+        catalog_snapshot.build(get_version(CATALOG))
+        with mock.patch.object(
+            catalog_snapshot.Snapshot, "select", autospec=True,
+            side_effect=catalog_snapshot.Snapshot.select,
+        ) as select:
+            self.assertEqual(self.list_ids(), [first.id])
+        self.assertTrue(select.called)
+
+        # The snapshot is now a version behind and not rebuilt for an hour.
+        with self.captureOnCommitCallbacks(execute=True):
+            second = make_product(self.category, count=5)
+        self.assertEqual(self.list_ids(), [second.id, first.id])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.filter(pk=second.pk).delete()
+        self.assertEqual(self.list_ids(), [first.id])
+
+
+class ProductDetailCacheTests(TestCase):
+    def setUp(self):
+        self.brand = Brand.objects.create(name="بوش")
+        self.product = make_product(Category.objects.create(name="c"), brand=self.brand)
+        forget_cached_responses()
+        self.url = f"/products/{self.product.id}/"
+
+    def detail(self):
+        response = APIClient().get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_detail_is_fresh_after_writes_to_the_product_and_its_relations(self):
+        self.assertEqual(self.detail()["price"], 1000)
+        self.assertEqual(self.detail()["price"], 1000)  # Cached.
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.price = 2000
+            self.product.save()
+        self.assertEqual(self.detail()["price"], 2000)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ProductImage.objects.create(product=self.product, image_url="https://img/1.webp")
+        self.assertEqual(len(self.detail()["images"]), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.brand.name = "بوش آلمان"
+            self.brand.save()
+        self.assertEqual(self.detail()["brand"]["name"], "بوش آلمان")
+
+    def test_an_unrelated_request_does_not_share_the_cached_response(self):
+        other = make_product(self.product.category, price=5000)
+        self.assertEqual(self.detail()["id"], self.product.id)
+        response = APIClient().get(f"/products/{other.id}/")
+        self.assertEqual(response.data["id"], other.id)
+
+
+class ProductCardCacheTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name="c")
+        # Committed, so cards cached by other tests under the same ids are dropped.
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products = [make_product(category, price=1000 * n) for n in (1, 2, 3)]
+        self.product = self.products[0]
+
+    def card(self, product):
+        return ProductOrderItemSerializer(context={}).cards([product.id])[product.id]
+
+    def test_card_is_fresh_after_a_write(self):
+        self.assertEqual(self.card(self.product)["price"], 1000)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.price = 4000
+            self.product.save()
+        self.assertEqual(self.card(self.product)["price"], 4000)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ProductImage.objects.create(product=self.product, image_url="https://img/1.webp")
+        self.assertEqual(len(self.card(self.product)["images"]), 1)
+
+    def test_a_card_built_before_an_invalidation_is_never_read(self):
+        # A reader takes the generation, a write commits, then the reader
+        # stores the card it built from the old row.
+        stale_key = product_fragment_keys("order_item", [self.product.id])[self.product.id]
+        Product.objects.filter(pk=self.product.pk).update(price=4000)
+        invalidate_product_fragments([self.product.id])
+        cache.set(stale_key, {"id": self.product.id, "price": 1000})
+
+        self.assertEqual(self.card(self.product)["price"], 4000)
+
+    def test_order_list_reads_every_card_in_one_round_trip(self):
+        user = User.objects.create_user(phone_number="+989121112233")
+        for products in (self.products[:2], self.products[1:]):
+            order = Order.objects.create(user=user)
+            for product in products:
+                OrderItem.objects.create(order=order, product=product, quantity=1)
+        client = APIClient()
+        client.force_authenticate(user)
+        self.assertEqual(client.get("/orders/").status_code, 200)  # Caches the cards.
+
+        with mock.patch.object(cache, "get_many", wraps=cache.get_many) as get_many:
+            response = client.get("/orders/")
+        self.assertEqual(response.status_code, 200)
+        prices = [item["product"]["price"] for order in response.data for item in order["order_items"]]
+        self.assertEqual(sorted(prices), [1000, 2000, 2000, 3000])
+        card_reads = [
+            keys for (keys,), _ in get_many.call_args_list
+            if any(key.startswith("adora:product-card") for key in keys)
+        ]
+        # The generations of the three products, then their cards.
+        self.assertEqual(len(card_reads), 2)
+        self.assertEqual([len(keys) for keys in card_reads], [3, 3])
+
+
+class BatchLoaderTests(TestCase):
+    def setUp(self):
+        self.product = make_product(Category.objects.create(name="c"))
+        self.users = [
+            User.objects.create_user(phone_number=f"+98912111{n:04d}") for n in range(12)
+        ]
+
+    def add_threads(self, count):
+        for n in range(count):
+            thread = Comment.objects.create(
+                product=self.product, user=self.users[n], text="سوال", rating=4
+            )
+            Comment.objects.create(
+                product=self.product, user=self.users[-1 - n], parent=thread, text="پاسخ"
+            )
+
+    def count_queries(self, client, url, params=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response
+
+    def test_comment_page_costs_the_same_for_any_number_of_threads(self):
+        self.add_threads(1)
+        few, _ = self.count_queries(APIClient(), "/comments/", {"product": self.product.id})
+        self.add_threads(5)
+        many, response = self.count_queries(
+            APIClient(), "/comments/", {"product": self.product.id}
+        )
+
+        self.assertEqual(len(response.data["results"]), 6)
+        self.assertTrue(all(len(thread["replies"]) == 1 for thread in response.data["results"]))
+        self.assertEqual(many, few)
+
+    def test_order_list_costs_the_same_for_any_number_of_orders(self):
+        user = self.users[0]
+        products = [self.product, make_product(self.product.category)]
+        client = APIClient()
+        client.force_authenticate(user)
+
+        def add_orders(count):
+            for _ in range(count):
+                order = Order.objects.create(user=user)
+                for product in products:
+                    OrderItem.objects.create(order=order, product=product, quantity=1)
+
+        # Measured with the product cards cached: their misses cost a fixed
+        # number of queries too, see ProductCardCacheTests.
+        add_orders(1)
+        client.get("/orders/")
+        few, _ = self.count_queries(client, "/orders/")
+        add_orders(4)
+        many, response = self.count_queries(client, "/orders/")
+
+        self.assertEqual(len(response.data), 5)
+        self.assertEqual(many, few)
+
+
+@override_settings(PRODUCT_COMMENTS_PAGE_SIZE=3, COMMENT_REPLY_MAX_DEPTH=2, COMMENT_REPLIES_LIMIT=2)
+class CommentThreadTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(phone_number="+989121112233")
+        self.product = make_product(Category.objects.create(name="c"))
+        forget_cached_responses()
+
+    def comment(self, parent=None, **fields):
+        return Comment.objects.create(
+            product=self.product, user=self.user, parent=parent, text="متن", **fields
+        )
+
+    def test_replies_are_capped_in_depth_and_count(self):
+        thread = self.comment(rating=5)
+        first, second, _ = (self.comment(thread) for _ in range(3))
+        deep = self.comment(self.comment(first))
+
+        response = APIClient().get("/comments/", {"product": self.product.id})
+
+        replies = response.data["results"][0]["replies"]
+        self.assertEqual([reply["id"] for reply in replies], [first.id, second.id])
+        nested = replies[0]["replies"]
+        self.assertEqual(len(nested), 1)
+        self.assertEqual(nested[0]["replies"], [])  # ``deep`` is below the depth cap.
+        self.assertEqual(Comment.objects.get(pk=deep.pk).depth, 3)
+
+    def test_product_comments_are_paged_from_the_detail_page_without_gaps(self):
+        # Three on the detail page, then pages of the comments endpoint.
+        threads = [self.comment(rating=4) for _ in range(25)]
+        self.comment(threads[0])  # Replies are not pages of their own.
+
+        response = APIClient().get(f"/products/{self.product.id}/")
+        seen = [comment["id"] for comment in response.data["comments"]]
+        url = response.data["comments_next"]
+        pages = 1
+        while url:
+            pages += 1
+            response = APIClient().get(url)
+            self.assertEqual(response.status_code, 200)
+            seen.extend(comment["id"] for comment in response.data["results"])
+            url = response.data["next"]
+
+        self.assertEqual(seen, [thread.id for thread in reversed(threads)])
+        self.assertEqual(pages, 4)
+
+    def test_moving_a_reply_moves_its_thread(self):
+        old_thread, new_thread = self.comment(rating=5), self.comment(rating=3)
+        reply = self.comment(old_thread)
+        nested = self.comment(reply)
+
+        reply.parent = new_thread
+        reply.save()
+
+        nested.refresh_from_db()
+        self.assertEqual(nested.path, f"/{new_thread.id}/{reply.id}/{nested.id}/")
+        self.assertEqual(nested.thread_id, new_thread.id)
+
+
+@override_settings(CATALOG_SNAPSHOT_ENABLED=False)
+class ReviewSummaryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(phone_number="+989121112233")
+        self.category = Category.objects.create(name="c")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product = make_product(self.category)
+        forget_cached_responses()
+
+    def review(self, rating, text="خوب", **fields):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Comment.objects.create(
+                product=self.product, user=self.user, text=text, rating=rating, **fields
+            )
+
+    def summary(self):
+        response = APIClient().get("/products/")
+        self.assertEqual(response.status_code, 200)
+        (card,) = response.data["results"]["results"]
+        self.assertNotIn("comments", card)
+        return card["review_summary"]
+
+    def test_summary_follows_the_best_review(self):
+        self.assertEqual(self.summary()["highlight"], None)
+        self.review(5, text="")  # Nothing to show.
+        good = self.review(4, buy_suggest=True)
+        self.review(3, parent=good)  # Replies are not reviews.
+
+        summary = self.summary()
+        self.assertEqual(
+            (summary["count"], summary["rating_avg"], summary["buy_suggest_count"]), (2, 4.5, 1)
+        )
+        self.assertEqual(summary["highlight"]["id"], good.id)
+
+        best = self.review(5)
+        self.assertEqual(self.summary()["highlight"]["id"], best.id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            best.delete()
+        summary = self.summary()
+        self.assertEqual(summary["highlight"]["id"], good.id)
+        self.assertEqual(summary["count"], 2)
+
+    def test_highlights_are_refreshed_in_a_fixed_number_of_queries(self):
+        other_user = User.objects.create_user(phone_number="+989121112244")
+        for _ in range(4):
+            product = make_product(self.category)
+            for user in (self.user, other_user):
+                Comment.objects.create(product=product, user=user, text="خوب", rating=4)
+        Product.objects.update(review_highlight=None)
+
+        # Pick the reviews, load them with their authors, write the changed highlights.
+        with self.assertNumQueries(3):
+            Product.objects.all().refresh_review_highlights()
+        self.assertEqual(Product.objects.filter(review_highlight__isnull=True).count(), 1)
+        with self.assertNumQueries(2):  # Nothing changed, nothing written.
+            Product.objects.all().refresh_review_highlights()
+
+
+@override_settings(CATALOG_SNAPSHOT_ENABLED=False)
+class SparseFieldsetTests(TestCase):
+    def setUp(self):
+        self.brand = Brand.objects.create(name="بوش")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product = make_product(
+                Category.objects.create(name="c"), brand=self.brand, title_description="بلند"
+            )
+            ProductImage.objects.create(product=self.product, image_url="https://img/1.webp")
+        forget_cached_responses()
+
+    def get(self, url, params=None, client=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = (client or APIClient()).get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response.data, " ".join(query["sql"] for query in queries)
+
+    def test_product_list_loads_only_the_selected_fields(self):
+        data, sql = self.get("/products/", {"fields": "id,fa_name,price,images.image_url"})
+        (card,) = data["results"]["results"]
+        self.assertEqual(
+            card,
+            {
+                "id": self.product.id,
+                "fa_name": "قطعه",
+                "price": 1000,
+                "images": [{"image_url": "https://img/1.webp"}],
+            },
+        )
+        self.assertNotIn("title_description", sql)
+        self.assertNotIn("adora_brand", sql)
+
+        # The sparse card is not cached in place of the full one.
+        data, _ = self.get("/products/")
+        self.assertEqual(data["results"]["results"][0]["title_description"], "بلند")
+
+    def test_nested_serializers_are_keys_unless_expanded(self):
+        url = f"/products/{self.product.id}/"
+        data, _ = self.get(url, {"fields": "id,brand"})
+        self.assertEqual(data, {"id": self.product.id, "brand": self.brand.id})
+
+        data, _ = self.get(url, {"fields": "id,brand", "expand": "brand"})
+        self.assertEqual(data["brand"]["name"], "بوش")
+
+    def test_order_list_selects_nested_product_fields(self):
+        user = User.objects.create_user(phone_number="+989121112233")
+        order = Order.objects.create(user=user)
+        OrderItem.objects.create(order=order, product=self.product, quantity=2)
+        client = APIClient()
+        client.force_authenticate(user)
+
+        data, sql = self.get(
+            "/orders/", {"fields": "id,order_items.quantity,order_items.product.fa_name"}, client
+        )
+
+        self.assertEqual(
+            data, [{"id": order.id, "order_items": [{"quantity": 2, "product": {"fa_name": "قطعه"}}]}]
+        )
+        self.assertNotIn("title_description", sql)
+        self.assertEqual(sql.count('FROM "adora_order"'), 1)  # No deferred column loaded per order.
+
+
+class ReviewAggregateTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(phone_number="+989121112233")
+        self.product = make_product(Category.objects.create(name="c"))
+
+    def review(self, rating, buy_suggest=False):
+        return Comment.objects.create(
+            product=self.product, user=self.user, text="خوب", rating=rating, buy_suggest=buy_suggest
+        )
+
+    def aggregates(self):
+        self.product.refresh_from_db()
+        return (
+            self.product.review_count,
+            self.product.rating_sum,
+            self.product.buy_suggest_count,
+            self.product.rating_avg,
+        )
+
+    def test_reviews_are_counted_incrementally(self):
+        first = self.review(5, buy_suggest=True)
+        self.review(2)
+        self.assertEqual(self.aggregates(), (2, 7, 1, 3.5))
+
+        first.rating = 3
+        first.save()
+        self.assertEqual(self.aggregates(), (2, 5, 1, 2.5))
+
+        first.delete()
+        self.assertEqual(self.aggregates(), (1, 2, 0, 2.0))
+
+    def test_removing_an_uncounted_review_recomputes_the_drifted_aggregates(self):
+        self.review(4)
+        uncounted = self.review(5, buy_suggest=True)
+        # As if the 5 star review had been written before the aggregates were backfilled.
+        Product.objects.filter(pk=self.product.pk).update(
+            review_count=1, rating_sum=4, buy_suggest_count=0, rating_avg=4.0
+        )
+
+        uncounted.delete()
+        self.assertEqual(self.aggregates(), (1, 4, 0, 4.0))
+
+
+class TrackingNumberTests(TestCase):
+    def test_numbers_are_unguessable_and_sort_by_creation_time(self):
+        numbers = []
+        for _ in range(3):
+            numbers.append(new_tracking_number())
+            time.sleep(0.002)
+
+        for number in numbers:
+            self.assertRegex(number, r"^ADO_[0-9A-HJKMNP-TV-Z]{24}$")
+        self.assertEqual(numbers, sorted(numbers))
+        self.assertEqual(len({number[14:] for number in numbers}), 3)
+
+    def test_a_taken_number_is_drawn_again(self):
+        user = User.objects.create_user(phone_number="+989121112233")
+        taken = Order.objects.create(user=user).tracking_number
+        fresh = new_tracking_number()
+
+        with mock.patch.object(
+            adora_models, "new_tracking_number", side_effect=[taken, fresh]
+        ):
+            order = Order.objects.create(user=user)
+
+        self.assertEqual(order.tracking_number, fresh)
+        self.assertEqual(Order.objects.count(), 2)
+
+
+def gateway_response(status_code, text="{}"):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = text.encode()
+    return response
+
+
+@override_settings(OUTBOX_MAX_ATTEMPTS=3)
+class OutboxTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch("adora.tasks.dispatch_outbox.delay")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.message = outbox.enqueue_order_status_sms("09121112233", ["ADO_1"], 100)
+
+    def dispatch(self, **post):
+        with mock.patch("adora.tasks.requests.post", **post) as send:
+            outbox.dispatch([self.message.id])
+        self.message.refresh_from_db()
+        return send
+
+    def test_sent_message_is_not_sent_again(self):
+        send = self.dispatch(return_value=gateway_response(200))
+        self.assertEqual(self.message.status, OutboxMessage.STATUS_SENT)
+        self.assertIsNotNone(send.call_args.kwargs["timeout"])
+        self.assertIsNone(self.message.claimed_until)
+
+        send = self.dispatch(return_value=gateway_response(200))
+        self.assertFalse(send.called)
+        self.assertEqual(self.message.attempts, 1)
+
+    def test_failures_are_retried_until_the_last_attempt(self):
+        self.dispatch(side_effect=requests.ConnectionError("down"))
+        self.assertEqual(
+            (self.message.status, self.message.attempts), (OutboxMessage.STATUS_PENDING, 1)
+        )
+        self.assertIn("down", self.message.last_error)
+
+        self.dispatch(return_value=gateway_response(502))
+        self.assertEqual(self.message.status, OutboxMessage.STATUS_PENDING)
+
+        outbox.dispatch()  # The sweep picks it up again.
+        self.message.refresh_from_db()
+        self.assertEqual(
+            (self.message.status, self.message.attempts), (OutboxMessage.STATUS_FAILED, 3)
+        )
+
+    def test_rejected_message_fails_at_once(self):
+        self.dispatch(return_value=gateway_response(400, '{"error": "bad number"}'))
+        self.assertEqual(self.message.status, OutboxMessage.STATUS_FAILED)
+        self.assertIn("bad number", self.message.last_error)
+
+    def test_claimed_message_is_left_to_its_worker_until_the_claim_expires(self):
+        claimed_until = timezone.now() + timedelta(minutes=5)
+        OutboxMessage.objects.filter(pk=self.message.pk).update(claimed_until=claimed_until)
+        send = self.dispatch(return_value=gateway_response(200))
+        self.assertFalse(send.called)
+
+        OutboxMessage.objects.filter(pk=self.message.pk).update(
+            claimed_until=timezone.now() - timedelta(seconds=1)
+        )
+        send = self.dispatch(return_value=gateway_response(200))
+        self.assertTrue(send.called)
+        self.assertEqual(self.message.status, OutboxMessage.STATUS_SENT)
+
+    def test_outcome_is_dropped_when_the_claim_was_lost(self):
+        def slow_send(*args, **kwargs):
+            # The claim ran out during the request and another worker took the message.
+            OutboxMessage.objects.filter(pk=self.message.pk).update(
+                claimed_until=timezone.now() + timedelta(hours=1)
+            )
+            return gateway_response(200)
+
+        self.dispatch(side_effect=slow_send)
+        self.assertEqual(self.message.status, OutboxMessage.STATUS_PENDING)
+
+
+class PaymentStatusTests(TransactionTestCase):
+    """The views read in threads that close their connection, so rows are committed."""
+
+    def setUp(self):
+        self.owner = User.objects.create_user(phone_number="+989121112233")
+        self.order = Order.objects.create(
+            user=self.owner, torob_payment_page_url="https://pay/1", torob_payment_token="T1"
+        )
+        OutboxMessage.objects.create(
+            topic="payment.torobpay",
+            order=self.order,
+            status=OutboxMessage.STATUS_SENT,
+        )
+
+    async def poll(self, user):
+        headers = {"Authorization": f"Bearer {AccessToken.for_user(user)}"} if user else {}
+        return await AsyncClient().get(
+            "/orders/payment-request-info/",
+            {"tracking_number": self.order.tracking_number},
+            headers=headers,
+        )
+
+    async def test_owner_gets_the_payment_page(self):
+        response = await self.poll(self.owner)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"payment_url": "https://pay/1", "payment_token": "T1"})
+
+    async def test_other_users_get_not_found(self):
+        other = await User.objects.acreate(phone_number="+989121112244")
+        self.assertEqual((await self.poll(other)).status_code, 404)
+        self.assertEqual((await self.poll(None)).status_code, 401)
+
+
+class ProductSearchTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name="c")
+        self.brake = make_product(
+            category, fa_name="لنت ترمز جلو", en_name="front brake pad",
+            brand=Brand.objects.create(name="بوش"),
+        )
+        self.brake.compatible_cars.add(Car.objects.create(fa_name="پژو ۲۰۶"))
+        self.filter = make_product(category, fa_name="فیلتر روغن", en_name="oil filter")
+        search.index_products([self.brake.id, self.filter.id])
+
+    def test_matches_names_brands_and_cars(self):
+        self.assertEqual(search.search_products("لنت ترمز")[0], self.brake)
+        self.assertEqual(search.search_products("brake")[0], self.brake)
+        self.assertEqual(search.search_products("بوش"), [self.brake])
+        self.assertEqual(search.search_products("پژو 206"), [self.brake])
+
+    def test_tolerates_typos_arabic_letters_and_the_latin_layout(self):
+        self.assertEqual(search.search_products("فيلتر روغن")[0], self.filter)
+        self.assertEqual(search.search_products("فیلتر روغم")[0], self.filter)
+        self.assertEqual(search.search_products("gkj")[0], self.brake)
+
+    def test_reindexing_drops_the_old_terms(self):
+        Product.objects.filter(pk=self.filter.pk).update(fa_name="شمع موتور", en_name="spark plug")
+        search.index_products([self.filter.id])
+
+        self.assertNotIn(self.filter, search.search_products("روغن"))
+        self.assertEqual(search.search_products("شمع")[0].id, self.filter.id)
+        self.assertEqual(search.search_products(""), [])
+
+
+class SuggestTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name="لنت ترمز")
+        self.brand = Brand.objects.create(name="بوش")
+        self.product = make_product(category, fa_name="لنت ترمز جلو پژو", brand=self.brand)
+        make_product(category, fa_name="فیلتر روغن")
+        suggest.rebuild()  # Drops the entries of other tests.
+
+    def suggestions(self, query, **params):
+        response = APIClient().get("/products/suggest/", {"query": query, **params})
+        self.assertEqual(response.status_code, 200)
+        return {kind: [entry["name"] for entry in entries] for kind, entries in response.data.items()}
+
+    def test_names_match_from_any_word_start(self):
+        self.assertEqual(self.suggestions("لنت")["products"], ["لنت ترمز جلو پژو"])
+        self.assertEqual(self.suggestions("پژ")["products"], ["لنت ترمز جلو پژو"])
+        self.assertEqual(self.suggestions("ترمز"), {
+            "products": ["لنت ترمز جلو پژو"], "brands": [], "categories": ["لنت ترمز"], "cars": [],
+        })
+        self.assertEqual(self.suggestions("رمز")["products"], [])  # Not a word start.
+        # Arabic letters and extra spaces are normalized like the names.
+        self.assertEqual(self.suggestions("  فيلتر ")["products"], ["فیلتر روغن"])
+
+    def test_saves_and_deletes_update_the_index(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.fa_name = "دیسک ترمز"
+            self.product.save()
+            self.brand.delete()
+        self.assertEqual(self.suggestions("لنت")["products"], [])
+        self.assertEqual(self.suggestions("دیسک")["products"], ["دیسک ترمز"])
+        self.assertEqual(self.suggestions("بوش")["brands"], [])
+
+    def test_query_is_required(self):
+        response = APIClient().get("/products/suggest/", {"query": " "})
+        self.assertEqual(response.status_code, 400)
+
+
+class NormalizeTextTests(TestCase):
+    def test_arabic_letters_digits_and_marks_become_canonical(self):
+        self.assertEqual(normalize_text("كيك"), "کیک")
+        self.assertEqual(normalize_text("پژو ۲۰۶ و ٢٠٦"), "پژو 206 و 206")
+        self.assertEqual(normalize_text("مُحَمَّد"), "محمد")
+        self.assertEqual(normalize_text("لنت\u200cترمز  ـجلو"), "لنت ترمز جلو")
+        self.assertEqual(normalize_text(" Brake\tPAD "), "brake pad")
+        self.assertEqual(normalize_text(None), "")
+
+    def test_latin_layout_variant(self):
+        self.assertEqual(normalized_variants("gkj"), ["gkj", "لنت"])
+        self.assertEqual(normalized_variants("لنت"), ["لنت"])
+        self.assertEqual(normalized_variants("  "), [])
+
+    def test_normalized_columns_are_stored_on_save(self):
+        product = make_product(Category.objects.create(name="c"), fa_name="فيلتر", en_name="Oil")
+        brand = Brand.objects.create(name="بوش")
+        car = Car.objects.create(fa_name="پژو ۲۰۶")
+
+        self.assertEqual((product.normalized_fa_name, product.normalized_en_name), ("فیلتر", "oil"))
+        self.assertEqual(brand.normalized_name, "بوش")
+        self.assertEqual(car.normalized_fa_name, "پژو 206")
+
+        product.fa_name = "كاسه"
+        product.save(update_fields=["fa_name"])
+        product.refresh_from_db()
+        self.assertEqual(product.normalized_fa_name, "کاسه")
+
+
+class CategoryTreeEndpointTests(TestCase):
+    def setUp(self):
+        self.root = Category.objects.create(name="موتور")
+        self.child = Category.objects.create(name="فیلتر", parent=self.root)
+        Category.objects.create(name="روغن", parent=self.child)
+        forget_cached_responses()
+
+    def test_tree_matches_the_recursive_serializer(self):
+        response = APIClient().get("/categories/")
+
+        self.assertEqual(response.status_code, 200)
+        roots = Category.objects.filter(parent=None).order_by("id")
+        self.assertEqual(
+            response.json(), CategoryWhitChildrenSerializer(roots, many=True).data
+        )
+
+    def test_tree_is_fresh_after_a_write_and_revalidates_by_etag(self):
+        client = APIClient()
+        etag = client.get("/categories/")["ETag"]
+        self.assertEqual(client.get("/categories/", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.child.name = "فیلتر هوا"
+            self.child.save()
+
+        response = client.get("/categories/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(response.json()[0]["children"][0]["name"], "فیلتر هوا")
+
+
+@override_settings(CATALOG_SNAPSHOT_ENABLED=False)
+class ProductKeysetPaginationTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name="c")
+        # Few distinct sort values, so pages end inside runs of ties.
+        self.products = [
+            make_product(category, count=i % 3, price=1000 * (i % 4)) for i in range(45)
+        ]
+        Product.objects.refresh_prices()
+        created = timezone.now()
+        for i, product in enumerate(self.products):
+            # Rows a microsecond apart, several within one millisecond.
+            Product.objects.filter(pk=product.pk).update(
+                created_date=created + timedelta(microseconds=i // 2)
+            )
+        forget_cached_responses()
+
+    def walk(self, url):
+        ids, pages = [], 0
+        while url:
+            response = APIClient().get(url)
+            self.assertEqual(response.status_code, 200)
+            page = response.data["results"]
+            ids.extend(product["id"] for product in page["results"])
+            url, pages = page["next"], pages + 1
+        return ids, pages
+
+    def test_every_ordering_is_walked_without_gaps_or_repeats(self):
+        for name, ordering in PRODUCT_ORDERINGS.items():
+            with self.subTest(ordering=name):
+                ids, pages = self.walk(f"/products/?pagination=cursor&ordering={name}")
+                expected = list(
+                    Product.objects.order_by(*ordering).values_list("id", flat=True)
+                )
+                self.assertEqual(ids, expected)
+                self.assertEqual(pages, 3)
+
+    def test_rows_added_behind_the_cursor_do_not_shift_the_next_page(self):
+        response = APIClient().get("/products/?pagination=cursor&ordering=newest")
+        first_page = [product["id"] for product in response.data["results"]["results"]]
+        newest = make_product(Category.objects.first())
+        forget_cached_responses()
+
+        rest, _ = self.walk(response.data["results"]["next"])
+        self.assertNotIn(newest.id, rest)
+        self.assertEqual(len(first_page) + len(rest), len(self.products))
+        self.assertFalse(set(first_page) & set(rest))
+
+    def test_invalid_cursor_is_not_found(self):
+        response = APIClient().get("/products/?cursor=bm90LWpzb24")
+        self.assertEqual(response.status_code, 404)
+
+
+class ProductFacetTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name="c")
+        self.bosch = Brand.objects.create(name="بوش")
+        self.car = Car.objects.create(fa_name="پراید")
+        forget_cached_responses()
+
+    def add_products(self, number):
+        for i in range(number):
+            product = make_product(
+                self.category,
+                price=300_000 * (i + 1),
+                count=i % 2,
+                brand=self.bosch if i % 3 == 0 else None,
+            )
+            if i % 2 == 0:
+                product.compatible_cars.add(self.car)
+        Product.objects.refresh_prices()
+
+    def facets(self, query=""):
+        with CaptureQueriesContext(connection) as queries:
+            response = APIClient().get(f"/products/facets/{query}")
+        self.assertEqual(response.status_code, 200)
+        return response.json(), len(queries)
+
+    def test_counts_match_the_filtered_products(self):
+        self.add_products(6)
+
+        facets, _ = self.facets(f"?compatible_cars={self.car.id}")
+        matching = Product.objects.filter(compatible_cars=self.car)
+        self.assertEqual(facets["total"], matching.count())
+        self.assertEqual(
+            facets["brands"],
+            [{"id": self.bosch.id, "name": "بوش", "count": matching.filter(brand=self.bosch).count()}],
+        )
+        self.assertEqual(facets["stock"]["in_stock"], matching.filter(count__gt=0).count())
+        self.assertEqual(sum(bucket["count"] for bucket in facets["price_ranges"]), facets["total"])
+        self.assertEqual(facets["price"]["min"], 300_000)
+
+    def test_query_count_does_not_grow_with_the_catalog(self):
+        self.add_products(3)
+        _, few = self.facets("?count=0")
+        self.add_products(30)
+        forget_cached_responses()
+        _, many = self.facets("?count=0")
+        self.assertEqual(few, many)
+
+
+class StoredPriceTests(TestCase):
+    CASES = [
+        (1_000_000, "0", "0"),
+        (1_000_000, "12.5", "3.33"),
+        (999_999, "33.33", "7.5"),
+        (123_457, "99.99", "0.01"),
+        (1, "50", "50"),
+    ]
+
+    def setUp(self):
+        self.category = Category.objects.create(name="c")
+        forget_cached_responses()
+
+    @staticmethod
+    def floor_percent(price, percent):
+        return int((Decimal(price) * Decimal(percent) / 100).to_integral_value(ROUND_FLOOR))
+
+    def test_save_and_bulk_refresh_store_the_same_exact_prices(self):
+        for price, discount, reward in self.CASES:
+            with self.subTest(price=price, discount=discount):
+                product = make_product(
+                    self.category, price=price, price_discount_percent=discount,
+                    wallet_discount=reward,
+                )
+                expected = (
+                    self.floor_percent(price, 100 - Decimal(discount)),
+                    self.floor_percent(price, reward),
+                )
+                self.assertEqual((product.discounted_price, product.wallet_reward), expected)
+
+                Product.objects.filter(pk=product.pk).update(discounted_price=0, wallet_reward=0)
+                Product.objects.filter(pk=product.pk).refresh_prices()
+                product.refresh_from_db()
+                self.assertEqual((product.discounted_price, product.wallet_reward), expected)
+
+    @override_settings(CATALOG_SNAPSHOT_ENABLED=False)
+    def test_price_filters_and_sorting_use_the_sale_price(self):
+        cheap_on_sale = make_product(self.category, price=900_000, price_discount_percent="50")
+        full_price = make_product(self.category, price=600_000)
+
+        response = APIClient().get("/products/?max_price=500000")
+        self.assertEqual([p["id"] for p in response.data["results"]["results"]], [cheap_on_sale.id])
+
+        response = APIClient().get("/products/?ordering=cheapest")
+        self.assertEqual(
+            [p["id"] for p in response.data["results"]["results"]], [cheap_on_sale.id, full_price.id]
+        )
+
+
+class ProductOrderingTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(CATALOG_SNAPSHOT_DIR=directory.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        patcher = mock.patch.object(catalog_snapshot, "_rebuild_in_background")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        category = Category.objects.create(name="c")
+        for i in range(25):
+            make_product(
+                category,
+                price=1000 * (i % 5 + 1),
+                price_discount_percent=(i * 7) % 30,
+                count=i % 4,
+                buyer=i % 6,
+                rating_avg=(i % 3) * 1.5,
+                review_count=i % 2,
+            )
+        forget_cached_responses()
+        catalog_snapshot.build(get_version(CATALOG))
+
+    def page_ids(self, ordering, page=1):
+        response = APIClient().get(f"/products/?ordering={ordering}&page={page}")
+        self.assertEqual(response.status_code, 200)
+        return [product["id"] for product in response.data["results"]["results"]]
+
+    def test_snapshot_and_database_agree_on_every_ordering(self):
+        for name, ordering in PRODUCT_ORDERINGS.items():
+            with self.subTest(ordering=name):
+                expected = list(Product.objects.order_by(*ordering).values_list("id", flat=True))
+                with mock.patch.object(
+                    catalog_snapshot.Snapshot, "select", autospec=True,
+                    side_effect=catalog_snapshot.Snapshot.select,
+                ) as select:
+                    from_snapshot = self.page_ids(name) + self.page_ids(name, 2)
+                self.assertTrue(select.called)
+                with override_settings(CATALOG_SNAPSHOT_ENABLED=False):
+                    bump_version(PRODUCT_PAGES)  # Not the cached snapshot pages.
+                    from_database = self.page_ids(name) + self.page_ids(name, 2)
+                self.assertEqual(from_snapshot, expected)
+                self.assertEqual(from_database, expected)
+
+    def test_unknown_ordering_is_rejected(self):
+        self.assertEqual(APIClient().get("/products/?ordering=random").status_code, 400)
+
+
+class PriceFeedTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=directory.name, PRICE_FEEDS_ACCEL_REDIRECT="")
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        cache.delete(feeds.SCHEDULED_KEY)
+        forget_cached_responses()
+
+        self.category = Category.objects.create(name="لنت ترمز")
+        for price, discount, count in ((120_000, "0", 3), (80_000, "25", 0), (1_000, "10", 1)):
+            make_product(
+                self.category, fa_name=" لنت جلو پژو ", price=price,
+                price_discount_percent=discount, count=count,
+            )
+        ProductImage.objects.create(
+            product=Product.objects.order_by("id").first(), image_url="https://img/1.webp"
+        )
+
+    @staticmethod
+    def baseline(product):
+        """The fields of the removed ProductTorobSerilizers / ProductEmallsSerilizers."""
+        url = f"https://adorayadak.ir/product/adp-{product.id}/{product.fa_name.strip().replace(' ', '-')}"
+        price = int(product.price * (1 - int(product.price_discount_percent) / 100))
+        image = product.images.first()
+        torob = {
+            "product_id": product.id,
+            "page_url": url,
+            "old_price": product.price,
+            "availability": "instock" if product.count > 0 else "outofstock",
+            "price": price,
+        }
+        emalls = {
+            "id": product.id,
+            "title": product.fa_name,
+            "url": url,
+            "old_price": product.price,
+            "is_available": product.count > 0,
+            "price": price,
+            "category": product.category.name,
+            "image": str(image.image_url) if image else None,
+        }
+        return torob, emalls
+
+    def fetch(self, url, **headers):
+        response = APIClient().get(url, headers=headers)
+        content = b"".join(response.streaming_content) if response.streaming else response.content
+        return response, content
+
+    def test_feeds_are_byte_compatible_with_the_serializers_they_replace(self):
+        torob, emalls = zip(*(self.baseline(product) for product in Product.objects.order_by("id")))
+        expected = {
+            "torob": JSONRenderer().render(list(torob)),
+            "emalls": JSONRenderer().render({"pages_count": 1, "products": list(emalls)}),
+        }
+
+        # Generated from the database while the first build is pending...
+        with mock.patch.object(feeds, "schedule_build") as schedule_build:
+            for name, body in expected.items():
+                self.assertEqual(self.fetch(f"/products/{name}/")[1], body)
+        self.assertTrue(schedule_build.called)
+
+        # ...then the published files and their gzip copies.
+        manifest = feeds.build(get_version(PRICE_FEEDS))
+        directory = Path(settings.MEDIA_ROOT) / "feeds" / manifest["directory"]
+        for name, body in expected.items():
+            response, content = self.fetch(f"/products/{name}/")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(content, body)
+            compressed = directory / f"{feeds.FEEDS[name].file_name()}.gz"
+            self.assertEqual(gzip.decompress(compressed.read_bytes()), body)
+
+    @override_settings(EMALLS_FEED_PAGE_SIZE=2)
+    def test_emalls_pages_cover_the_catalog_once(self):
+        feeds.build(get_version(PRICE_FEEDS))
+        products = []
+        for page in (1, 2):
+            response, content = self.fetch(f"/products/emalls/?page={page}")
+            body = json.loads(content)
+            self.assertEqual(body["pages_count"], 2)
+            products.extend(product["id"] for product in body["products"])
+
+        self.assertEqual(products, list(Product.objects.order_by("id").values_list("id", flat=True)))
+        self.assertEqual(self.fetch("/products/emalls/?page=3")[0].status_code, 404)
+
+    def test_a_catalog_change_publishes_a_new_build(self):
+        feeds.build(get_version(PRICE_FEEDS))
+        response, _ = self.fetch("/products/torob/")
+        etag = response["ETag"]
+        self.assertEqual(self.fetch("/products/torob/", if_none_match=etag)[0].status_code, 304)
+
+        product = Product.objects.order_by("id").first()
+        with self.captureOnCommitCallbacks(execute=True):  # Celery runs eagerly here.
+            product.price = 150_000
+            product.save()
+
+        response, content = self.fetch("/products/torob/", if_none_match=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(json.loads(content)[0]["price"], 150_000)
+
+
+@override_settings(CATALOG_CHANGES_LAG=0)
+class ProductChangesTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name="c")
+        self.products = [make_product(self.category) for _ in range(5)]
+
+    def page(self, since=None, limit=2):
+        params = {"limit": limit}
+        if since is not None:
+            params["since"] = since
+        response = APIClient().get("/products/changes/", params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def sync(self, since=None):
+        """Every change after ``since`` as ``(op, id)``, and the cursor to resume from."""
+        seen = []
+        while True:
+            page = self.page(since)
+            seen.extend((change["op"], change["id"]) for change in page["changes"])
+            since = page["cursor"]
+            if not page["has_more"]:
+                return seen, since
+
+    def test_cursor_resumes_without_gaps_or_repeats(self):
+        seen, cursor = self.sync()
+        self.assertEqual(seen, [("update", product.id) for product in self.products])
+
+        updated, deleted, related = self.products[1], self.products[2], self.products[3]
+        deleted_id = deleted.id
+        updated.price = 5000
+        updated.save()
+        deleted.delete()
+        # Relation changes leave updated_date alone and are read from the tombstones.
+        related.compatible_cars.add(Car.objects.create(fa_name="پژو ۲۰۶"))
+
+        seen, cursor = self.sync(cursor)
+        self.assertEqual(
+            seen, [("update", updated.id), ("delete", deleted_id), ("update", related.id)]
+        )
+        self.assertEqual(self.sync(cursor)[0], [])
+
+    def test_caught_up_cursor_moves_to_the_served_time(self):
+        before = timezone.now()
+        _, cursor = self.sync()
+        position = changes.decode_since(cursor)
+        self.assertEqual(position["products"], position["tombstones"])
+        self.assertGreaterEqual(position["products"][0], before)
+
+    def test_expired_and_invalid_cursors_are_rejected(self):
+        old = timezone.now() - timedelta(days=31)
+        cursor = changes.encode_cursor({"products": (old, 1), "tombstones": (old, 1)})
+        response = APIClient().get("/products/changes/", {"since": cursor})
+        self.assertEqual(response.status_code, 410)
+        response = APIClient().get("/products/changes/", {"since": "not a cursor"})
+        self.assertEqual(response.status_code, 400)
+
+
+class CartPricingTests(TestCase):
+    PRODUCTS = [
+        (1_000_000, "0", "0"),
+        (999_999, "12.5", "7.5"),
+        (123_457, "33.33", "3.33"),
+        (1_001, "50", "0.01"),
+    ]
+
+    def setUp(self):
+        category = Category.objects.create(name="c")
+        for price, discount, reward in self.PRODUCTS:
+            make_product(category, price=price, price_discount_percent=discount, wallet_discount=reward)
+        self.products = list(Product.objects.order_by("id"))
+        self.order = Order.objects.create(user=User.objects.create_user(phone_number="+989121112233"))
+
+    def stored(self, **amounts):
+        """``amounts`` as the order's DecimalFields store them."""
+        Order.objects.filter(pk=self.order.pk).update(**amounts)
+        return Order.objects.filter(pk=self.order.pk).values(*amounts).get()
+
+    def baseline(self, items, cash_percent, delivery_cost, wallet_balance):
+        """
+        What OrderItem.save and OrderSerializer.calculate_* stored before the
+        pricing engine, from the same sale prices; ``cash_percent`` is None for
+        installment purchases. The wallet is taken off the stored total: the old
+        code subtracted it from the unsaved float and failed on cash purchases.
+        """
+        sold_prices = [product.discounted_price for product, _ in items]
+        total = sum(product.discounted_price * quantity for product, quantity in items)
+        reward = 0
+        if cash_percent is not None:
+            sold_prices = [round(Decimal(price) * (1 - Decimal(cash_percent) / 100)) for price in sold_prices]
+            total -= (total * cash_percent) / 100
+            reward = sum(
+                (product.price * product.wallet_discount) / 100 * quantity for product, quantity in items
+            )
+        stored = self.stored(total_price=total + int(delivery_cost), order_reward=reward)
+        if wallet_balance is not None:
+            stored.update(self.stored(total_price=stored["total_price"] - wallet_balance))
+        return sold_prices, stored["total_price"], stored["order_reward"]
+
+    def test_cart_totals_match_the_previous_formulas(self):
+        carts = [
+            [(self.products[0], 1)],
+            list(zip(self.products, (3, 1, 7, 2))),
+            [(self.products[1], 11), (self.products[3], 5)],
+        ]
+        for cash_percent in (None, 0, 3, 7):
+            if cash_percent is not None:
+                CashDiscountPercent.objects.create(zarinpal_discount_percent=cash_percent)
+            reference = "torobpay" if cash_percent is None else "zarinpal"
+            for items in carts:
+                for delivery_cost, wallet_balance in ((0, None), (45_000, Decimal("1234.57"))):
+                    with self.subTest(cash=cash_percent, items=len(items), delivery=delivery_cost):
+                        cart = price_cart(items, reference, delivery_cost, wallet_balance)
+                        sold_prices, total, reward = self.baseline(
+                            items, cash_percent, delivery_cost, wallet_balance
+                        )
+                        self.assertEqual([line.sold_price for line in cart.lines], sold_prices)
+                        self.assertEqual(self.stored(**cart.order_fields()), {
+                            "total_price": total,
+                            "order_reward": reward,
+                            "amount_used_wallet_balance": wallet_balance or 0,
+                        })
+                        self.assertEqual(cart.order_reward, reward)
+
+
+class MoneyTests(TestCase):
+    def test_percents_round_down_exactly_on_ints_and_arrays(self):
+        amounts = [1, 999, 1_000, 123_457, 999_999_999]
+        for percent in ("0", "7", "12.5", "33.33", "99.99", "100"):
+            with self.subTest(percent=percent):
+                p = hundredths(percent)
+                off = [percent_off(amount, p) for amount in amounts]
+                of = [percent_of(amount, p) for amount in amounts]
+                self.assertEqual(off, [
+                    int((amount * (100 - Decimal(percent)) / 100).to_integral_value(ROUND_FLOOR))
+                    for amount in amounts
+                ])
+                self.assertEqual(of, [
+                    int((amount * Decimal(percent) / 100).to_integral_value(ROUND_FLOOR))
+                    for amount in amounts
+                ])
+                array = np.array(amounts, dtype=np.int64)
+                self.assertEqual(percent_off(array, p).tolist(), off)
+                self.assertEqual(percent_of(array, p).tolist(), of)
+
+    def test_rounded_percent_off_rounds_half_to_even_like_decimal(self):
+        for amount in (50, 150, 250, 999, 123_457):
+            for percent in (0, 1, 3, 7, 50):
+                with self.subTest(amount=amount, percent=percent):
+                    self.assertEqual(
+                        rounded_percent_off(amount, percent),
+                        round(Decimal(amount) * (1 - Decimal(percent) / 100)),
+                    )
+
+    def test_rial_conversion_rounds_down_once(self):
+        self.assertEqual(Rial.from_toman(1234), 12340)
+        self.assertEqual(Rial.from_toman(Decimal("100.95")), 1009)
+        self.assertEqual(Rial.from_toman(Decimal("100.95")).to_toman(), 100)
+        self.assertIsInstance(Rial(5) + 5, Rial)
+
+    def test_wallet_split_always_adds_up_to_the_total(self):
+        for total, wallet in (
+            (Decimal("100.95"), Decimal("0.06")),
+            (Decimal("100.95"), Decimal("40.57")),
+            (Decimal("100.95"), Decimal("500")),
+            (100, 0),
+            (100, Decimal("-3")),
+        ):
+            with self.subTest(total=total, wallet=wallet):
+                to_pay, from_wallet = wallet_split(total, wallet)
+                self.assertEqual(to_pay + from_wallet, Rial.from_toman(total))
+                self.assertGreaterEqual(to_pay, 0)
+                self.assertGreaterEqual(from_wallet, 0)
+
+    def test_the_charged_amount_comes_from_the_stored_order_amounts(self):
+        order = Order.objects.create(
+            user=User.objects.create_user(phone_number="+989121112233"),
+            use_wallet_balance=True,
+            total_price=Decimal("60.38"),  # Stored net of the wallet amount.
+            amount_used_wallet_balance=Decimal("40.57"),
+        )
+        to_pay, from_wallet, total = order.payment_amounts()
+        self.assertEqual((to_pay, from_wallet, total), (604, 405, 1009))
+        self.assertEqual(consider_walet_balance(order), to_pay)
+        self.assertEqual(consider_walet_balance(order, "TOMAN"), 60)
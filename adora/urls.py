@@ -1,6 +1,7 @@
 from django.urls import include, path
 from rest_framework.routers import DefaultRouter
 
+from adora import payment_status
 from adora.views import (
     BrandViewset,
     CarViewset,
@@ -36,6 +37,17 @@ router.register(
 
 
 urlpatterns = [
+    # Async long-poll, ahead of the orders routes.
+    path(
+        "orders/zarinpal-payment-request-info/",
+        payment_status.zarinpal_payment_status,
+        name="orders-zarinpal-payment-request-info",
+    ),
+    path(
+        "orders/payment-request-info/",
+        payment_status.installment_payment_status,
+        name="orders-payment-request-info",
+    ),
     path(
         "snappay-callback/",
         SnapPayCallbackView.as_view(),
@@ -1,14 +1,15 @@
 import json
 import os
-import time
 import traceback
 
 import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
 from django.db.models import Prefetch
 from django_filters import rest_framework as filters
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
-from fuzzywuzzy import fuzz
 from requests.exceptions import ConnectionError
 from rest_framework.decorators import action
 
@@ -25,7 +26,18 @@ from django.http import HttpResponseRedirect
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 
-from adora.filters import ProductFilter
+from adora import catalog_snapshot, changes, feeds, outbox
+from adora.caching import (
+    CATALOG,
+    CATEGORY_TREE,
+    PRODUCT_PAGES,
+    etag_response,
+    get_version,
+    make_etag,
+    versioned_response_cache,
+)
+from adora.facets import compute_product_facets, facets_cache_key
+from adora.filters import PRODUCT_ORDERINGS, ProductFilter
 from adora.models import (
     Banner,
     Brand,
@@ -40,7 +52,13 @@ from adora.models import (
     Post,
     Product,
 )
-from adora.paginations import ProductPagination
+from adora.paginations import (
+    CommentKeysetPagination,
+    ProductKeysetPagination,
+    ProductPagination,
+)
+from adora.search import search_products
+from adora.suggest import suggest as suggest_names
 from adora.serializers import (
     BrandSerializer,
     CarSerializer,
@@ -52,19 +70,21 @@ from adora.serializers import (
     OrderRejectedReasonSerializer,
     OrderSerializer,
     PostSerializer,
-    ProductEmallsSerilizers,
+    ProductChangeSerializer,
     ProductListSerializer,
     ProductRetrieveSerializer,
     ProductSearchSerializer,
-    ProductTorobSerilizers,
     SnapOrderUpdateSerilizer,
+    serialize_category_tree,
 )
 from adora.tasks import (
+    consider_walet_balance,
     get_torobpay_access_token,
     get_snap_pay_access_token,
     send_order_status_message,
     azkivam_verify,
 )
+from core.utils.money import Rial, toman_to_rial, wallet_split
 from core.permissions import (  # object_level_permissions,
     object_level_permissions_restricted_actions,
     personal_permissions,
@@ -84,6 +104,19 @@ class CategoryViewset(ModelViewSet):
     )
     serializer_class = CategoryWhitChildrenSerializer
 
+    def list(self, request: Request, *args, **kwargs):
+        version = get_version(CATEGORY_TREE)
+
+        def get_tree():
+            cache_key = f"adora:categories:tree:{version}"
+            tree = cache.get(cache_key)
+            if tree is None:
+                tree = serialize_category_tree()
+                cache.set(cache_key, tree, timeout=settings.CATEGORY_TREE_CACHE_TTL)
+            return tree
+
+        return etag_response(request, make_etag("categories", version), get_tree)
+
     @action(
         detail=False,
         methods=["get"],
@@ -101,6 +134,12 @@ class CategoryViewset(ModelViewSet):
         return Response(banners, status=status.HTTP_200_OK)
 
 
+# Columns every listing order reads, kept by sparse querysets.
+ORDERING_COLUMNS = {
+    field.lstrip("-") for ordering in PRODUCT_ORDERINGS.values() for field in ordering
+}
+
+
 class ProductViewset(ModelViewSet):
     queryset = (
         Product.objects.select_related(
@@ -113,7 +152,7 @@ class ProductViewset(ModelViewSet):
             "images",
         )
         .all()
-        .order_by("-count")
+        .order_by(*PRODUCT_ORDERINGS["default"])
     )
     serializer_class = ProductRetrieveSerializer
     filter_backends = (filters.DjangoFilterBackend,)
@@ -121,6 +160,17 @@ class ProductViewset(ModelViewSet):
     pagination_class = ProductPagination
     permission_classes = [personal_permissions({"u": 3, "a": 63, "o": 3})]
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action == "list":
+            # Cards come from the product fragment cache, which prefetches for misses only.
+            queryset = queryset.prefetch_related(None)
+        if self.action in ("list", "retrieve"):
+            # ?fields= also trims the columns and relations that are loaded.
+            queryset = self.get_serializer().sparse_queryset(queryset, ORDERING_COLUMNS)
+        return queryset
+
+    @versioned_response_cache("products:retrieve", PRODUCT_PAGES)
     def retrieve(self, request, *args, **kwargs):
         self.serializer_class = ProductRetrieveSerializer
         return super().retrieve(request, *args, **kwargs)
@@ -149,6 +199,7 @@ class ProductViewset(ModelViewSet):
         # ],
         responses={200: ProductRetrieveSerializer(many=True)},
     )
+    @versioned_response_cache("products:list", PRODUCT_PAGES)
     def list(self, request: Request, *args, **kwargs):
         query_params = request.query_params
         min_price = query_params.get("min_price", "")
@@ -165,6 +216,13 @@ class ProductViewset(ModelViewSet):
                 pass
 
         self.serializer_class = ProductListSerializer
+        if (
+            "cursor" in query_params
+            or query_params.get("pagination") == "cursor"
+        ):
+            # Infinite scroll: constant cost pages without COUNT(*) or OFFSET.
+            self.pagination_class = ProductKeysetPagination
+
         if (min_price.isdigit() and int(min_price) < 0) or len(min_price) > 20:
             return Response(
                 {
@@ -184,11 +242,26 @@ class ProductViewset(ModelViewSet):
         return Response(
             {
                 "category_hierarchy": hierarchy,
-                "results": super().list(request, *args, **kwargs).data,
+                "results": self.list_results(request, *args, **kwargs),
             },
             status=status.HTTP_200_OK,
         )
 
+    def list_results(self, request: Request, *args, **kwargs):
+        """Page of the product list, answered from the catalog snapshot when possible."""
+        if settings.CATALOG_SNAPSHOT_ENABLED and self.pagination_class is ProductPagination:
+            snapshot_filters = catalog_snapshot.parse_filters(request.query_params)
+            snapshot = catalog_snapshot.current() if snapshot_filters is not None else None
+            ids = snapshot.select(snapshot_filters) if snapshot is not None else None
+            if ids is not None:
+                page = self.paginate_queryset(
+                    catalog_snapshot.SnapshotResult(ids, self.get_queryset())
+                )
+                serializer = self.get_serializer(page, many=True)
+                return self.get_paginated_response(serializer.data).data
+
+        return super().list(request, *args, **kwargs).data
+
     @action(
         detail=False,
         methods=["GET"],
@@ -198,23 +271,8 @@ class ProductViewset(ModelViewSet):
     def search(self, request: Request, *args, **kwargs):
         query = request.query_params.get("query", "").strip()
         if query:
-            products = (
-                Product.objects.all()
-                .select_related("category", "brand", "material")
-                .prefetch_related("images", "compatible_cars")
-            )
-
-            similar_products = []
-            for product in products:
-                title = product.fa_name
-                ratio = fuzz.WRatio(query, title)
-                print("ratio", ratio)
-                if ratio >= 50:
-                    similar_products.append((product, ratio))
-
-            similar_products.sort(key=lambda x: x[1], reverse=True)
-            sorted_products = [product for product, ratio in similar_products]
-            serializer = ProductSearchSerializer(sorted_products, many=True)
+            products = search_products(query)
+            serializer = ProductSearchSerializer(products, many=True)
 
             return Response(serializer.data)
 
@@ -224,6 +282,99 @@ class ProductViewset(ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
+    @action(
+        detail=False,
+        methods=["GET"],
+        url_path="facets",
+        permission_classes=[permissions.AllowAny],
+    )
+    def facets(self, request: Request, *args, **kwargs):
+        filter_params = {
+            name: request.query_params.getlist(name)
+            for name in ProductFilter.base_filters
+            if name in request.query_params and name != "ordering"
+        }
+        cache_key = facets_cache_key(get_version(CATALOG), filter_params)
+        facets = cache.get(cache_key)
+        if facets is None:
+            facets = compute_product_facets(self.filter_queryset(Product.objects.all()))
+            cache.set(cache_key, facets, timeout=settings.PRODUCT_FACETS_CACHE_TTL)
+        return Response(facets, status=status.HTTP_200_OK)
+
+    @action(
+        detail=False,
+        methods=["GET"],
+        url_path="suggest",
+        permission_classes=[permissions.AllowAny],
+    )
+    def suggest(self, request: Request, *args, **kwargs):
+        try:
+            limit = int(request.query_params.get("limit", 5))
+        except ValueError:
+            raise ValidationError({"detail": "limit must be an integer."})
+
+        suggestions = suggest_names(request.query_params.get("query", ""), limit)
+        if suggestions is None:
+            return Response(
+                {"detail": "Query parameter is required."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        return Response(suggestions, status=status.HTTP_200_OK)
+
+    @action(
+        detail=False,
+        methods=["Get"],
+        url_path="changes",
+        permission_classes=[permissions.AllowAny],
+    )
+    def changes(self, request: Request):
+        """
+        Products changed since ``?since=`` (the ``cursor`` of the previous
+        response, or an ISO 8601 datetime; nothing to start a full sync), oldest
+        first. Keep calling with the returned cursor while ``has_more``.
+        """
+        try:
+            limit = min(
+                int(request.query_params.get("limit", settings.CATALOG_CHANGES_PAGE_SIZE)),
+                settings.CATALOG_CHANGES_PAGE_SIZE,
+            )
+        except ValueError:
+            raise ValidationError({"detail": "limit must be an integer."})
+        if limit < 1:
+            raise ValidationError({"detail": "limit must be a positive integer."})
+
+        try:
+            page = changes.catalog_changes(request.query_params.get("since"), limit)
+        except changes.InvalidCursor:
+            raise ValidationError({"detail": "Invalid since."})
+        except changes.ExpiredCursor:
+            return Response(
+                {"detail": "since is older than the change history, sync the whole catalog."},
+                status=status.HTTP_410_GONE,
+            )
+
+        products = ProductChangeSerializer(
+            [change.product for change in page.changes if change.product is not None],
+            many=True,
+        ).data
+        products = {product["id"]: product for product in products}
+        return Response(
+            {
+                "changes": [
+                    {
+                        "op": change.op,
+                        "id": change.product_id,
+                        "at": change.at,
+                        **({"product": products[change.product_id]} if change.product else {}),
+                    }
+                    for change in page.changes
+                ],
+                "cursor": page.cursor,
+                "has_more": page.has_more,
+            },
+            status=status.HTTP_200_OK,
+        )
+
     @action(
         detail=False,
         methods=["Get"],
@@ -231,11 +382,7 @@ class ProductViewset(ModelViewSet):
         permission_classes=[permissions.AllowAny],
     )
     def products_torob(self, request: Request):
-        products = Product.objects.all()
-        # .select_related( 'category', 'brand', 'material' )\
-        #     .prefetch_related('images','compatible_cars' )
-        serialize = ProductTorobSerilizers(products, many=True)
-        return Response(serialize.data, status=status.HTTP_200_OK)
+        return self._price_feed(request, "torob")
 
     @action(
         detail=False,
@@ -244,13 +391,31 @@ class ProductViewset(ModelViewSet):
         permission_classes=[permissions.AllowAny],
     )
     def products_emalls(self, request: Request):
-        products = Product.objects.prefetch_related("images").all()
-        # .select_related( 'category', 'brand', 'material' )\
-        #     .prefetch_related('images','compatible_cars' )
-        serialize = ProductEmallsSerilizers(products, many=True)
-        return Response(
-            {"pages_count": 1, "products": serialize.data}, status=status.HTTP_200_OK
-        )
+        return self._price_feed(request, "emalls")
+
+    @action(
+        detail=False,
+        methods=["Get"],
+        url_path=r"feeds/(?P<feed_name>[a-z0-9_-]+)",
+        permission_classes=[permissions.AllowAny],
+    )
+    def products_feed(self, request: Request, feed_name: str):
+        if feed_name not in feeds.FEEDS:
+            return Response({"detail": "Feed not found."}, status=status.HTTP_404_NOT_FOUND)
+        return self._price_feed(request, feed_name)
+
+    def _price_feed(self, request: Request, name: str):
+        page = request.query_params.get("page", "1")
+        if not page.isdigit() or int(page) < 1:
+            return Response(
+                {"detail": "page must be a positive integer."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        response = feeds.serve(request, name, int(page))
+        if response is None:
+            return Response({"detail": "Page not found."}, status=status.HTTP_404_NOT_FOUND)
+        return response
 
 
 class BrandViewset(ModelViewSet):
@@ -276,15 +441,27 @@ class CommentViewSet(ModelViewSet):
 
     def get_queryset(self):
         if self.action == "list":
-            return Comment.objects.filter(parent__isnull=True).select_related(
+            queryset = Comment.objects.filter(parent__isnull=True).select_related(
                 "product", "user"
             )
+            product = self.request.query_params.get("product")
+            if product is not None:
+                if not product.isdigit():
+                    raise ValidationError({"product": "product must be an integer."})
+                queryset = queryset.filter(product_id=product)
+            return queryset
 
         # if self.action == 'retrieve':
         #     return Comment.objects.all().select_related('product', 'user')
 
         return Comment.objects.all().select_related("product", "user")
 
+    def list(self, request: Request, *args, **kwargs):
+        if "product" in request.query_params:
+            # Threads of one product, newest first, paged by cursor.
+            self.pagination_class = CommentKeysetPagination
+        return super().list(request, *args, **kwargs)
+
     def perform_create(self, serializer):
         parent_id = self.request.data.get("parent")
         if parent_id:
@@ -354,12 +531,16 @@ class OrderViewSet(viewsets.ModelViewSet):
             if self.action == "list":
                 user = self.request.user
 
-                return Order.objects.filter(user=user)
+                queryset = Order.objects.filter(user=user).prefetch_related("order_items__product")
+                return self.get_serializer().sparse_queryset(queryset)
 
             # if self.action == 'retrieve':
             #     return Comment.objects.all().select_related('product', 'user')
 
-            return Order.objects.all()
+            queryset = Order.objects.all().prefetch_related("order_items__product")
+            if self.action == "retrieve":
+                return self.get_serializer().sparse_queryset(queryset)
+            return queryset
 
         else:
             return Order.objects.none()
@@ -380,73 +561,6 @@ class OrderViewSet(viewsets.ModelViewSet):
         if instance.user != self.request.user:
             raise PermissionDenied("You do not have permission to delete this comment.")
 
-    @action(
-        detail=False,
-        methods=["get"],
-        url_path="zarinpal-payment-request-info",
-        permission_classes=[permissions.IsAuthenticated],
-    )
-    def zarinpal_payment_status(self, request: Request):
-        try:
-            tracking_number = request.query_params.get("tracking_number")
-
-            if not tracking_number:
-                return Response(
-                    {"message": "Tracking number is missing."},
-                    status=status.HTTP_400_BAD_REQUEST,
-                )
-
-            order = Order.objects.filter(tracking_number=tracking_number).first()
-            if not order:
-                return Response(
-                    {
-                        "message": f"There is no Order with this tracking number {tracking_number}."
-                    },
-                    status=status.HTTP_404_NOT_FOUND,
-                )
-            max_attempts = 5
-            for attempt in range(max_attempts):
-                if hasattr(order, "receipt"):
-                    order_receipt = order.receipt
-                    break  # Exit the loop if receipt exists
-                else:
-                    if attempt < max_attempts - 1:  # Avoid sleep after the last attempt
-                        time.sleep(5)  # Wait for 5 seconds before retrying
-
-            # Check if a receipt was found after the retries
-            if not hasattr(order, "receipt"):
-                return Response(
-                    {
-                        "message": "Order receipt not created after multiple attempts, please try again later!"
-                    },
-                    status=status.HTTP_202_ACCEPTED,
-                )
-
-            request_code = order.receipt.request_code
-            if request_code == 100:
-                return Response(
-                    {
-                        "payment_url": f"{os.environ.get('ZARIN_START_PAY_URL')}/{order_receipt.authority}",
-                        "message": order_receipt.request_msg,
-                        "fee": order_receipt.fee,
-                        "amount": int(order.total_price),
-                    },
-                    status=status.HTTP_200_OK,
-                )
-
-            else:
-                return Response(
-                    {"message": order_receipt.error_msg, "code": request_code},
-                    status=status.HTTP_402_PAYMENT_REQUIRED,
-                )
-        except Exception:
-            error_message = str(traceback.format_exc())
-            print(error_message)
-            return Response(
-                {"message": f"An unexpected error!!"},
-                status=status.HTTP_400_BAD_REQUEST,
-            )
-
     def _get_full_name_or_phone_number(self, order: Order) -> str:
         user_prfile = order.user.profile
         name = user_prfile.first_name or ""
@@ -530,7 +644,8 @@ class OrderViewSet(viewsets.ModelViewSet):
                 zarin_verify_url = os.getenv("ZARIN_VERIFY_URL", "")
                 verify_payload = {
                     "merchant_id": os.getenv("ZARIN_MERCHANT_ID"),
-                    "amount": int(order.total_price),
+                    # The amount charged by send_zarin_payment_information.
+                    "amount": consider_walet_balance(order, "TOMAN"),
                     "authority": authority,
                 }
 
@@ -977,7 +1092,7 @@ class OrderViewSet(viewsets.ModelViewSet):
             cart_items_list = list(map(
                 lambda item: {
                     "id": item[0].id,
-                    "amount": int(item[2] * 10),  # تبدیل به ریال
+                    "amount": toman_to_rial(item[2]),  # تبدیل به ریال
                     "category": "ابزار و یدک خودرو",
                     "count": item[1],
                     "name": item[0].fa_name,
@@ -988,28 +1103,12 @@ class OrderViewSet(viewsets.ModelViewSet):
 
 
             total_amount += order.delivery_cost
-            print(order.user.profile.wallet_balance, "profile wallet balance from snap update")
-            print(order.amount_used_wallet_balance, "used wallet balance from snap update")
-            print(total_amount, "total amount from snap update")
             # محاسبه مبلغ با در نظر گرفتن کیف پول برای مبلغ جدید
-            if order.use_wallet_balance:
-                wallet_balance = order.amount_used_wallet_balance
-                if wallet_balance >= total_amount:
-                    print(wallet_balance, "total amount from snap update")
-                    print(total_amount, "total amount from snap update")
-                    # کل مبلغ از کیف پول پرداخت می‌شود
-                    print("Wallet_balance is greater than total_amout")
-                    amount_to_pay = 0
-                    wallet_discount = int(total_amount * 10)
-                else:
-
-                    # بخشی از کیف پول استفاده می‌شود
-                    amount_to_pay = int((total_amount - wallet_balance) * 10)
-                    wallet_discount = int(wallet_balance * 10)
-            else:
-                # کیف پول استفاده نمی‌شود
-                amount_to_pay = int(total_amount * 10)
-                wallet_discount = 0
+            # (اگر کیف پول بیشتر از مبلغ باشد کل مبلغ از کیف پول پرداخت می‌شود)
+            amount_to_pay, wallet_discount = wallet_split(
+                total_amount,
+                order.amount_used_wallet_balance if order.use_wallet_balance else 0,
+            )
 
             # ساخت payload برای درخواست update
 
@@ -1022,13 +1121,13 @@ class OrderViewSet(viewsets.ModelViewSet):
                         "cartItems": cart_items_list,
                         "isShipmentIncluded": True if order.delivery_cost else False,
                         "isTaxIncluded": True,
-                        "shippingAmount": int(order.delivery_cost * 10) if order.delivery_cost else 0,
+                        "shippingAmount": Rial.from_toman(order.delivery_cost),
                         "taxAmount": 0,
-                        "totalAmount": int(total_amount * 10)
+                        "totalAmount": amount_to_pay + wallet_discount
                     }
                 ],
                 "discountAmount": 0,
-                "discountAmount": 0,
+                "externalSourceAmount": wallet_discount,
                 "paymentMethodTypeDto": "INSTALLMENT",
                 "paymentToken": order.snap_payment_token
             }
@@ -1068,7 +1167,7 @@ class OrderViewSet(viewsets.ModelViewSet):
                     )
 
                 # به‌روزرسانی مبلغ کل سفارش
-                order.total_price = int(amount_to_pay / 10)
+                order.total_price = amount_to_pay.to_toman()
                 order.payment_status = "SU"
                 order.save()
 
@@ -1076,7 +1175,7 @@ class OrderViewSet(viewsets.ModelViewSet):
                     "message": "Order updated successfully",
                     "transactionId": response_dict.get("response", {}).get("transactionId"),
                     "old_total": float(old_total),
-                    "new_total": float(amount_to_pay / 10)
+                    "new_total": amount_to_pay.to_toman()
                 }, status=status.HTTP_200_OK)
             else:
                 error_data = response_dict.get("errorData", {})
@@ -1205,12 +1304,13 @@ class OrderViewSet(viewsets.ModelViewSet):
             phone_number = str(order.user.phone_number).replace("+98", "0")
             text_code = os.environ.get("ORDER_RETURNED_ASK", 0)
             print(text_code)
-            send_order_status_message.delay(
-                phone_number, [full_name, tracking_number], int(text_code)
-            )
-            order.returned_asked_reason = returned_asked_reason
-            order.returned_status = "RA"
-            order.save()
+            with transaction.atomic():
+                order.returned_asked_reason = returned_asked_reason
+                order.returned_status = "RA"
+                order.save()
+                outbox.enqueue_order_status_sms(
+                    phone_number, [full_name, tracking_number], int(text_code), order=order
+                )
 
             return Response(
                 {"message": "Rjected ask was successfully"}, status=status.HTTP_200_OK
@@ -11,6 +11,10 @@ import os
 
 from django.core.asgi import get_asgi_application
 
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+
+DJANGO_ENV = os.environ.get('DJANGO_ENV', 'development')
+
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', f'core.settings.{DJANGO_ENV}')
 
 application = get_asgi_application()
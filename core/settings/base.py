@@ -215,12 +215,65 @@ CELERY_BEAT_SCHEDULE = {
         "schedule": 2,
         "args": ["0909090909", "1111111"],
         # 'kwargs': {}
-    }
+    },
+    "reconcile_product_reviews": {
+        "task": "adora.tasks.reconcile_product_reviews",
+        "schedule": crontab(hour=4, minute=0),
+    },
+    "prune_catalog_tombstones": {
+        "task": "adora.tasks.prune_catalog_tombstones",
+        "schedule": crontab(hour=4, minute=30),
+    },
+    # Retries outbox messages whose dispatch failed or was never queued.
+    "dispatch_outbox": {
+        "task": "adora.tasks.dispatch_outbox",
+        "schedule": crontab(minute="*"),
+    },
 }
 
 
 APPEND_SLASH = True
 CACHE_TTL = 1 * 60
+CATEGORY_TREE_CACHE_TTL = 24 * 60 * 60
+PRODUCT_FACETS_CACHE_TTL = 5 * 60
+PRODUCT_RESPONSE_CACHE_TTL = 10 * 60
+PRODUCT_FRAGMENT_CACHE_TTL = 60 * 60
+# Comment threads inlined in product pages; the rest is paged by comments?product=<id>.
+PRODUCT_COMMENTS_PAGE_SIZE = 10
+COMMENT_REPLY_MAX_DEPTH = 3
+COMMENT_REPLIES_LIMIT = 5
+# Columnar product snapshot shared by the gunicorn workers (adora.catalog_snapshot).
+CATALOG_SNAPSHOT_ENABLED = True
+CATALOG_SNAPSHOT_DIR = BASE_DIR / "catalog_snapshot"
+# Seconds a snapshot is kept after the catalog changes, to batch bursts of edits.
+CATALOG_SNAPSHOT_MIN_AGE = 30
+# Price-comparison feeds (adora.feeds): seconds between rebuilds, products fetched per
+# query while streaming, Emalls page size, and the nginx internal location serving
+# MEDIA_ROOT/feeds/ (empty to send the files from Django).
+PRICE_FEEDS_MIN_INTERVAL = 10 * 60
+PRICE_FEEDS_CHUNK_SIZE = 2000
+EMALLS_FEED_PAGE_SIZE = 500
+PRICE_FEEDS_ACCEL_REDIRECT = os.environ.get("PRICE_FEEDS_ACCEL_REDIRECT", "")
+# products/changes: page size, seconds a change waits before it is served (so late commits
+# are not skipped), and days deletes are remembered for (older cursors must resync).
+CATALOG_CHANGES_PAGE_SIZE = 500
+CATALOG_CHANGES_LAG = 5
+CATALOG_TOMBSTONE_RETENTION_DAYS = 30
+# Tries before an outbox message is marked failed, messages per dispatch sweep, and seconds a
+# claimed message is left to its worker before another may run it.
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_CLAIM_SECONDS = 300
+# Seconds a payment gateway or SMS request may take; keep them well under
+# OUTBOX_CLAIM_SECONDS, or a slow request could be sent again by another worker.
+PAYMENT_GATEWAY_TIMEOUT = 20
+SMS_GATEWAY_TIMEOUT = 10
+# Long-polls of orders/zarinpal-payment-request-info and orders/payment-request-info
+# (adora.payment_status).
+PAYMENT_STATUS_WAIT_TIMEOUT = 20
+PAYMENT_EVENTS_REDIS_URL = CACHES["default"]["LOCATION"]
+# Lower bounds (Toman) of the price ranges counted by products/facets.
+PRODUCT_FACET_PRICE_BUCKETS = [0, 500_000, 1_000_000, 2_000_000, 5_000_000, 10_000_000]
 
 SESSION_ENGINE = "django.contrib.sessions.backends.cache"
 SESSION_CACHE_ALIAS = "default"  # Points to the master Redis
@@ -0,0 +1,81 @@
+"""
+Integer money helpers.
+
+Prices are whole Toman in the database; order totals and the wallet are
+``DecimalField`` with two decimals; the gateways are paid in Rial
+(1 Toman = 10 Rial). Everything here works on integers: percents are taken
+in hundredths of a percent, and Toman amounts become ``Rial`` in one place,
+rounded down to a whole Rial, so what is charged and what is later verified
+come from the same conversion.
+
+The percent and conversion helpers only use ``*`` and ``//``, so they work
+the same on Python ints and on NumPy integer arrays.
+"""
+
+from decimal import ROUND_FLOOR, Decimal
+from typing import Tuple
+
+RIALS_PER_TOMAN = 10
+
+
+def hundredths(percent) -> int:
+    """``percent`` (int, str or Decimal, at most two decimals) in hundredths of a percent."""
+    return int((Decimal(str(percent)) * 100).to_integral_value())
+
+
+def percent_off(amount, percent_hundredths):
+    """``amount`` less the percent, rounded down."""
+    return amount * (10000 - percent_hundredths) // 10000
+
+
+def percent_of(amount, percent_hundredths):
+    """The percent of ``amount``, rounded down."""
+    return amount * percent_hundredths // 10000
+
+
+def rounded_percent_off(amount: int, percent: int) -> int:
+    """``amount`` less ``percent`` (whole) percent, rounded to the nearest unit, half to even."""
+    quotient, remainder = divmod(amount * (100 - percent), 100)
+    if remainder * 2 > 100 or (remainder * 2 == 100 and quotient % 2):
+        quotient += 1
+    return quotient
+
+
+def toman_to_rial(toman):
+    """Whole Toman to Rial."""
+    return toman * RIALS_PER_TOMAN
+
+
+class Rial(int):
+    """An amount in Rial, as the gateways take it."""
+
+    @classmethod
+    def from_toman(cls, toman) -> "Rial":
+        """Toman (int or Decimal) to Rial, rounded down to a whole Rial."""
+        if isinstance(toman, int):
+            return cls(toman * RIALS_PER_TOMAN)
+        rials = (Decimal(str(toman)) * RIALS_PER_TOMAN).to_integral_value(ROUND_FLOOR)
+        return cls(int(rials))
+
+    def to_toman(self) -> int:
+        """Whole Toman, rounded down."""
+        return int(self) // RIALS_PER_TOMAN
+
+    def __add__(self, other):
+        return Rial(int(self) + int(other))
+
+    def __sub__(self, other):
+        return Rial(int(self) - int(other))
+
+    def __repr__(self):
+        return f"Rial({int(self)})"
+
+
+def wallet_split(total_toman, wallet_toman) -> Tuple[Rial, Rial]:
+    """
+    ``(to pay, paid from the wallet)`` of a total, in Rial. The wallet covers
+    at most the total, and the two always add up to the total in Rial.
+    """
+    total = Rial.from_toman(total_toman)
+    wallet = min(Rial.from_toman(wallet_toman), total) if wallet_toman > 0 else Rial(0)
+    return total - wallet, wallet
@@ -0,0 +1,122 @@
+import re
+
+# Arabic code points that customers (and Arabic keyboards) use instead of the Persian ones.
+_CHARACTERS = str.maketrans(
+    {
+        "ي": "ی",
+        "ى": "ی",
+        "ئ": "ی",
+        "ك": "ک",
+        "ة": "ه",
+        "ۀ": "ه",
+        "أ": "ا",
+        "إ": "ا",
+        "ٱ": "ا",
+        "آ": "ا",
+        "ؤ": "و",
+        "۰": "0",
+        "۱": "1",
+        "۲": "2",
+        "۳": "3",
+        "۴": "4",
+        "۵": "5",
+        "۶": "6",
+        "۷": "7",
+        "۸": "8",
+        "۹": "9",
+        "٠": "0",
+        "١": "1",
+        "٢": "2",
+        "٣": "3",
+        "٤": "4",
+        "٥": "5",
+        "٦": "6",
+        "٧": "7",
+        "٨": "8",
+        "٩": "9",
+        # Half-space and the other invisible joiners separate words like a space.
+        "‌": " ",
+        "‍": " ",
+        "‎": None,
+        "‏": None,
+        "﻿": None,
+        "ـ": None,  # tatweel
+    }
+)
+
+# Harakat, tanwin, shadda, sukun and superscript alef.
+_DIACRITICS = re.compile("[ً-ٰٟ]")
+_WHITESPACE = re.compile(r"\s+")
+
+# Latin key -> Persian character on the standard Persian keyboard layout.
+_PERSIAN_LAYOUT = str.maketrans(
+    {
+        "q": "ض",
+        "w": "ص",
+        "e": "ث",
+        "r": "ق",
+        "t": "ف",
+        "y": "غ",
+        "u": "ع",
+        "i": "ه",
+        "o": "خ",
+        "p": "ح",
+        "[": "ج",
+        "]": "چ",
+        "a": "ش",
+        "s": "س",
+        "d": "ی",
+        "f": "ب",
+        "g": "ل",
+        "h": "ا",
+        "j": "ت",
+        "k": "ن",
+        "l": "م",
+        ";": "ک",
+        "'": "گ",
+        "z": "ظ",
+        "x": "ط",
+        "c": "ز",
+        "v": "ر",
+        "b": "ذ",
+        "n": "د",
+        "m": "پ",
+        ",": "و",
+        "\\": "پ",
+    }
+)
+_LATIN_LETTER = re.compile("[a-z]")
+
+
+def normalize_text(text: str) -> str:
+    """
+    Canonical form used for searching and for the stored ``normalized_*`` columns.
+
+    Arabic letters become their Persian equivalents, Persian/Arabic digits become
+    ASCII digits, diacritics and tatweel are dropped, half-spaces become spaces,
+    whitespace is collapsed and Latin letters are lower-cased.
+    """
+    if not text:
+        return ""
+    text = str(text).translate(_CHARACTERS)
+    text = _DIACRITICS.sub("", text)
+    return _WHITESPACE.sub(" ", text).strip().lower()
+
+
+def latin_to_persian_layout(text: str) -> str:
+    """Rewrites text typed with the keyboard on the Latin layout as the intended Persian text."""
+    return normalize_text(normalize_text(text).translate(_PERSIAN_LAYOUT))
+
+
+def normalized_variants(text: str) -> list:
+    """
+    The normalized text, followed by its Persian-layout reading when it contains
+    Latin letters (e.g. ``gkj`` -> ``لنت``).
+    """
+    normalized = normalize_text(text)
+    variants = [normalized] if normalized else []
+    if _LATIN_LETTER.search(normalized):
+        persian = latin_to_persian_layout(normalized)
+        if persian and persian != normalized:
+            variants.append(persian)
+    return variants
@@ -75,7 +75,8 @@ echo "Fixing ownership of static files"
 # Gunicorn settings
 NUM_WORKERS=3
 SOCKET_PATH="/run/gunicorn.sock"
-WSGI_APPLICATION="core.wsgi:application"
+# ASGI, so the long-polled payment status (adora.payment_status) waits without holding a worker.
+ASGI_APPLICATION="core.asgi:application"
 
 if [ ! -d "/run" ]; then
     mkdir -p /run
@@ -86,5 +87,6 @@ if [ -e "$SOCKET_PATH" ]; then
 fi
 
 echo "Running Django Production server with Gunicorn"
-exec gunicorn --workers $NUM_WORKERS --bind unix:$SOCKET_PATH $WSGI_APPLICATION \
+exec gunicorn --workers $NUM_WORKERS --worker-class uvicorn.workers.UvicornWorker \
+    --bind unix:$SOCKET_PATH $ASGI_APPLICATION \
     --user adora_u --group adora_g